@@ -2,6 +2,8 @@
 ASGI config for Equb project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP requests are served by Django and websocket connections by the
+moneypool consumers.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
@@ -13,4 +15,17 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Equb.settings')
 
-application = get_asgi_application()
+django_asgi_application = get_asgi_application()
+
+from channels.auth import AuthMiddlewareStack
+from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.security.websocket import AllowedHostsOriginValidator
+
+from moneypool.routing import JWTAuthMiddleware, websocket_urlpatterns
+
+application = ProtocolTypeRouter({
+    'http': django_asgi_application,
+    'websocket': AllowedHostsOriginValidator(
+        AuthMiddlewareStack(JWTAuthMiddleware(URLRouter(websocket_urlpatterns)))
+    ),
+})
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 """
 
 import os
+import datetime
 import dj_database_url
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -39,6 +40,7 @@ CORS_ALLOWED_ORIGINS = [
 # Application definition
 
 INSTALLED_APPS = [
+    'daphne',
     'moneypool.apps.MoneypoolConfig',
     'rest_framework',
     'rest_framework_simplejwt',
@@ -46,12 +48,14 @@ INSTALLED_APPS = [
     'corsheaders',
     'guardian',
     'background_task',
+    'channels',
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 ]
 
 MIDDLEWARE = [
@@ -67,9 +71,13 @@ MIDDLEWARE = [
 
 AUTHENTICATION_BACKENDS = [
     'django.contrib.auth.backends.ModelBackend',
-    'guardian.backends.ObjectPermissionBackend',
+    'moneypool.permissions.OwnershipPermissionBackend',
 ]
 
+# object permissions are derived from ownership by OwnershipPermissionBackend instead of guardian;
+# guardian stays installed until existing rows are removed with the prune_object_permissions command
+SILENCED_SYSTEM_CHECKS = ['guardian.W001']
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework_simplejwt.authentication.JWTAuthentication',
@@ -77,6 +85,24 @@ REST_FRAMEWORK = {
     ),
 }
 
+REDIS_URL = os.getenv('REDIS_URL')
+
+# serialized equbs are kept in a cache shared by all processes when redis is available.
+# A cache local to each process would miss the invalidations made by the others, so
+# without redis nothing is cached
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'equbs': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'KEY_PREFIX': 'moneypool',
+    } if REDIS_URL else {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    },
+}
+
 ROOT_URLCONF = 'Equb.urls'
 
 TEMPLATES = [
@@ -96,6 +122,23 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'Equb.wsgi.application'
+ASGI_APPLICATION = 'Equb.asgi.application'
+
+# bids of open rounds are kept in redis sorted sets when a url is set; an empty url disables them
+AUCTION_BOOK_URL = os.getenv('AUCTION_BOOK_URL', REDIS_URL)
+
+# pending friend requests older than this are expired by the expire_requests command
+FRIEND_REQUEST_TTL = datetime.timedelta(days=int(os.getenv('FRIEND_REQUEST_TTL_DAYS', 30)))
+
+# equb events are pushed to websocket clients through redis when it is available
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'CONFIG': {'hosts': [REDIS_URL]},
+    } if REDIS_URL else {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    },
+}
 
 
 # Database
@@ -21,3 +21,6 @@ admin.site.register(NewRoundNotification)
 admin.site.register(PaymentConfirmationRequest)
 admin.site.register(PaymentMethod)
 
+admin.site.register(RoundState)
+admin.site.register(LedgerEntry)
+admin.site.register(RoundDeadline)
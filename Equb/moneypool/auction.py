@@ -0,0 +1,203 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+
+import collections
+import contextlib
+import decimal
+import logging
+import time
+
+import redis
+
+from .models import Bid, BidPlacement
+
+# bids of a round are kept this long after the end of its cycle in case the round is closed late
+AUCTION_BOOK_GRACE_SECONDS = 60 * 60 * 24
+
+# once redis fails, the auction books aren't tried again for this long so that
+# bids fall back to the database right away instead of waiting for a timeout
+AUCTION_BOOK_BACKOFF_SECONDS = 30
+
+# a bid's score is its amount in thousandths followed by the inverse of its arrival
+# order, so that of two equal bids the earlier one ranks higher like it does in HighestBid
+SEQUENCE_BITS = 32
+
+LiveBid = collections.namedtuple('LiveBid', ['bid_id', 'user_id', 'amount'])
+
+
+class AuctionBookUnavailable(Exception):
+    pass
+
+
+_client = None
+_unavailable_until = 0.0
+
+
+def auction_client():
+    """
+    returns the redis client of the auction books, or None if they are disabled
+    """
+    global _client
+    if _client is None and settings.AUCTION_BOOK_URL:
+        _client = redis.Redis.from_url(settings.AUCTION_BOOK_URL, socket_timeout=1)
+    return _client
+
+
+@contextlib.contextmanager
+def book_operation():
+    """
+    turns redis errors into AuctionBookUnavailable, which is also raised without
+    calling redis for AUCTION_BOOK_BACKOFF_SECONDS after an error
+    """
+    global _unavailable_until
+    if time.monotonic() < _unavailable_until:
+        raise AuctionBookUnavailable('auction books are unavailable after a recent error')
+    try:
+        yield
+    except redis.RedisError as error:
+        _unavailable_until = time.monotonic() + AUCTION_BOOK_BACKOFF_SECONDS
+        raise AuctionBookUnavailable() from error
+
+
+class AuctionBook:
+    """
+    Live bids of one equb round kept in two redis sorted sets: one of bids,
+    whose first entry is the highest bid, and one of each bidder's best bid,
+    which gives the rank of a bidder. Placing a bid and reading the highest
+    bid or a rank are O(log n) and don't touch the database, which is only
+    updated with the highest bid when the round is closed.
+    """
+
+    def __init__(self, client, equb_id, round):
+        self.client = client
+        self.equb_id = equb_id
+        self.round = round
+        self.bids_key = f'auction:{equb_id}:{round}:bids'
+        self.bidders_key = f'auction:{equb_id}:{round}:bidders'
+        self.sequence_key = f'auction:{equb_id}:{round}:sequence'
+
+    @classmethod
+    def for_round(cls, equb_id, round):
+        """
+        returns the book of the round, or None if auction books are disabled
+        """
+        client = auction_client()
+        if client is None:
+            return None
+        return cls(client, equb_id, round)
+
+    @staticmethod
+    def parse(entries):
+        """
+        returns the LiveBid of the first (member, score) entry, if there is one
+        """
+        if not entries:
+            return None
+        member, score = entries[0]
+        bid_id, user_id = (int(id) for id in member.decode().split(':'))
+        amount = decimal.Decimal(int(score) >> SEQUENCE_BITS) / 1000
+        return LiveBid(bid_id, user_id, amount)
+
+    def place(self, bid, timeout):
+        """
+        adds a saved bid to the book and returns its BidPlacement. The highest bid
+        is read before and after adding the bid in one transaction.
+        """
+        with book_operation():
+            sequence = self.client.incr(self.sequence_key)
+            score = (int(bid.amount * 1000) << SEQUENCE_BITS) + (1 << SEQUENCE_BITS) - 1 - sequence
+            member = f'{bid.id}:{bid.user_id}'
+            pipeline = self.client.pipeline(transaction=True)
+            pipeline.zrevrange(self.bids_key, 0, 0, withscores=True)
+            pipeline.zadd(self.bids_key, {member: score})
+            pipeline.zadd(self.bidders_key, {bid.user_id: score}, gt=True)
+            pipeline.zrevrange(self.bids_key, 0, 0, withscores=True)
+            for key in (self.bids_key, self.bidders_key, self.sequence_key):
+                pipeline.expire(key, timeout)
+            previous, _, _, current = pipeline.execute()[:4]
+
+        previous = self.parse(previous)
+        previous_highest_bid = Bid.objects.filter(pk=previous.bid_id).first() if previous else None
+        return BidPlacement(is_highest=self.parse(current).bid_id == bid.id, previous_highest_bid=previous_highest_bid)
+
+    def highest(self):
+        with book_operation():
+            return self.parse(self.client.zrevrange(self.bids_key, 0, 0, withscores=True))
+
+    def rank(self, user_id):
+        """
+        returns the rank of the user's best bid, starting from 1, and the number of bidders
+        """
+        with book_operation():
+            pipeline = self.client.pipeline(transaction=True)
+            pipeline.zrevrank(self.bidders_key, user_id)
+            pipeline.zcard(self.bidders_key)
+            rank, bidders = pipeline.execute()
+        return (rank + 1 if rank is not None else None), bidders
+
+    def flush(self):
+        """
+        places the higher of the book's highest bid and the round's highest saved
+        bid in the database and removes the book once the current transaction
+        commits. The saved bids cover a book that was lost or can't be read.
+        """
+        bid = Bid.objects.filter(equb_id=self.equb_id, round=self.round).order_by('-amount', 'date', 'id').first()
+        try:
+            highest = self.highest()
+        except AuctionBookUnavailable:
+            logging.exception(f'could not read the auction book of equb {self.equb_id} round {self.round}')
+            highest = None
+        if highest and (bid is None or highest.amount > bid.amount):
+            bid = Bid.objects.filter(pk=highest.bid_id).first() or bid
+        if bid:
+            bid.place()
+        transaction.on_commit(self.clear)
+
+    def clear(self):
+        try:
+            with book_operation():
+                self.client.delete(self.bids_key, self.bidders_key, self.sequence_key)
+        except AuctionBookUnavailable:
+            logging.exception(f'could not clear the auction book of equb {self.equb_id} round {self.round}')
+
+
+def live_highest_bids(rounds):
+    """
+    returns the LiveBid of every {equb_id: round} that has one in its book,
+    reading all the books in one round trip
+    """
+    client = auction_client()
+    if client is None or not rounds:
+        return {}
+    books = [AuctionBook(client, equb_id, round) for equb_id, round in rounds.items()]
+    try:
+        with book_operation():
+            pipeline = client.pipeline(transaction=False)
+            for book in books:
+                pipeline.zrevrange(book.bids_key, 0, 0, withscores=True)
+            results = pipeline.execute()
+    except AuctionBookUnavailable:
+        logging.exception('could not read the auction books')
+        return {}
+    live_bids = {book.equb_id: AuctionBook.parse(entries) for book, entries in zip(books, results)}
+    return {equb_id: live_bid for equb_id, live_bid in live_bids.items() if live_bid}
+
+
+def bid_rank(equb, round, user):
+    """
+    returns the rank of user's best bid in the round and the number of bidders,
+    from the round's auction book or from the database if it is unavailable
+    """
+    book = AuctionBook.for_round(equb.id, round)
+    if book is not None:
+        try:
+            return book.rank(user.id)
+        except AuctionBookUnavailable:
+            logging.exception(f'could not read the auction book of equb {equb.id} round {round}')
+
+    best_bids = list(Bid.objects.filter(equb=equb, round=round).values('user').annotate(best=Max('amount')))
+    user_best = next((best_bid['best'] for best_bid in best_bids if best_bid['user'] == user.id), None)
+    if user_best is None:
+        return None, len(best_bids)
+    return len([best_bid for best_bid in best_bids if best_bid['best'] > user_best]) + 1, len(best_bids)
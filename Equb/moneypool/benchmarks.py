@@ -0,0 +1,241 @@
+"""
+Query-count and latency benchmarks of the REST API.
+
+Seeds a realistic data set, requests every router endpoint as a member of
+many equbs with cold caches and fails when an endpoint makes more queries
+or is slower at the 95th percentile than its budget. They are not part of
+the regular test suite and are run against the PostgreSQL database of the
+settings, e.g. a local server with
+
+    POSTGRES_DB=equb POSTGRES_USER=postgres POSTGRES_HOST=localhost python manage.py test moneypool.benchmarks
+
+Other backends cannot apply the trigram migrations and are skipped.
+BENCHMARK_SCALE multiplies the seeded data, BENCHMARK_ITERATIONS sets the
+requests made to each endpoint and BENCHMARK_LATENCY_FACTOR loosens the
+latency budgets on slower machines.
+"""
+from django.core.cache import caches
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from decimal import Decimal
+import gc
+import os
+import random
+import statistics
+import time
+import unittest
+
+from .models import *
+
+SCALE = float(os.getenv('BENCHMARK_SCALE', 1))
+ITERATIONS = int(os.getenv('BENCHMARK_ITERATIONS', 20))
+LATENCY_FACTOR = float(os.getenv('BENCHMARK_LATENCY_FACTOR', 1))
+
+USER_COUNT = int(2000 * SCALE)
+EQUB_COUNT = int(200 * SCALE)
+
+# (maximum queries, maximum p95 latency in milliseconds) of each endpoint, measured
+# at the default BENCHMARK_SCALE and BENCHMARK_ITERATIONS against a local PostgreSQL 18
+# server through the POSTGRES_* settings without REDIS_URL. The query counts are the
+# measured ones and the latencies about twice the highest p95 of four runs and at
+# least 100ms, to be loosened with BENCHMARK_LATENCY_FACTOR on slower machines.
+# Lists are measured at their first page.
+BUDGETS = {
+    'user-list': (1, 100),
+    'user-detail': (4, 100),
+    'user-current-user': (3, 100),
+    'user-user-profile': (5, 130),
+    'user-friends': (1, 100),
+    'user-search': (1, 100),
+    'equb-list': (7, 300),
+    'equb-detail': (7, 120),
+    'equb-active-equbs': (7, 290),
+    'equb-pending-equbs': (7, 240),
+    'equb-invited-equbs': (7, 190),
+    'equb-past-equbs': (7, 320),
+    'equb-recommended-equbs': (7, 460),
+    'equb-by-user': (8, 100),
+    'equb-dashboard': (8, 160),
+    'bid-list': (1, 100),
+    'bid-create': (12, 100),
+    'bid-rank': (3, 100),
+    'equbjoinrequest-list': (1, 100),
+    'equbinviterequest-list': (7, 260),
+    'equbinviterequest-received': (7, 320),
+    'equbinviterequest-by-equb': (1, 100),
+    'friendrequest-list': (1, 110),
+    'friendrequest-received': (1, 100),
+    'friendrequest-sent': (1, 120),
+    'paymentconfirmationrequest-list': (1, 110),
+    'paymentconfirmationrequest-get-by-equb-and-round': (1, 100),
+    'paymentmethod-list': (1, 100),
+    'paymentmethod-services': (0, 100),
+}
+
+
+def seed():
+    """
+    creates users with friends, equbs at every stage with bids and payment
+    confirmations, and requests, and returns the user the endpoints are requested as
+    """
+    rng = random.Random(0)
+    user = User.objects.create_user(username='benchmark_user', first_name='Benchmark', last_name='User')
+    users = User.objects.bulk_create([
+        User(username=f'user_{idx}', first_name=f'First{idx}', last_name=f'Last{idx}', email=f'user_{idx}@example.com')
+        for idx in range(USER_COUNT)
+    ])
+    PaymentMethod.objects.bulk_create([PaymentMethod(user=other, service=ServiceChoices.CASH) for other in users])
+
+    friends = users[:50]
+    user.friends.add(*friends)
+    for friend in friends[:10]:
+        friend.friends.add(*rng.sample(users[50:], 10))
+
+    for idx in range(EQUB_COUNT):
+        creator = friends[idx % len(friends)]
+        max_members = rng.randint(5, 10)
+        equb = Equb.objects.create(
+            name=f'equb_{idx}', amount=100 * rng.randint(1, 10), max_members=max_members,
+            creator=creator, is_private=idx % 5 == 0,
+        )
+        stage = idx % 10
+        others = [other for other in rng.sample(users, max_members) if other != creator]
+        members = ([user] if idx % 3 == 0 else []) + others
+        if stage < 4:  # open to new members
+            equb.members.add(*members[:max_members // 2])
+            if idx % 3 != 0:
+                EqubInviteRequest.objects.create(sender=creator, receiver=user, equb=equb)
+            continue
+
+        equb.members.add(*members[:max_members - 1])
+        equb = Equb.objects.get(pk=equb.pk)
+        bidders = list(equb.members.all())
+        for round_bid in range(3):
+            for bidder in bidders[:4]:
+                Bid.objects.create(
+                    equb=equb, user=bidder, round=1, amount=Decimal(rng.randint(1, 500)) / 1000 + Decimal(round_bid) / 10
+                )
+        if stage < 7:  # active and bidding
+            continue
+
+        winner = equb.balance_manager.select_winner()
+        if stage < 9:  # in the payment stage
+            for payer in bidders:
+                if payer != winner:
+                    PaymentConfirmationRequest.objects.create(
+                        sender=payer, receiver=winner, equb=equb, round=1,
+                        amount=equb.balance_manager.calculate_losers_deductions(payer, 1),
+                        payment_method=payer.selected_payment_methods.first(),
+                    )
+            continue
+        Equb.objects.filter(pk=equb.pk).update(is_in_payment_stage=False, is_completed=True)  # completed
+
+    for other in users[100:120]:
+        FriendRequest.objects.create(sender=other, receiver=user)
+    for other in users[120:140]:
+        FriendRequest.objects.create(sender=user, receiver=other)
+    for equb in Equb.objects.filter(is_active=False).exclude(members=user)[:20]:
+        EqubJoinRequest.objects.create(sender=user, receiver=equb.creator, equb=equb)
+    return user
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'the benchmarks run against PostgreSQL')
+class APIBenchmark(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed()
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+
+    def endpoints(self):
+        """
+        returns the (method, url, data) requested for every endpoint
+        """
+        user = self.user
+        equb = user.joined_equbs.filter(is_active=True, is_in_payment_stage=False).first()
+        paid_equb = user.joined_equbs.filter(is_in_payment_stage=True).first()
+        bid = Bid.objects.filter(equb=equb).first()
+        detail = lambda name, instance: reverse(f'{name}-detail', kwargs={'pk': instance.pk})
+        amounts = iter(Decimal(900 + idx) / 1000 for idx in range(ITERATIONS + 1))
+        return {
+            'user-list': ('get', reverse('user-list'), None),
+            'user-detail': ('get', detail('user', user), None),
+            'user-current-user': ('get', reverse('user-current-user'), None),
+            'user-user-profile': ('get', reverse('user-user-profile'), {'id': user.id}),
+            'user-friends': ('get', reverse('user-friends'), None),
+            'user-search': ('get', reverse('user-search'), {'name': 'user_1'}),
+            'equb-list': ('get', reverse('equb-list'), None),
+            'equb-detail': ('get', detail('equb', equb), None),
+            'equb-active-equbs': ('get', reverse('equb-active-equbs'), None),
+            'equb-pending-equbs': ('get', reverse('equb-pending-equbs'), None),
+            'equb-invited-equbs': ('get', reverse('equb-invited-equbs'), None),
+            'equb-past-equbs': ('get', reverse('equb-past-equbs'), None),
+            'equb-recommended-equbs': ('get', reverse('equb-recommended-equbs'), None),
+            'equb-by-user': ('get', reverse('equb-by-user'), {'user': equb.creator_id}),
+            'equb-dashboard': ('get', reverse('equb-dashboard'), None),
+            'bid-list': ('get', reverse('bid-list'), None),
+            'bid-create': ('post', reverse('bid-list'), lambda: {
+                'equb': 'http://testserver' + detail('equb', equb), 'amount': next(amounts), 'round': 1
+            }),
+            'bid-rank': ('get', reverse('bid-rank'), {'equb': bid.equb_id}),
+            'equbjoinrequest-list': ('get', reverse('equbjoinrequest-list'), None),
+            'equbinviterequest-list': ('get', reverse('equbinviterequest-list'), None),
+            'equbinviterequest-received': ('get', reverse('equbinviterequest-received'), None),
+            'equbinviterequest-by-equb': ('get', reverse('equbinviterequest-by-equb'), {'equb': equb.id}),
+            'friendrequest-list': ('get', reverse('friendrequest-list'), None),
+            'friendrequest-received': ('get', reverse('friendrequest-received'), None),
+            'friendrequest-sent': ('get', reverse('friendrequest-sent'), None),
+            'paymentconfirmationrequest-list': ('get', reverse('paymentconfirmationrequest-list'), None),
+            'paymentconfirmationrequest-get-by-equb-and-round': (
+                'get', reverse('paymentconfirmationrequest-get-by-equb-and-round'), {'equb': paid_equb.id, 'round': 1}
+            ),
+            'paymentmethod-list': ('get', reverse('paymentmethod-list'), None),
+            'paymentmethod-services': ('get', reverse('paymentmethod-services'), None),
+        }
+
+    def measure(self, method, url, data):
+        """
+        requests the endpoint ITERATIONS times with cold caches and returns
+        the most queries made by a request and the latencies in milliseconds
+        """
+        queries = 0
+        latencies = []
+        getattr(self.client, method)(url, data() if callable(data) else data)  # warm up
+        for iteration in range(ITERATIONS):
+            for cache in caches.all():
+                cache.clear()
+            connection.queries_log.clear()  # the log is bounded, which would hide the queries of a request
+            gc.collect()
+            gc.disable()  # so that collecting the seeded objects isn't timed as part of a request
+            try:
+                with CaptureQueriesContext(connection) as context:
+                    start = time.perf_counter()
+                    response = getattr(self.client, method)(url, data() if callable(data) else data)
+                    latencies.append((time.perf_counter() - start) * 1000)
+            finally:
+                gc.enable()
+            self.assertLess(response.status_code, 400, f'{method} {url} returned {response.status_code}')
+            queries = max(queries, len(context.captured_queries))
+        return queries, latencies
+
+    def test_endpoints(self):
+        results = {}
+        for name, (method, url, data) in self.endpoints().items():
+            queries, latencies = self.measure(method, url, data)
+            p95 = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0]
+            results[name] = (queries, statistics.median(latencies), p95)
+
+        print(f"\n{'endpoint':<50} {'queries':>8} {'p50 ms':>9} {'p95 ms':>9}")
+        for name, (queries, p50, p95) in results.items():
+            print(f'{name:<50} {queries:>8} {p50:>9.1f} {p95:>9.1f}')
+
+        for name, (queries, p50, p95) in results.items():
+            max_queries, max_p95 = BUDGETS[name]
+            with self.subTest(name):
+                self.assertLessEqual(queries, max_queries, f'{name} made {queries} queries')
+                self.assertLessEqual(p95, max_p95 * LATENCY_FACTOR, f'{name} took {p95:.1f}ms at p95')
@@ -0,0 +1,144 @@
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.db import transaction
+
+import hashlib
+import time
+import uuid
+
+from .models import BalanceManager
+
+# serialized equbs are also dropped after this many seconds so that details
+# of members that are not tracked by the equb version do not stay stale
+EQUB_CACHE_TIMEOUT = 300
+
+
+def equb_cache():
+    return caches['equbs']
+
+
+def is_cache_shared():
+    """
+    tells whether the equb cache is shared by all processes, which versions rely on
+    to see the invalidations of every process. It isn't when redis is unavailable.
+    """
+    return not isinstance(equb_cache(), DummyCache)
+
+
+def version_key(kind, id):
+    return f'{kind}:{id}:version'
+
+
+def new_version():
+    """
+    returns a unique version starting with the time it was made at in nanoseconds
+    """
+    return f'{time.time_ns()}.{uuid.uuid4().hex[:8]}'
+
+
+def version_timestamp(version):
+    """
+    returns the unix time in seconds at which version was made, or None for versions without one
+    """
+    made, separator, _ = version.partition('.')
+    return int(made) // 10**9 if separator and made.isdigit() else None
+
+
+def get_versions(kind, ids):
+    """
+    returns the current version of every equb or user id, creating the versions that are missing
+    """
+    cache = equb_cache()
+    keys = {version_key(kind, id): id for id in ids}
+    versions = cache.get_many(keys.keys())
+    missing = {key: new_version() for key in keys if key not in versions}
+    if missing:
+        cache.set_many(missing, timeout=None)
+        versions.update(missing)
+    return {id: versions[key] for key, id in keys.items()}
+
+
+def invalidate(kind, id):
+    """
+    moves the equb or user to a new version so every representation cached
+    under the old version is ignored. The version is moved again once the
+    current transaction commits, in case the old state was cached in the meantime.
+    """
+    def move():
+        equb_cache().set(version_key(kind, id), new_version(), timeout=None)
+
+    move()
+    transaction.on_commit(move)
+
+
+def get_equb_versions(equb_ids):
+    return get_versions('equb', equb_ids)
+
+
+def invalidate_equb(equb_id):
+    invalidate('equb', equb_id)
+
+
+def invalidate_user(user_id):
+    invalidate('user', user_id)
+
+
+# query parameters that change the representation of an equb
+REPRESENTATION_PARAMS = ['expand', 'fields', 'omit']
+
+
+def representation_shape(request):
+    return '&'.join(f'{param}={request.GET.get(param, "")}' for param in REPRESENTATION_PARAMS)
+
+
+def cached_equb_representations(equbs, request, serialize, shape):
+    """
+    returns the representations of equbs as seen by the requesting user, in the
+    shape described by shape, which must tell apart every set of serialized fields.
+    serialize(equbs) is only called for the equbs that are not cached and must
+    return a (representation, next_round_time) pair for each of them.
+
+    The countdown is cached as the time of the next round and recomputed on
+    every read, since it changes without the equb changing.
+    """
+    if not is_cache_shared():
+        return [representation for representation, next_round_time in serialize(equbs)]
+
+    cache = equb_cache()
+    versions = get_equb_versions([equb.id for equb in equbs])
+    shape = hashlib.md5(shape.encode()).hexdigest()  # keeps keys short whatever the number of fields
+    keys = {
+        equb.id: f'equb:{equb.id}:{versions[equb.id]}:{request.user.id}:{request.get_host()}:{shape}'
+        for equb in equbs
+    }
+    cached = cache.get_many(keys.values())
+
+    missing = [equb for equb in equbs if keys[equb.id] not in cached]
+    if missing:
+        new_entries = {
+            keys[equb.id]: entry for equb, entry in zip(missing, serialize(missing))
+        }
+        cache.set_many(new_entries, timeout=EQUB_CACHE_TIMEOUT)
+        cached.update(new_entries)
+
+    data = []
+    for equb in equbs:
+        representation, next_round_time = cached[keys[equb.id]]
+        if 'time_left_till_next_round' in representation:
+            representation['time_left_till_next_round'] = BalanceManager.time_left_until(next_round_time)
+        data.append(representation)
+    return data
+
+
+def representation_etag(kind, version, request, *validators):
+    """
+    returns the weak ETag of a resource at version and any further validators, as
+    seen by the requesting user in the shape and media type chosen by the request.
+    It is weak since countdowns in the representation change without the resource changing.
+    """
+    validator = ':'.join([
+        kind, version, str(request.user.id), request.get_host(),
+        representation_shape(request), getattr(request, 'accepted_media_type', ''),
+        *(str(validator) for validator in validators),
+    ])
+    return f'W/"{hashlib.md5(validator.encode()).hexdigest()}"'
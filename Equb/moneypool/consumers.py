@@ -0,0 +1,79 @@
+from asgiref.sync import async_to_sync
+from channels.generic.websocket import JsonWebsocketConsumer
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+import logging
+
+from .models import BalanceManager, EqubMembership
+
+
+def equb_group_name(equb_id):
+    return f'equb_{equb_id}'
+
+
+def broadcast_equb_event(equb_id, event, data=None):
+    """
+    sends an event to every member subscribed to the equb once the current
+    transaction commits. Failing to broadcast never fails the change itself.
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+
+    def send():
+        try:
+            async_to_sync(channel_layer.group_send)(
+                equb_group_name(equb_id), {'type': 'equb.event', 'event': event, 'data': data or {}}
+            )
+        except Exception:
+            logging.exception(f'could not broadcast {event} for equb {equb_id}')
+
+    transaction.on_commit(send)
+
+
+class EqubConsumer(JsonWebsocketConsumer):
+    """
+    Pushes the events of one equb (new highest bid, round winner, payment
+    confirmation, new member and countdown sync) to its connected members.
+    Clients can send {"type": "countdown.sync"} to receive the countdown again.
+    """
+
+    def connect(self):
+        self.equb_id = self.scope['url_route']['kwargs']['equb_id']
+        self.group_name = None
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            self.close()
+            return
+        if not EqubMembership.objects.filter(equb_id=self.equb_id, member=user).exists():
+            self.close()
+            return
+        self.group_name = equb_group_name(self.equb_id)
+        async_to_sync(self.channel_layer.group_add)(self.group_name, self.channel_name)
+        self.accept()
+        self.send_countdown()
+
+    def disconnect(self, code):
+        if self.group_name:
+            async_to_sync(self.channel_layer.group_discard)(self.group_name, self.channel_name)
+
+    def receive_json(self, content, **kwargs):
+        if content.get('type') == 'countdown.sync':
+            self.send_countdown()
+
+    def equb_event(self, message):
+        self.send_json({'type': message['event'], 'equb': self.equb_id, 'data': message['data']})
+
+    def send_countdown(self):
+        balance_manager = BalanceManager.objects.select_related('equb').get(equb_id=self.equb_id)
+        self.send_json({'type': 'countdown.sync', 'equb': self.equb_id, 'data': countdown_data(balance_manager)})
+
+
+def countdown_data(balance_manager):
+    next_round_time = balance_manager.next_round_time()
+    return {
+        'round': balance_manager.current_round(),
+        'next_round_time': next_round_time.isoformat() if next_round_time else None,
+        'time_left_till_next_round': balance_manager.time_left_till_next_round(),
+    }
@@ -0,0 +1,52 @@
+from django.db.models import Q, F, Count, IntegerField, DateTimeField, ExpressionWrapper, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import *
+from .recommendations import ranked_recommendations, recommended_equbs
+
+# the number of equbs shown in each category of the dashboard
+DASHBOARD_CARD_LIMIT = 10
+
+
+def equb_cards(queryset):
+    """
+    annotates equbs with what their cards show, so that cards are read
+    without loading members, balance managers or rounds
+    """
+    member_count = EqubMembership.objects.filter(equb=OuterRef('pk')).values('equb').annotate(
+        count=Count('id')
+    ).values('count')
+    return queryset.annotate(
+        member_count=Coalesce(Subquery(member_count, output_field=IntegerField()), 0),
+        finished_rounds=Coalesce(F('balance_manager__finished_rounds'), 0),
+        next_round_time=ExpressionWrapper(
+            F('balance_manager__current_round_start_date') + F('cycle'), output_field=DateTimeField()
+        ),
+    )
+
+
+def dashboard(user, limit=DASHBOARD_CARD_LIMIT):
+    """
+    returns the number of equbs in each category of user's home screen and
+    the cards of the first limit equbs of each, in a fixed number of queries
+    """
+    joined = user.joined_equbs.all()
+    categories = {
+        'active': joined.filter(is_active=True, is_completed=False),
+        'pending': joined.filter(is_active=False, is_completed=False),
+        'invited': Equb.objects.filter(
+            accesses__user=user, accesses__is_invited=True, accesses__is_member=False, is_active=False
+        ),
+        'past': joined.filter(is_completed=True),
+    }
+    counts = joined.aggregate(
+        active=Count('id', filter=Q(is_active=True, is_completed=False)),
+        pending=Count('id', filter=Q(is_active=False, is_completed=False)),
+        past=Count('id', filter=Q(is_completed=True)),
+    )
+    counts['invited'] = categories['invited'].count()
+    counts['recommended'] = recommended_equbs(user).count()
+    categories['recommended'] = ranked_recommendations(user)
+
+    cards = {category: list(equb_cards(queryset)[:limit]) for category, queryset in categories.items()}
+    return {category: {'count': counts[category], 'equbs': cards[category]} for category in cards}
@@ -0,0 +1,44 @@
+from django.conf import settings
+from django.db.models import Q, F, Count
+from django.utils import timezone
+
+from .models import Equb, EqubJoinRequest, EqubInviteRequest, FriendRequest
+
+
+def closed_equbs():
+    """
+    returns the equbs that can't take new members because they are full, active or completed
+    """
+    return Equb.objects.alias(member_count=Count('members')).filter(
+        Q(is_active=True) | Q(is_completed=True) | Q(member_count__gte=F('max_members'))
+    )
+
+
+def stale_requests(now=None):
+    """
+    returns the pending requests that should be expired, keyed by request model: requests
+    and invitations to join closed equbs and friend requests older than FRIEND_REQUEST_TTL
+    """
+    now = now or timezone.now()
+    equb_ids = closed_equbs().values('id')
+    return {
+        EqubJoinRequest: EqubJoinRequest.pending().filter(equb__in=equb_ids),
+        EqubInviteRequest: EqubInviteRequest.pending().filter(equb__in=equb_ids),
+        FriendRequest: FriendRequest.pending().filter(creation_date__lt=now - settings.FRIEND_REQUEST_TTL),
+    }
+
+
+def expire_stale_requests(batch_size=5000, now=None):
+    """
+    expires the stale requests with bulk updates of at most batch_size rows, to keep
+    each update short, and returns the number of expired requests of each model
+    """
+    expired = {}
+    for model, queryset in stale_requests(now).items():
+        expired[model] = 0
+        while True:
+            ids = list(queryset.values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            expired[model] += model.expire_pending(pk__in=ids)
+    return expired
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from moneypool.expiry import expire_stale_requests
+
+
+class Command(BaseCommand):
+    help = (
+        'expires pending requests and invitations to join full, active or completed equbs '
+        'and pending friend requests older than FRIEND_REQUEST_TTL; meant to be run periodically'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        expired = expire_stale_requests(batch_size=options['batch_size'])
+        for model, count in expired.items():
+            self.stdout.write(self.style.SUCCESS(f'expired {count} {model._meta.verbose_name} rows'))
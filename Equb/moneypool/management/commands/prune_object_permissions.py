@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import Permission
+from django.db import transaction
+
+from guardian.models import GroupObjectPermission, UserObjectPermission
+
+from moneypool.models import User
+from moneypool.permissions import OWNER_FIELDS
+
+
+class Command(BaseCommand):
+    help = (
+        'deletes the per-object permission rows and the per-user change permissions '
+        'that were stored for moneypool objects before ownership based permissions'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        dry_run = options['dry_run']
+
+        for model in (UserObjectPermission, GroupObjectPermission):
+            queryset = model.objects.filter(content_type__app_label='moneypool')
+            self.prune(queryset, model.__name__, batch_size, dry_run)
+
+        change_permissions = Permission.objects.filter(
+            content_type__app_label='moneypool',
+            codename__in=[f'change_{model_name}' for model_name in OWNER_FIELDS],
+        )
+        user_permissions = User.user_permissions.through.objects.filter(permission__in=change_permissions)
+        self.prune(user_permissions, 'user change permission', batch_size, dry_run)
+
+    def prune(self, queryset, label, batch_size, dry_run):
+        """
+        deletes the rows of queryset in batches to keep each transaction short
+        """
+        if dry_run:
+            self.stdout.write(f'{queryset.count()} {label} rows would be deleted')
+            return
+        deleted = 0
+        while True:
+            ids = list(queryset.values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            with transaction.atomic():
+                count, _ = queryset.model.objects.filter(pk__in=ids).delete()
+            deleted += count
+        self.stdout.write(self.style.SUCCESS(f'deleted {deleted} {label} rows'))
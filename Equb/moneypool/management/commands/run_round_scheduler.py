@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from moneypool.scheduler import RoundScheduler, run_workers
+
+
+class Command(BaseCommand):
+    help = 'selects the winners of equb rounds as their deadlines become due'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument(
+            '--poll-interval', type=float, default=5.0,
+            help='seconds between checks for new or moved deadlines'
+        )
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='number of processes, each handling the equbs whose id modulo workers is its shard'
+        )
+        parser.add_argument('--once', action='store_true', help='process the due deadlines and exit')
+
+    def handle(self, *args, **options):
+        scheduler_options = {'batch_size': options['batch_size'], 'poll_interval': options['poll_interval']}
+        if options['once']:
+            RoundScheduler(**scheduler_options).run_once()
+            return
+        self.stdout.write(self.style.SUCCESS(f"round scheduler started with {options['workers']} worker(s)"))
+        try:
+            if options['workers'] > 1:
+                run_workers(options['workers'], **scheduler_options)
+            else:
+                RoundScheduler(**scheduler_options).run()
+        except KeyboardInterrupt:
+            self.stdout.write('round scheduler stopped')
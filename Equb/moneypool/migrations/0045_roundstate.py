@@ -0,0 +1,81 @@
+# Generated by Django 4.2.16 on 2026-10-16 20:52
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import decimal
+
+
+def backfill_round_states(apps, schema_editor):
+    """
+    creates the round state of every round that already has a HighestBid
+    """
+    HighestBid = apps.get_model('moneypool', 'HighestBid')
+    RoundState = apps.get_model('moneypool', 'RoundState')
+    BalanceManager = apps.get_model('moneypool', 'BalanceManager')
+    PaymentConfirmationRequest = apps.get_model('moneypool', 'PaymentConfirmationRequest')
+
+    winners = {}
+    for balance_manager in BalanceManager.objects.prefetch_related('wins'):
+        for win in balance_manager.wins.all():
+            winners[(balance_manager.equb_id, win.round)] = win.user_id
+
+    payer_ids = {}
+    for request in PaymentConfirmationRequest.objects.all():
+        status = 'rejected' if request.is_rejected else 'confirmed' if request.is_accepted else 'unconfirmed'
+        payers = payer_ids.setdefault((request.equb_id, request.round), {'confirmed': [], 'unconfirmed': [], 'rejected': []})
+        payers[status].append(request.sender_id)
+
+    round_states = []
+    for highest_bid in HighestBid.objects.select_related('equb', 'bid'):
+        equb = highest_bid.equb
+        bid_amount = highest_bid.bid.amount if highest_bid.bid else 0
+        deductible_portion = equb.amount * decimal.Decimal(1 - 1 / equb.max_members)
+        award = equb.amount / equb.max_members + deductible_portion * decimal.Decimal(1 - bid_amount)
+        key = (equb.id, highest_bid.round)
+        payers = payer_ids.get(key, {'confirmed': [], 'unconfirmed': [], 'rejected': []})
+        round_states.append(RoundState(
+            equb=equb, round=highest_bid.round, winner_id=winners.get(key),
+            highest_bidder_id=highest_bid.bid.user_id if highest_bid.bid else None,
+            highest_bid_amount=bid_amount, award=round(award, 2),
+            confirmed_count=len(payers['confirmed']), confirmed_payer_ids=payers['confirmed'],
+            unconfirmed_count=len(payers['unconfirmed']), unconfirmed_payer_ids=payers['unconfirmed'],
+            rejected_count=len(payers['rejected']), rejected_payer_ids=payers['rejected'],
+        ))
+    RoundState.objects.bulk_create(round_states, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('moneypool', '0044_user_profile_picture'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoundState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('round', models.PositiveIntegerField()),
+                ('highest_bid_amount', models.DecimalField(decimal_places=3, default=0, max_digits=5)),
+                ('award', models.DecimalField(decimal_places=2, default=0, max_digits=13)),
+                ('confirmed_count', models.PositiveIntegerField(default=0)),
+                ('unconfirmed_count', models.PositiveIntegerField(default=0)),
+                ('rejected_count', models.PositiveIntegerField(default=0)),
+                ('confirmed_payer_ids', models.JSONField(blank=True, default=list)),
+                ('unconfirmed_payer_ids', models.JSONField(blank=True, default=list)),
+                ('rejected_payer_ids', models.JSONField(blank=True, default=list)),
+                ('equb', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='round_states', to='moneypool.equb')),
+                ('highest_bidder', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('winner', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-round'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='roundstate',
+            constraint=models.UniqueConstraint(fields=('equb', 'round'), name='unique_equb_round_state'),
+        ),
+        migrations.RunPython(backfill_round_states, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.16 on 2026-10-16 20:54
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('moneypool', '0045_roundstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('round', models.PositiveIntegerField()),
+                ('kind', models.CharField(choices=[('credit', 'Credit'), ('debit', 'Debit')], max_length=6)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=13)),
+                ('date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('equb', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger_entries', to='moneypool.equb')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-date'],
+            },
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.16 on 2026-10-16 21:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_round_deadlines(apps, schema_editor):
+    """
+    schedules the current round of every active equb that is waiting for a winner
+    """
+    BalanceManager = apps.get_model('moneypool', 'BalanceManager')
+    RoundDeadline = apps.get_model('moneypool', 'RoundDeadline')
+
+    balance_managers = BalanceManager.objects.select_related('equb').filter(
+        equb__is_active=True, equb__is_completed=False, equb__is_in_payment_stage=False,
+        current_round_start_date__isnull=False,
+    )
+    RoundDeadline.objects.bulk_create([
+        RoundDeadline(
+            equb=balance_manager.equb,
+            round=min(balance_manager.finished_rounds + 1, balance_manager.equb.max_members),
+            due_at=balance_manager.current_round_start_date + balance_manager.equb.cycle,
+        )
+        for balance_manager in balance_managers
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('moneypool', '0046_ledgerentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoundDeadline',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('round', models.PositiveIntegerField()),
+                ('due_at', models.DateTimeField(db_index=True)),
+                ('updated_at', models.DateTimeField(auto_now=True, db_index=True)),
+                ('equb', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='round_deadline', to='moneypool.equb')),
+            ],
+            options={
+                'ordering': ['due_at'],
+            },
+        ),
+        migrations.RunPython(backfill_round_deadlines, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 4.2.16 on 2026-10-16 22:20
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+import collections
+import itertools
+
+
+def backfill_mutual_friendships(apps, schema_editor):
+    """
+    counts the friends that every pair of users has in common
+    """
+    Friendship = apps.get_model('moneypool', 'Friendship')
+    MutualFriendship = apps.get_model('moneypool', 'MutualFriendship')
+
+    friends = collections.defaultdict(set)
+    for user_id, friend_id in Friendship.objects.values_list('friend_id', 'user_id'):
+        friends[user_id].add(friend_id)
+    mutual_friends = collections.Counter()
+    for user_friends in friends.values():
+        for user_id, other_id in itertools.permutations(user_friends, 2):
+            mutual_friends[(user_id, other_id)] += 1
+    MutualFriendship.objects.bulk_create([
+        MutualFriendship(user_id=user_id, other_id=other_id, mutual_friends=count)
+        for (user_id, other_id), count in mutual_friends.items()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('moneypool', '0048_user_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MutualFriendship',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mutual_friends', models.PositiveIntegerField(default=0)),
+                ('other', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='mutualfriendship',
+            constraint=models.UniqueConstraint(fields=('user', 'other'), name='unique_mutual_friendship'),
+        ),
+        migrations.RunPython(backfill_mutual_friendships, migrations.RunPython.noop),
+    ]
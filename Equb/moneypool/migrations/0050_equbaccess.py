@@ -0,0 +1,46 @@
+# Generated by Django 4.2.16 on 2026-10-16 22:21
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_equb_accesses(apps, schema_editor):
+    """
+    gives access to the members of every equb and to everyone invited to it
+    """
+    EqubMembership = apps.get_model('moneypool', 'EqubMembership')
+    EqubInviteRequest = apps.get_model('moneypool', 'EqubInviteRequest')
+    EqubAccess = apps.get_model('moneypool', 'EqubAccess')
+
+    accesses = {}
+    for user_id, equb_id in EqubMembership.objects.values_list('member_id', 'equb_id'):
+        accesses.setdefault((user_id, equb_id), EqubAccess(user_id=user_id, equb_id=equb_id)).is_member = True
+    for user_id, equb_id in EqubInviteRequest.objects.values_list('receiver_id', 'equb_id'):
+        accesses.setdefault((user_id, equb_id), EqubAccess(user_id=user_id, equb_id=equb_id)).is_invited = True
+    EqubAccess.objects.bulk_create(accesses.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('moneypool', '0049_mutualfriendship'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EqubAccess',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_member', models.BooleanField(default=False)),
+                ('is_invited', models.BooleanField(default=False)),
+                ('equb', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='accesses', to='moneypool.equb')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='equb_accesses', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='equbaccess',
+            constraint=models.UniqueConstraint(fields=('user', 'equb'), name='unique_user_equb_access'),
+        ),
+        migrations.RunPython(backfill_equb_accesses, migrations.RunPython.noop),
+    ]
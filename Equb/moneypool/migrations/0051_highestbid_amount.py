@@ -0,0 +1,31 @@
+# Generated by Django 4.2.16 on 2026-10-16 22:27
+
+from django.db import migrations, models
+
+
+def backfill_highest_bid_amounts(apps, schema_editor):
+    """
+    copies the amount of every highest bid onto its HighestBid
+    """
+    HighestBid = apps.get_model('moneypool', 'HighestBid')
+    Bid = apps.get_model('moneypool', 'Bid')
+
+    HighestBid.objects.filter(bid__isnull=False).update(
+        amount=models.Subquery(Bid.objects.filter(pk=models.OuterRef('bid_id')).values('amount')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('moneypool', '0050_equbaccess'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='highestbid',
+            name='amount',
+            field=models.DecimalField(decimal_places=3, default=0, max_digits=5),
+        ),
+        migrations.RunPython(backfill_highest_bid_amounts, migrations.RunPython.noop),
+    ]
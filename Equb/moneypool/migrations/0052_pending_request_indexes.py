@@ -0,0 +1,30 @@
+# Generated by Django 4.2.16 on 2026-10-16 22:38
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+PENDING_REQUEST = models.Q(('is_accepted', False), ('is_expired', False), ('is_rejected', False))
+
+
+class Migration(migrations.Migration):
+    # indexes are built concurrently, which can't be done in a transaction
+    atomic = False
+
+    dependencies = [
+        ('moneypool', '0051_highestbid_amount'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='equbinviterequest',
+            index=models.Index(condition=PENDING_REQUEST, fields=['equb'], name='equbinviterequest_pending'),
+        ),
+        AddIndexConcurrently(
+            model_name='equbjoinrequest',
+            index=models.Index(condition=PENDING_REQUEST, fields=['equb'], name='equbjoinrequest_pending'),
+        ),
+        AddIndexConcurrently(
+            model_name='friendrequest',
+            index=models.Index(condition=PENDING_REQUEST, fields=['creation_date'], name='friendrequest_pending'),
+        ),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 4.2.16 on 2026-10-16 22:41
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+def remove_duplicate_highest_bids(apps, schema_editor):
+    """
+    keeps only the highest of the HighestBids of each equb round so they can be made unique
+    """
+    HighestBid = apps.get_model('moneypool', 'HighestBid')
+
+    duplicates = HighestBid.objects.values('equb', 'round').annotate(count=models.Count('id')).filter(count__gt=1)
+    for duplicate in duplicates:
+        highest_bids = HighestBid.objects.filter(equb=duplicate['equb'], round=duplicate['round']).order_by('-amount', 'id')
+        HighestBid.objects.filter(pk__in=list(highest_bids.values_list('pk', flat=True)[1:])).delete()
+
+
+# the unique index is built without locking the table and then attached as the constraint
+ADD_UNIQUE_HIGHEST_BID = [
+    'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS unique_equb_round_highest_bid ON moneypool_highestbid (equb_id, round)',
+    'ALTER TABLE moneypool_highestbid ADD CONSTRAINT unique_equb_round_highest_bid UNIQUE USING INDEX unique_equb_round_highest_bid',
+]
+REMOVE_UNIQUE_HIGHEST_BID = [
+    'ALTER TABLE moneypool_highestbid DROP CONSTRAINT IF EXISTS unique_equb_round_highest_bid',
+]
+
+PENDING_REQUEST = models.Q(('is_accepted', False), ('is_expired', False), ('is_rejected', False))
+
+
+class Migration(migrations.Migration):
+    # indexes are built concurrently, which can't be done in a transaction
+    atomic = False
+
+    dependencies = [
+        ('moneypool', '0052_pending_request_indexes'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='bid',
+            index=models.Index(fields=['equb', 'round', '-amount', 'date'], name='bid_equb_round_amount'),
+        ),
+        AddIndexConcurrently(
+            model_name='equbinviterequest',
+            index=models.Index(condition=PENDING_REQUEST, fields=['receiver', '-creation_date'], name='inviterequest_receiver_pending'),
+        ),
+        AddIndexConcurrently(
+            model_name='friendrequest',
+            index=models.Index(condition=PENDING_REQUEST, fields=['receiver', '-creation_date'], name='friendrequest_receiver_pending'),
+        ),
+        AddIndexConcurrently(
+            model_name='friendrequest',
+            index=models.Index(condition=PENDING_REQUEST, fields=['sender', '-creation_date'], name='friendrequest_sender_pending'),
+        ),
+        AddIndexConcurrently(
+            model_name='paymentconfirmationrequest',
+            index=models.Index(fields=['equb', 'round', 'is_rejected'], name='paymentrequest_equb_round'),
+        ),
+        migrations.RunPython(remove_duplicate_highest_bids, migrations.RunPython.noop),
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddConstraint(
+                    model_name='highestbid',
+                    constraint=models.UniqueConstraint(fields=('equb', 'round'), name='unique_equb_round_highest_bid'),
+                ),
+            ],
+            database_operations=[
+                migrations.RunSQL(ADD_UNIQUE_HIGHEST_BID, REMOVE_UNIQUE_HIGHEST_BID),
+            ],
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.2.16 on 2026-10-16 23:43
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # indexes are built concurrently, which can't be done in a transaction
+    atomic = False
+
+    dependencies = [
+        ('moneypool', '0053_hot_lookup_indexes'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='bid',
+            index=models.Index(fields=['equb', '-date'], name='bid_equb_date'),
+        ),
+        AddIndexConcurrently(
+            model_name='equb',
+            index=models.Index(fields=['-creation_date'], name='equb_creation_date'),
+        ),
+        AddIndexConcurrently(
+            model_name='equbjoinrequest',
+            index=models.Index(fields=['receiver', '-creation_date'], name='joinrequest_receiver'),
+        ),
+        AddIndexConcurrently(
+            model_name='equbjoinrequest',
+            index=models.Index(fields=['sender', '-creation_date'], name='joinrequest_sender'),
+        ),
+        AddIndexConcurrently(
+            model_name='paymentconfirmationrequest',
+            index=models.Index(fields=['receiver', '-creation_date'], name='paymentrequest_receiver'),
+        ),
+        AddIndexConcurrently(
+            model_name='paymentconfirmationrequest',
+            index=models.Index(fields=['sender', '-creation_date'], name='paymentrequest_sender'),
+        ),
+        AddIndexConcurrently(
+            model_name='user',
+            index=models.Index(fields=['-date_joined'], name='user_date_joined'),
+        ),
+    ]
@@ -1,9 +1,12 @@
 from django.db import models, transaction
+from django.db.models.functions import Upper
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.indexes import GinIndex, OpClass
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.utils import timezone
 from django.dispatch import Signal
 
+import collections
 import datetime
 import random
 import logging
@@ -11,7 +14,6 @@ import decimal
 import pytz
 
 from rest_framework import serializers
-from guardian.shortcuts import assign_perm
 
 class User(AbstractUser):
     first_name = models.CharField(max_length=150)
@@ -40,6 +42,16 @@ class User(AbstractUser):
             models.Index(fields=['first_name']),
             models.Index(fields=['last_name']),
             models.Index(fields=['username']),
+            # trigram indexes serve user search by any part of a name
+            GinIndex(OpClass(Upper('username'), name='gin_trgm_ops'), name='user_username_trgm'),
+            GinIndex(OpClass(Upper('first_name'), name='gin_trgm_ops'), name='user_first_name_trgm'),
+            GinIndex(OpClass(Upper('last_name'), name='gin_trgm_ops'), name='user_last_name_trgm'),
+            # pattern indexes serve searches too short for trigrams by the start of a name
+            models.Index(OpClass(Upper('username'), name='text_pattern_ops'), name='user_username_prefix'),
+            models.Index(OpClass(Upper('first_name'), name='text_pattern_ops'), name='user_first_name_prefix'),
+            models.Index(OpClass(Upper('last_name'), name='text_pattern_ops'), name='user_last_name_prefix'),
+            # serves paging through users from the most recently joined
+            models.Index(fields=['-date_joined'], name='user_date_joined'),
         ]
 
 class ServiceChoices(models.TextChoices):
@@ -74,6 +86,92 @@ class Friendship(models.Model):
     # TODO removing friend
 
 
+class MutualFriendship(models.Model):
+    """
+    Number of friends two users have in common, kept for every pair of users with
+    at least one. It is adjusted whenever friendships are made or removed so that
+    the friends of friends of a user can be read without walking the friend graph.
+    """
+    user = models.ForeignKey(to=User, on_delete=models.CASCADE, related_name='+')
+    other = models.ForeignKey(to=User, on_delete=models.CASCADE, related_name='+')
+    mutual_friends = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'other'], name='unique_mutual_friendship')
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} and {self.other_id} have {self.mutual_friends} mutual friends'
+
+    @classmethod
+    def record_friendships(cls, user, friend_ids, delta):
+        """
+        adjusts the mutual friend counts for friendships between user and each of
+        friend_ids that were made (delta=1) or are being removed (delta=-1).
+        friendships are applied one at a time so that friends made or removed
+        together are counted once as each other's mutual friends.
+        """
+        friend_ids = set(friend_ids)
+        if not friend_ids:
+            return
+        current_friend_ids = set(Friendship.objects.filter(friend_id=user.id).values_list('user_id', flat=True))
+        user_friend_ids = current_friend_ids - friend_ids if delta > 0 else current_friend_ids | friend_ids
+
+        friends_of_friends = {friend_id: set() for friend_id in friend_ids}
+        for friend_id, other_id in Friendship.objects.filter(friend_id__in=friend_ids).values_list('friend_id', 'user_id'):
+            if other_id != user.id:
+                friends_of_friends[friend_id].add(other_id)
+
+        changes = collections.Counter()
+        for friend_id in friend_ids:
+            # user is now (or no longer) a mutual friend of friend and every other friend of user
+            for other_id in user_friend_ids - {friend_id}:
+                changes[(friend_id, other_id)] += delta
+                changes[(other_id, friend_id)] += delta
+            # friend is now (or no longer) a mutual friend of user and every other friend of friend
+            for other_id in friends_of_friends[friend_id]:
+                changes[(user.id, other_id)] += delta
+                changes[(other_id, user.id)] += delta
+            if delta > 0:
+                user_friend_ids.add(friend_id)
+            else:
+                user_friend_ids.discard(friend_id)
+        cls.apply_changes(changes)
+
+    @classmethod
+    def apply_changes(cls, changes):
+        """
+        adds each change to the count of its (user_id, other_id) pair, removing pairs left without mutual friends
+        """
+        changes = {pair: change for pair, change in changes.items() if change}
+        if not changes:
+            return
+        with transaction.atomic():
+            existing = {
+                (mutual_friendship.user_id, mutual_friendship.other_id): mutual_friendship
+                for mutual_friendship in cls.objects.select_for_update().filter(
+                    user_id__in={user_id for user_id, other_id in changes},
+                    other_id__in={other_id for user_id, other_id in changes},
+                )
+                if (mutual_friendship.user_id, mutual_friendship.other_id) in changes
+            }
+            updated, created, removed = [], [], []
+            for (user_id, other_id), change in changes.items():
+                mutual_friendship = existing.get((user_id, other_id))
+                if mutual_friendship is None:
+                    if change > 0:
+                        created.append(cls(user_id=user_id, other_id=other_id, mutual_friends=change))
+                elif mutual_friendship.mutual_friends + change > 0:
+                    mutual_friendship.mutual_friends += change
+                    updated.append(mutual_friendship)
+                else:
+                    removed.append(mutual_friendship.pk)
+            cls.objects.bulk_update(updated, ['mutual_friends'])
+            cls.objects.bulk_create(created)
+            cls.objects.filter(pk__in=removed).delete()
+
+
 def deleted_user():
     return User.objects.get_or_create(username='deleted', first_name='deleted', last_name='deleted')[0]
 
@@ -89,30 +187,28 @@ class Equb(models.Model):
     creator = models.ForeignKey(to=User, on_delete=models.SET_NULL, null=True, related_name='created_equbs')
     creation_date = models.DateTimeField(default=timezone.now)
     end_date = models.DateTimeField(null=True, blank=True)
-    is_private = models.BooleanField(default=False)  # if true, creator's friends are notified of the equb's creation
+    is_private = models.BooleanField(default=False)  # if false, equb is recommended to creator's friends and their friends
     is_active = models.BooleanField(default=False)
     is_completed = models.BooleanField(default=False)
     is_in_payment_stage = models.BooleanField(default=False)
 
     class Meta:
         ordering = ['-creation_date']
+        indexes = [
+            # serves paging through equbs from the most recently created
+            models.Index(fields=['-creation_date'], name='equb_creation_date'),
+        ]
 
     def __str__(self):
         return f"{self.creator.username  if self.creator else 'deleted user'}'s {self.name}"
 
     def activate(self) -> None:
         self.is_active = True
-        self.save()
-
-        # freezing all requests or invitations to join this equb
-        map(lambda req: req.freeze_instance(), EqubInviteRequest.objects.filter(equb=self))
-        map(lambda req: req.freeze_instance(), EqubJoinRequest.objects.filter(equb=self))
-        
-        # expiring all requests or invitations to join this equb
-        EqubInviteRequest.objects.filter(equb=self).update(is_expired=True)
-        EqubJoinRequest.objects.filter(equb=self).update(is_expired=True)
+        self.save(update_fields=['is_active'])
 
-        
+        # expiring all pending requests or invitations to join this equb
+        EqubInviteRequest.expire_pending(equb=self)
+        EqubJoinRequest.expire_pending(equb=self)
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
@@ -126,6 +222,45 @@ class EqubMembership(models.Model):
     class Meta:
         ordering = ['-date_joined']
 
+class EqubAccess(models.Model):
+    """
+    Access of a user to an equb through membership or an invitation. It is kept
+    up to date by the membership and invitation signals so that the equbs a user
+    can see are read with one indexed lookup on (user, equb).
+    """
+    user = models.ForeignKey(to=User, on_delete=models.CASCADE, related_name='equb_accesses')
+    equb = models.ForeignKey(to=Equb, on_delete=models.CASCADE, related_name='accesses')
+    is_member = models.BooleanField(default=False)
+    is_invited = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'equb'], name='unique_user_equb_access')
+        ]
+
+    def __str__(self):
+        return str(self.user_id) + ' can access ' + str(self.equb_id)
+
+    @classmethod
+    def grant(cls, field, pairs):
+        """
+        gives access through field, 'is_member' or 'is_invited', to every (user_id, equb_id) pair
+        """
+        cls.objects.bulk_create(
+            [cls(user_id=user_id, equb_id=equb_id, **{field: True}) for user_id, equb_id in pairs],
+            update_conflicts=True, unique_fields=['user', 'equb'], update_fields=[field],
+        )
+
+    @classmethod
+    def revoke(cls, field, **filters):
+        """
+        removes access through field from the matching rows, deleting the rows left without access
+        """
+        with transaction.atomic():
+            cls.objects.filter(**filters).update(**{field: False})
+            cls.objects.filter(is_member=False, is_invited=False, **filters).delete()
+
+
 class Win(models.Model):
     user = models.ForeignKey(to=User, on_delete=models.CASCADE)
     round = models.PositiveIntegerField()
@@ -138,6 +273,7 @@ class Win(models.Model):
         return str(self.user.username) + ' won round ' + str(self.round)
 
 new_round_signal = Signal()
+round_closing_signal = Signal()  # sent before the winner of a round is selected
 
 class BalanceManager(models.Model):
     equb = models.OneToOneField(to=Equb, on_delete=models.CASCADE, related_name='balance_manager')
@@ -175,8 +311,17 @@ class BalanceManager(models.Model):
     def current_round(self):
         return min(self.finished_rounds + 1, self.equb.max_members)
 
-    def time_left_till_next_round(self):  # time till next round
+    def next_round_time(self):
         if self.current_round_start_date is None:
+            return None
+        return self.current_round_start_date.replace(tzinfo=pytz.UTC) + self.equb.cycle
+
+    def time_left_till_next_round(self):  # time till next round
+        return self.time_left_until(self.next_round_time())
+
+    @staticmethod
+    def time_left_until(next_round_time):
+        if next_round_time is None:
             time_delta_dict = {
                 "days": 0,
                 "hours": 0,
@@ -184,7 +329,6 @@ class BalanceManager(models.Model):
                 "seconds": 0
             }
         else: 
-            next_round_time = self.current_round_start_date.replace(tzinfo=pytz.UTC) + self.equb.cycle
             delta = next_round_time - datetime.datetime.now(tz=pytz.UTC)
             days = delta.days
             hours, remainder = divmod(delta.seconds, 3600)
@@ -199,36 +343,41 @@ class BalanceManager(models.Model):
             }
         return time_delta_dict
 
+    def round_state(self, round=None):
+        """
+        returns the maintained RoundState of the given round, the current round by default, without writing it
+        """
+        return RoundState.for_round(self.equb, round or self.current_round())
+
     def rejected_payers(self):
         """
-        returns all payment confirmation requests from the previous round that have been rejected
+        returns all members whose payment confirmation requests for the current round have been rejected
         """
-        return [conf_request.sender for conf_request in PaymentConfirmationRequest.objects.filter(equb=self.equb, round=self.current_round(), is_rejected=True).select_related('sender')]
+        return list(User.objects.filter(id__in=self.round_state().rejected_payer_ids))
 
     def unconfirmed_payers(self):
         """
-        returns all payment confirmation requests from the previous round that haven't yet been accepted 
+        returns all members whose payment confirmation requests for the current round haven't yet been accepted 
         by that round's winner and haven't been rejected
         """
-        return [conf_request.sender for conf_request in PaymentConfirmationRequest.objects.filter(equb=self.equb, round=self.current_round(), is_accepted=False, is_rejected=False).select_related('sender')]
+        return list(User.objects.filter(id__in=self.round_state().unconfirmed_payer_ids))
     
     def confirmed_payers(self):
         """
         inverse of self.unconfirmed_payers
         """
-        return [conf_request.sender for conf_request in PaymentConfirmationRequest.objects.filter(equb=self.equb, round=self.current_round(), is_accepted=True).select_related('sender')]
+        return list(User.objects.filter(id__in=self.round_state().confirmed_payer_ids))
     
     def unpaid_members(self):
         """
         returns all members who haven't yet sent a payment confirmation request to the current round's winner
         """
-        all_members = self.equb.members.all()
-        payment_confirmation_requests = PaymentConfirmationRequest.objects.filter(equb=self.equb, round=self.current_round(), is_rejected=False)
-        payment_confirmation_requested_members = User.objects.filter(pk__in=payment_confirmation_requests.values_list('sender', flat=True))
-        if self.latest_winner():
-            return all_members.exclude(id=self.latest_winner().id).difference(payment_confirmation_requested_members)
-        else:
-            return all_members.difference(payment_confirmation_requested_members)
+        round_state = self.round_state()
+        requested = round_state.confirmed_payer_ids + round_state.unconfirmed_payer_ids
+        latest_winner = self.latest_winner()
+        if latest_winner:
+            requested.append(latest_winner.id)
+        return self.equb.members.exclude(id__in=requested)
 
     def payment_collection_dates(self):
         """
@@ -241,24 +390,44 @@ class BalanceManager(models.Model):
         return win_dates
 
     def latest_winner(self):
-        return self.wins.first().user if self.wins.exists() else None
+        round_state = self.equb.round_states.filter(winner__isnull=False).select_related('winner').first()
+        return round_state.winner if round_state else None
     
+    def lock(self):
+        """
+        locks the balance manager's row for the rest of the current transaction
+        and reloads its round progress and its equb's state
+        """
+        locked = BalanceManager.objects.select_for_update().get(pk=self.pk)
+        self.finished_rounds = locked.finished_rounds
+        self.current_round_start_date = locked.current_round_start_date
+        self.last_managed = locked.last_managed
+        self.equb.refresh_from_db(fields=['is_active', 'is_in_payment_stage', 'is_completed', 'end_date'])
+
     def select_winner(self):
         """
+        Closes the current round and starts its payment stage.
         Selects highest bidder as winner.
         If there is no bid, winner is randomly selected from
-        those who haven't received their equbs yet
+        those who haven't received their equbs yet.
+        Runs in one transaction with the balance manager locked, so a round
+        is closed once and never left in the payment stage without a winner.
         """
-        with transaction.atomic(): # to ensure payment stage is not started without a winner
-            self.equb.is_in_payment_stage = True
-            self.equb.save()
+        with transaction.atomic():
+            self.lock()
+            equb = self.equb
+            if equb.is_in_payment_stage or equb.is_completed:
+                return None  # already closed
+
+            equb.is_in_payment_stage = True
+            equb.save(update_fields=['is_in_payment_stage'])
 
             current_round = self.finished_rounds + 1
-            highest_bid = self.equb.highest_bids.get(round=current_round)
-            all_members = self.equb.members.all()
-            received = self.received.all()
-            not_received = all_members.difference(received)
-            logging.info(f'{not_received.count()} member have not won yet')
+            round_closing_signal.send(sender=self.__class__, instance=self, round=current_round)
+            highest_bid = equb.highest_bids.select_related('bid__user').get(round=current_round)
+            received = set(self.received.values_list('id', flat=True))
+            not_received = [member for member in equb.members.all() if member.id not in received]
+            logging.info(f'{len(not_received)} member have not won yet')
             
             if not_received:
                 win = Win.objects.create(
@@ -266,64 +435,80 @@ class BalanceManager(models.Model):
                     round=current_round
                 )
                 self.wins.add(win)
+                RoundState.setup(equb, current_round).record_win(win)
                 logging.info(f'{win.user.username} won round {current_round}')
                 self.received.add(win.user)
                 return win.user
         
     def calculate_winners_award(self, round):
+        return self.round_state(round).award
+
+    def calculate_award_for_bid(self, bid_amount):
+        """
+        award of a round whose highest bid is bid_amount (0 if there is no bid)
+        """
         equb = self.equb
-        highest_bid = equb.highest_bids.get(round=round) 
-        if highest_bid.bid:
-            bid_amount = highest_bid.bid.amount
-        else:
-            bid_amount = 0
-        
-        deductible_portion = equb.amount * decimal.Decimal(1 - 1 / equb.max_members)
+        amount = decimal.Decimal(equb.amount)
+        deductible_portion = amount * decimal.Decimal(1 - 1 / equb.max_members)
         deducted_award = deductible_portion * decimal.Decimal(1 - bid_amount)
-        non_deductible_award = equb.amount / equb.max_members
+        non_deductible_award = amount / equb.max_members
         award = non_deductible_award + deducted_award
         
         return award
     
-    def calculate_losers_deductions(self, member, round):
+    def calculate_deductions(self, round):
         """
-        calculates the amount each member must pay in the next round; 
+        calculates the amount every member must pay for the round in one pass;
         amount of deduction depends on whether the member has received equb in previous rounds.
+        returns the members and a dict of deductions keyed by member id.
         """
         equb = self.equb
-        all_members = equb.members.all()
-        not_received = all_members.difference(self.received.all())
+        members = list(equb.members.all())
+        received = set(self.received.values_list('id', flat=True))
+        not_received_count = len([member for member in members if member.id not in received])
         max_members = equb.max_members
-        highest_bid = equb.highest_bids.get(round=round) 
-
-        if highest_bid.bid:
-            bid_amount = highest_bid.bid.amount
-        else:
-            bid_amount = 0
+        amount = decimal.Decimal(equb.amount)
+        bid_amount = self.round_state(round).highest_bid_amount
 
         # winner's contribution = 0 if there is no bid
-        winners_contribution = equb.amount * decimal.Decimal((1 - 1 / max_members)) * decimal.Decimal((bid_amount))
-
-        if member in not_received: 
-            return (equb.amount / max_members) - (winners_contribution / not_received.count())
-        elif member in self.received.all():
-            return equb.amount / max_members
-        else: # winner
-            return 0
-        
+        winners_contribution = amount * decimal.Decimal((1 - 1 / max_members)) * decimal.Decimal((bid_amount))
+
+        deductions = {}
+        for member in members:
+            if member.id not in received:
+                deductions[member.id] = (amount / max_members) - (winners_contribution / not_received_count)
+            else:
+                deductions[member.id] = amount / max_members
+        return members, deductions
+
+    def calculate_losers_deductions(self, member, round):
+        """
+        calculates the amount a member must pay in the next round
+        """
+        members, deductions = self.calculate_deductions(round)
+        return deductions.get(member.id, 0)
 
     def update_winner_account(self):
         """
         adds the total value of equb to winners account minus the percentage
-        of this amount equal to what was bid
+        of this amount equal to what was bid.
+        The winner is selected and credited in one transaction with the balance
+        manager locked, so a round is never left with a winner but no credit.
         """
-        winner = self.select_winner()
-        award = self.calculate_winners_award(self.finished_rounds + 1)
-        if winner:
-            logging.info(f'award {award} bank account {winner.bank_account}')
-            winner.bank_account += award  # amount = equb value if highest bid = 0
-            winner.save()
-            logging.info(f'{winner.username} award {award}')
+        with transaction.atomic():
+            self.lock()
+            current_round = self.finished_rounds + 1
+            winner = self.select_winner()
+            if not winner:
+                return
+            # amount = equb value if highest bid = 0
+            award = self.calculate_winners_award(current_round)
+            User.objects.filter(pk=winner.pk).update(bank_account=models.F('bank_account') + award)
+            LedgerEntry.objects.create(
+                user=winner, equb=self.equb, round=current_round,
+                kind=LedgerEntry.CREDIT, amount=award
+            )
+        logging.info(f'{winner.username} award {award}')
 
     def collect_money(self):
         """
@@ -331,28 +516,151 @@ class BalanceManager(models.Model):
         Distributes the highest bid to those who haven't
         received their equbs yet. Those who received their
         equb won't benefit from the bid.
+        All balances are updated with a single statement and every
+        deduction is recorded in the ledger.
         """
 
-        current_round = self.finished_rounds + 1
-        for member in self.equb.members.all(): 
-            member.bank_account -= self.calculate_losers_deductions(member, current_round)
-            member.save()
-            
+        with transaction.atomic():
+            self.lock()
+            current_round = self.finished_rounds + 1
+            members, deductions = self.calculate_deductions(current_round)
+            deductions = {
+                member_id: decimal.Decimal(deduction).quantize(decimal.Decimal('0.01'))
+                for member_id, deduction in deductions.items()
+            }
+            User.objects.filter(pk__in=deductions.keys()).update(
+                bank_account=models.F('bank_account') - models.Case(
+                    *[models.When(pk=member_id, then=models.Value(deduction)) for member_id, deduction in deductions.items()],
+                    output_field=models.DecimalField(max_digits=13, decimal_places=2),
+                )
+            )
+            LedgerEntry.objects.bulk_create([
+                LedgerEntry(
+                    user=member, equb=self.equb, round=current_round,
+                    kind=LedgerEntry.DEBIT, amount=deductions[member.id]
+                )
+                for member in members if deductions[member.id]
+            ])
 
     def setup_next_round(self):
-        self.equb.is_in_payment_stage = False
-        self.equb.save()
-        
-        self.finished_rounds += 1
-        self.last_managed = timezone.now()
-        self.save()
-        
-        if self.equb.max_members == self.finished_rounds:
-            self.equb.is_completed = True  
-            self.equb.end_date = timezone.now()          
-            self.equb.save()
-        else:
-            new_round_signal.send(sender=self.__class__, instance = self, equb=self.equb)
+        """
+        Ends the payment stage and starts the next round, or completes the equb
+        after its last round. The round advance, the next round's HighestBid,
+        RoundState and deadline and the members' notifications are written in
+        one transaction with the balance manager locked, and new_round_signal
+        is sent once it commits.
+        """
+        with transaction.atomic():
+            self.lock()
+            equb = self.equb
+            if not equb.is_in_payment_stage:
+                return  # already advanced
+
+            now = timezone.now()
+            equb.is_in_payment_stage = False
+            self.finished_rounds += 1
+            self.last_managed = now
+
+            if equb.max_members == self.finished_rounds:
+                equb.is_completed = True
+                equb.end_date = now
+                equb.save(update_fields=['is_in_payment_stage', 'is_completed', 'end_date'])
+                self.save(update_fields=['finished_rounds', 'last_managed'])
+                return
+
+            self.current_round_start_date = now
+            equb.save(update_fields=['is_in_payment_stage'])
+            self.save(update_fields=['finished_rounds', 'last_managed', 'current_round_start_date'])
+
+            next_round = self.finished_rounds + 1
+            HighestBid.objects.create(equb=equb, round=next_round)
+            RoundState.setup(equb, next_round)
+            RoundDeadline.schedule(self)
+            NewRoundNotification.notify(equb=equb)
+            transaction.on_commit(lambda: new_round_signal.send(sender=self.__class__, instance=self, equb=equb))
+
+
+class LedgerEntryImmutable(Exception):
+    pass
+
+
+class LedgerEntryQuerySet(models.QuerySet):
+    """
+    refuses the bulk updates and deletes that would bypass LedgerEntry.save and LedgerEntry.delete
+    """
+
+    def update(self, **kwargs):
+        raise LedgerEntryImmutable('ledger entries cannot be changed once recorded')
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        # refused before bulk_update opens a transaction that the error would break
+        raise LedgerEntryImmutable('ledger entries cannot be changed once recorded')
+
+    def delete(self):
+        raise LedgerEntryImmutable('ledger entries cannot be deleted')
+
+
+class LedgerEntry(models.Model):
+    """
+    Append-only record of every credit and debit made to a member's
+    bank account when a round is settled.
+    """
+    CREDIT = 'credit'
+    DEBIT = 'debit'
+
+    user = models.ForeignKey(to=User, on_delete=models.CASCADE, related_name='ledger_entries')
+    equb = models.ForeignKey(to=Equb, on_delete=models.CASCADE, related_name='ledger_entries')
+    round = models.PositiveIntegerField()
+    kind = models.CharField(max_length=6, choices=[(CREDIT, 'Credit'), (DEBIT, 'Debit')])
+    amount = models.DecimalField(max_digits=13, decimal_places=2)
+    date = models.DateTimeField(default=timezone.now)
+
+    objects = LedgerEntryQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['-date']
+
+    def __str__(self):
+        return f'{self.kind} of {self.amount} to {self.user.username} for {self.equb.name} round {self.round}'
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise LedgerEntryImmutable('ledger entries cannot be changed once recorded')
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise LedgerEntryImmutable('ledger entries cannot be deleted')
+
+
+class RoundDeadline(models.Model):
+    """
+    Time at which the winner of an active equb's current round is selected.
+    Each equb has at most one deadline, which is read by the round scheduler.
+    """
+    equb = models.OneToOneField(to=Equb, on_delete=models.CASCADE, related_name='round_deadline')
+    round = models.PositiveIntegerField()
+    due_at = models.DateTimeField(db_index=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        ordering = ['due_at']
+
+    def __str__(self):
+        return str(self.equb.name) + ' round ' + str(self.round) + ' due at ' + str(self.due_at)
+
+    @classmethod
+    def schedule(cls, balance_manager):
+        """
+        sets the deadline of the balance manager's current round to the end of its cycle
+        """
+        deadline, created = cls.objects.update_or_create(
+            equb_id=balance_manager.equb_id,
+            defaults={
+                'round': balance_manager.current_round(),
+                'due_at': balance_manager.current_round_start_date + balance_manager.equb.cycle,
+            }
+        )
+        return deadline
 
 
 class Bid(models.Model):
@@ -367,6 +675,12 @@ class Bid(models.Model):
 
     class Meta:
         ordering = ['-round', '-amount']
+        indexes = [
+            # serves reading the bids of a round from the highest
+            models.Index(fields=['equb', 'round', '-amount', 'date'], name='bid_equb_round_amount'),
+            # serves paging through the bids of a user's equbs from the most recent
+            models.Index(fields=['equb', '-date'], name='bid_equb_date'),
+        ]
 
     def __str__(self):
         return str(self.user.username) + ' to ' + str(self.equb.name) + ' round ' + str(self.round) + ' ' + str(self.amount)
@@ -381,17 +695,29 @@ class Bid(models.Model):
         bid.save()
         return bid
 
-    def is_highest_bid(self):
-        highest_bid = HighestBid.objects.get(equb=self.equb, round=self.round)
-        if not highest_bid.bid or (highest_bid.bid and self.amount > highest_bid.bid.amount):
-            return True
-        else:
-            return False
+    def place(self):
+        """
+        makes the bid the highest bid of its round if it is higher than the current one.
+        The highest bid is swapped with a single conditional update that only succeeds
+        if it hasn't changed since it was read, and is read again if it has, so
+        concurrent bids never overwrite a higher bid and no lock is held between bids.
+        The swap and the round state are written in one transaction.
+        """
+        while True:
+            with transaction.atomic():
+                highest_bid = HighestBid.objects.select_related('bid').get(equb_id=self.equb_id, round=self.round)
+                if self.amount <= highest_bid.amount:
+                    return BidPlacement(is_highest=False, previous_highest_bid=highest_bid.bid)
+                swapped = HighestBid.objects.filter(
+                    pk=highest_bid.pk, bid_id=highest_bid.bid_id, amount__lt=self.amount
+                ).update(bid=self, amount=self.amount)
+                if swapped:
+                    RoundState.record_highest_bid(self)
+                    return BidPlacement(is_highest=True, previous_highest_bid=highest_bid.bid)
+
 
-    def make_highest_bid(self):
-        highest_bid = HighestBid.objects.get(equb=self.equb, round=self.round)
-        highest_bid.bid = self
-        highest_bid.save()
+# outcome of placing a bid, returned by Bid.place
+BidPlacement = collections.namedtuple('BidPlacement', ['is_highest', 'previous_highest_bid'])
 
 
 class HighestBid(models.Model):
@@ -399,13 +725,123 @@ class HighestBid(models.Model):
     """
     highest bid object is always created whenever an equb is created in create_equb view.
     However the bid attribute is set to null.
+    amount is a copy of the bid's amount (0 without a bid) that bids are compared against.
     """
 
     equb = models.ForeignKey(to=Equb, on_delete=models.CASCADE, related_name='highest_bids')
     bid = models.OneToOneField(to=Bid, on_delete=models.SET_NULL, null=True, blank=True)
+    amount = models.DecimalField(max_digits=5, decimal_places=3, default=0)
     round = models.PositiveIntegerField()
     winner = models.ForeignKey(to=User, on_delete=models.SET_NULL, null=True, blank=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['equb', 'round'], name='unique_equb_round_highest_bid')
+        ]
+
+
+class RoundState(models.Model):
+    """
+    Maintained summary of one round of an equb. It is updated by the bid, win
+    and payment confirmation flows so that the state of a round can be read
+    from a single row instead of being recomputed from Win, HighestBid and
+    PaymentConfirmationRequest.
+    """
+    equb = models.ForeignKey(to=Equb, on_delete=models.CASCADE, related_name='round_states')
+    round = models.PositiveIntegerField()
+    winner = models.ForeignKey(to=User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    highest_bidder = models.ForeignKey(to=User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    highest_bid_amount = models.DecimalField(max_digits=5, decimal_places=3, default=0)
+    award = models.DecimalField(max_digits=13, decimal_places=2, default=0)
+    confirmed_count = models.PositiveIntegerField(default=0)
+    unconfirmed_count = models.PositiveIntegerField(default=0)
+    rejected_count = models.PositiveIntegerField(default=0)
+    confirmed_payer_ids = models.JSONField(default=list, blank=True)
+    unconfirmed_payer_ids = models.JSONField(default=list, blank=True)
+    rejected_payer_ids = models.JSONField(default=list, blank=True)
+
+    class Meta:
+        ordering = ['-round']
+        constraints = [
+            models.UniqueConstraint(fields=['equb', 'round'], name='unique_equb_round_state')
+        ]
+
+    def __str__(self):
+        return str(self.equb.name) + ' round ' + str(self.round)
+
+    @classmethod
+    def for_round(cls, equb, round):
+        """
+        returns the state of the round without writing it, or an unsaved blank state if it hasn't been set up
+        """
+        round_state = cls.objects.filter(equb=equb, round=round).first()
+        if round_state is None:
+            award = equb.balance_manager.calculate_award_for_bid(0).quantize(decimal.Decimal('0.01'))
+            round_state = cls(equb=equb, round=round, award=award)
+        return round_state
+
+    @classmethod
+    def setup(cls, equb, round):
+        """
+        returns the saved state of the round, creating it if it doesn't exist yet.
+        Only the setup of a round and the flows that write its state call this.
+        """
+        round_state, created = cls.objects.get_or_create(
+            equb=equb, round=round,
+            defaults={'award': equb.balance_manager.calculate_award_for_bid(0)}
+        )
+        return round_state
+
+    @classmethod
+    def record_highest_bid(cls, bid):
+        """
+        records bid as the highest bid of its round without loading the round's state,
+        which is only set up here if it hasn't been. The update is conditional, so a
+        lower bid recorded late never replaces a higher one.
+        """
+        fields = {
+            'highest_bid_amount': bid.amount,
+            'highest_bidder_id': bid.user_id,
+            'award': bid.equb.balance_manager.calculate_award_for_bid(bid.amount),
+        }
+        round_states = cls.objects.filter(equb_id=bid.equb_id, round=bid.round)
+        if not round_states.filter(highest_bid_amount__lt=bid.amount).update(**fields) and not round_states.exists():
+            cls.setup(bid.equb, bid.round)
+            round_states.filter(highest_bid_amount__lt=bid.amount).update(**fields)
+
+    def record_win(self, win):
+        self.winner = win.user
+        self.save(update_fields=['winner'])
+
+    def refresh_payments(self):
+        """
+        recomputes the payer sets of the round from its payment confirmation requests
+        """
+        with transaction.atomic():
+            round_state = RoundState.objects.select_for_update().get(pk=self.pk)
+            payer_ids = {'confirmed': [], 'unconfirmed': [], 'rejected': []}
+            requests = PaymentConfirmationRequest.objects.filter(
+                equb_id=self.equb_id, round=self.round
+            ).values_list('sender_id', 'is_accepted', 'is_rejected')
+            for sender_id, is_accepted, is_rejected in requests:
+                if is_rejected:
+                    payer_ids['rejected'].append(sender_id)
+                elif is_accepted:
+                    payer_ids['confirmed'].append(sender_id)
+                else:
+                    payer_ids['unconfirmed'].append(sender_id)
+            for status, ids in payer_ids.items():
+                setattr(round_state, f'{status}_payer_ids', ids)
+                setattr(round_state, f'{status}_count', len(ids))
+            round_state.save(update_fields=[
+                'confirmed_payer_ids', 'unconfirmed_payer_ids', 'rejected_payer_ids',
+                'confirmed_count', 'unconfirmed_count', 'rejected_count',
+            ])
+        self.refresh_from_db()
+
+
+PENDING_REQUEST = models.Q(is_accepted=False, is_rejected=False, is_expired=False)
+request_addressed_signal = Signal()  # sent when a pending request is accepted, rejected or expired
 
 class Request(models.Model):
     sender = models.ForeignKey(to=User, on_delete=models.CASCADE, related_name='sent_%(class)ss')
@@ -419,22 +855,62 @@ class Request(models.Model):
         abstract = True
         ordering = ['-creation_date']
 
+    @classmethod
+    def pending(cls):
+        return cls.objects.filter(PENDING_REQUEST)
+
+    @classmethod
+    def expire_pending(cls, **filters):
+        """
+        expires the pending requests matching filters with one bulk update, without
+        running on_expire, and returns how many were expired
+        """
+        return cls.pending().filter(**filters).update(is_expired=True)
+
+    def on_accept(self):
+        raise NotImplementedError('must implement on_accept method for request subclass')
+
+    def on_reject(self):
+        pass
+
+    def on_expire(self):
+        pass
+
+    def transition(self, field, side_effect):
+        """
+        Marks a pending request as addressed with a single conditional update
+        and runs the side effect only if the request was still pending, so only
+        one of concurrent transitions of a request takes effect.
+        Returns whether the request was addressed.
+        """
+        with transaction.atomic():
+            if not self.__class__.pending().filter(pk=self.pk).update(**{field: True}):
+                return False
+            setattr(self, field, True)
+            request_addressed_signal.send(sender=self.__class__, instance=self, field=field)
+            side_effect()
+        return True
+
     def accept(self):
-        raise NotImplementedError('must implement accept method for request subclass')
+        return self.transition('is_accepted', self.on_accept)
 
     def reject(self):
-        pass
+        return self.transition('is_rejected', self.on_reject)
+
+    def expire(self):
+        return self.transition('is_expired', self.on_expire)
 
     def save(self, *args, **kwargs):
-        if self.pk: # if instance exists
-            addressed_before = self.__class__.objects.get(pk=self.pk).is_accepted or self.__class__.objects.get(pk=self.pk).is_rejected or self.__class__.objects.get(pk=self.pk).is_expired
-            if self.is_accepted and not addressed_before:
-                super().save(*args, **kwargs)
-                self.accept()
-            elif self.is_rejected and not addressed_before:
-                super().save(*args, **kwargs)
-                self.reject()
+        if self.pk: # if instance exists, it can only be addressed
+            if self.is_accepted:
+                addressed = self.accept()
+            elif self.is_rejected:
+                addressed = self.reject()
+            elif self.is_expired:
+                addressed = self.expire()
             else:
+                addressed = False
+            if not addressed:
                 raise serializers.ValidationError({"is_accepted": "You cannot update this request"})
         else:
             super().save(*args, **kwargs)
@@ -442,7 +918,16 @@ class Request(models.Model):
 class EqubJoinRequest(Request):
     equb = models.ForeignKey(to=Equb, on_delete=models.CASCADE, related_name='%(class)ss')
 
-    def accept(self):
+    class Meta(Request.Meta):
+        indexes = [
+            # serves expiring the pending requests of an equb
+            models.Index(fields=['equb'], condition=PENDING_REQUEST, name='equbjoinrequest_pending'),
+            # serve paging through the join requests received and sent by a user
+            models.Index(fields=['receiver', '-creation_date'], name='joinrequest_receiver'),
+            models.Index(fields=['sender', '-creation_date'], name='joinrequest_sender'),
+        ]
+
+    def on_accept(self):
         if not self.equb.is_active and self.sender:
             self.equb.members.add(self.sender)
         else:
@@ -452,7 +937,15 @@ class EqubJoinRequest(Request):
 class EqubInviteRequest(Request):
     equb = models.ForeignKey(to=Equb, on_delete=models.CASCADE, related_name='%(class)ss')
 
-    def accept(self):
+    class Meta(Request.Meta):
+        indexes = [
+            # serves expiring the pending invitations of an equb
+            models.Index(fields=['equb'], condition=PENDING_REQUEST, name='equbinviterequest_pending'),
+            # serves the pending invitations received by a user
+            models.Index(fields=['receiver', '-creation_date'], condition=PENDING_REQUEST, name='inviterequest_receiver_pending'),
+        ]
+
+    def on_accept(self):
         # equb must not be active
         if not self.equb.is_active:
             self.equb.members.add(self.receiver)
@@ -474,25 +967,36 @@ class PaymentConfirmationRequest(Request):
     round = models.IntegerField(default=1)
     message = models.TextField(blank=True)
 
-    def accept(self):
+    class Meta(Request.Meta):
+        indexes = [
+            # serves the payment confirmations of a round
+            models.Index(fields=['equb', 'round', 'is_rejected'], name='paymentrequest_equb_round'),
+            # serve paging through the payment confirmations received and sent by a user
+            models.Index(fields=['receiver', '-creation_date'], name='paymentrequest_receiver'),
+            models.Index(fields=['sender', '-creation_date'], name='paymentrequest_sender'),
+        ]
+
+    def on_accept(self):
         """
         If all loosers' payments have been confirmed by the winner,
         the next round is ready to be set up.
         """
-        if len(self.equb.balance_manager.confirmed_payers()) == self.equb.members.count() - 1:
+        if self.equb.balance_manager.round_state().confirmed_count == self.equb.members.count() - 1:
             self.equb.balance_manager.setup_next_round()
 
 class FriendRequest(Request):
 
-    def accept(self):
-        self.receiver.friends.add(self.sender)
-
+    class Meta(Request.Meta):
+        indexes = [
+            # serves expiring pending friend requests older than FRIEND_REQUEST_TTL
+            models.Index(fields=['creation_date'], condition=PENDING_REQUEST, name='friendrequest_pending'),
+            # serve the pending friend requests received and sent by a user
+            models.Index(fields=['receiver', '-creation_date'], condition=PENDING_REQUEST, name='friendrequest_receiver_pending'),
+            models.Index(fields=['sender', '-creation_date'], condition=PENDING_REQUEST, name='friendrequest_sender_pending'),
+        ]
 
-def assign_notification_perm(sender, instance, created, **kwargs):
-    if created:
-        perm = sender._meta.model_name
-        assign_perm(f'moneypool.change_{sender._meta.model_name}', instance.receiver)
-        assign_perm(f'change_{sender._meta.model_name}', instance.receiver, instance)
+    def on_accept(self):
+        self.receiver.friends.add(self.sender)
 
 
 class Notification(models.Model):
@@ -501,15 +1005,18 @@ class Notification(models.Model):
     creation_date = models.DateTimeField(default=timezone.now)
     is_read = models.BooleanField(default=False)
 
-    @classmethod
-    def __init_subclass__(cls, **kwargs):
-        super().__init_subclass__(**kwargs)
-        models.signals.post_save.connect(receiver=assign_notification_perm, sender=cls)
-
     @classmethod
     def notify(cls, *args):
         raise NotImplementedError('must implement notify method for a Notification subclass ')
 
+    @classmethod
+    def fan_out(cls, receivers, **fields):
+        """
+        creates a notification for every receiver with a single insert, so the
+        number of writes does not depend on the number of receivers
+        """
+        return cls.objects.bulk_create([cls(receiver=receiver, **fields) for receiver in receivers])
+
     class Meta:
         abstract = True
         ordering = ['-creation_date']
@@ -529,10 +1036,7 @@ class NewRoundNotification(Notification):
 
     @classmethod
     def notify(cls, equb):
-        for member in equb.members.all():
-            cls.objects.create(
-                equb=equb, receiver=member, 
-                round=equb.balance_manager.finished_rounds + 1)
+        cls.fan_out(equb.members.all(), equb=equb, round=equb.balance_manager.finished_rounds + 1)
 
 
 class NewMemberNotification(Notification):
@@ -543,25 +1047,21 @@ class NewMemberNotification(Notification):
 
     @classmethod
     def notify(cls, equb, new_member):
-        members = list(equb.members.all())[:-1]
-        for member in members:  # includes all members except the latest member
-            cls.objects.create(equb=equb, receiver=member, new_member=new_member)
+        members = list(equb.members.all())[:-1]  # includes all members except the latest member
+        cls.fan_out(members, equb=equb, new_member=new_member)
 
 
 class NewEqubNotification(Notification):
+
     @classmethod
     def notify(cls, equb):
         if not equb.is_private:
-            for friend in equb.creator.friends.all():
-                cls.objects.create(equb=equb, receiver=friend)
+            cls.fan_out(equb.creator.friends.all(), equb=equb)
 
 class NewPaymentConfirmationRequestNotification(Notification):
     @classmethod
     def notify(cls, payment_confirmation_request):
-        cls.objects.create(
-            equb=payment_confirmation_request.equb, 
-            receiver=payment_confirmation_request.receiver
-        )
+        cls.fan_out([payment_confirmation_request.receiver], equb=payment_confirmation_request.equb)
 
 
 class OutBidNotification(Notification):
@@ -574,10 +1074,8 @@ class OutBidNotification(Notification):
 
     @classmethod
     def notify(cls, equb, previous_highest_bid, new_highest_bid):
-        for member in equb.members.all():
-            cls.objects.create(
-                equb=equb, previous_highest_bid=previous_highest_bid, 
-                new_highest_bid=new_highest_bid, receiver=member, 
-                round=equb.balance_manager.finished_rounds + 1
-            )
+        cls.fan_out(
+            equb.members.all(), equb=equb, previous_highest_bid=previous_highest_bid, 
+            new_highest_bid=new_highest_bid, round=equb.balance_manager.finished_rounds + 1
+        )
 
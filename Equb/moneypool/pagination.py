@@ -0,0 +1,41 @@
+from rest_framework.pagination import CursorPagination
+
+
+class UserSearchPagination(CursorPagination):
+    """
+    pages through user search results by rank without counting the matches
+    """
+    page_size = 5
+    ordering = ('-rank', 'id')
+
+
+class EqubCursorPagination(CursorPagination):
+    """
+    pages through equbs from the most recently created
+    """
+    page_size = 10
+    ordering = '-creation_date'
+
+
+class RequestCursorPagination(CursorPagination):
+    """
+    pages through requests from the most recently created
+    """
+    page_size = 10
+    ordering = '-creation_date'
+
+
+class UserCursorPagination(CursorPagination):
+    """
+    pages through users from the most recently joined
+    """
+    page_size = 10
+    ordering = '-date_joined'
+
+
+class BidCursorPagination(CursorPagination):
+    """
+    pages through bids from the most recently placed
+    """
+    page_size = 10
+    ordering = '-date'
@@ -1,9 +1,61 @@
+from django.contrib.auth.backends import BaseBackend
 from rest_framework import permissions
 
 
+class OwnershipPermissions(permissions.DjangoObjectPermissions):
+    """
+    DjangoObjectPermissions whose only model level requirement is authentication,
+    since OwnershipPermissionBackend only grants permissions on owned objects
+    """
+
+    def has_permission(self, request, view):
+        return bool(request.user and request.user.is_authenticated)
+
+
 class AuthenticatedAndObjectPermissionMixin(object):
     def get_permissions(self):
         if self.request.method in ['GET', 'POST']:
             return [permissions.IsAuthenticated()]
         else:
-            return [permissions.DjangoObjectPermissions()]
\ No newline at end of file
+            return [OwnershipPermissions()]
+
+
+# field holding the user who may change an object of each model; None means the object is the user
+OWNER_FIELDS = {
+    'user': None,
+    'equb': 'creator',
+    'paymentmethod': 'user',
+    'friendrequest': 'receiver',
+    'equbjoinrequest': 'receiver',
+    'equbinviterequest': 'receiver',
+    'paymentconfirmationrequest': 'receiver',
+    'newroundnotification': 'receiver',
+    'newmembernotification': 'receiver',
+    'newequbnotification': 'receiver',
+    'newpaymentconfirmationrequestnotification': 'receiver',
+    'outbidnotification': 'receiver',
+}
+
+
+class OwnershipPermissionBackend(BaseBackend):
+    """
+    Grants the change permission of an object to the user who owns it.
+    Ownership is derived from the fields in OWNER_FIELDS, so no permission
+    rows are stored when objects are created.
+    """
+
+    def has_perm(self, user_obj, perm, obj=None):
+        if not user_obj.is_active or user_obj.is_anonymous:
+            return False
+        app_label, _, codename = perm.rpartition('.')
+        if app_label not in ('', 'moneypool') or not codename.startswith('change_'):
+            return False
+        model_name = codename[len('change_'):]
+        if model_name not in OWNER_FIELDS:
+            return False
+        if obj is None or obj._meta.model_name != model_name:
+            # owning an object grants no permission on its whole model, which the admin checks
+            return False
+        owner_field = OWNER_FIELDS[model_name]
+        owner_id = obj.pk if owner_field is None else getattr(obj, f'{owner_field}_id')
+        return owner_id is not None and owner_id == user_obj.pk
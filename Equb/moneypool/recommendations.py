@@ -0,0 +1,38 @@
+from django.db.models import Q, F, Count, Exists, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import *
+
+# the number of equbs recommended to a user at a time
+RECOMMENDATION_LIMIT = 50
+
+
+def discoverable_equbs(user):
+    """
+    returns the public equbs that are still open to new members and were created
+    by a friend of user or by a friend of one of user's friends
+    """
+    friend_ids = Friendship.objects.filter(friend=user).values('user_id')
+    friend_of_friend_ids = MutualFriendship.objects.filter(user=user).values('other_id')
+    return Equb.objects.filter(
+        Q(creator__in=friend_ids) | Q(creator__in=friend_of_friend_ids),
+        is_private=False, is_active=False, is_completed=False,
+    )
+
+
+def ranked_recommendations(user):
+    """
+    returns the discoverable equbs that user hasn't joined, with equbs created by
+    friends first, then by the number of friends user shares with the creator
+    and then by the number of open spots
+    """
+    mutual_friends = MutualFriendship.objects.filter(user=user, other=OuterRef('creator')).values('mutual_friends')
+    return discoverable_equbs(user).exclude(members=user).annotate(
+        is_created_by_friend=Exists(Friendship.objects.filter(friend=user, user=OuterRef('creator'))),
+        creator_mutual_friends=Coalesce(Subquery(mutual_friends), 0),
+        open_spots=F('max_members') - Count('members'),
+    ).order_by('-is_created_by_friend', '-creator_mutual_friends', '-open_spots', '-creation_date')
+
+
+def recommended_equbs(user, limit=RECOMMENDATION_LIMIT):
+    return ranked_recommendations(user)[:limit]
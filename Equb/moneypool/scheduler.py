@@ -0,0 +1,195 @@
+from django.db import connections, transaction
+from django.db.models.functions import Mod
+from django.utils import timezone
+
+import datetime
+import heapq
+import logging
+import multiprocessing
+import time
+
+from .models import BalanceManager, RoundDeadline
+
+
+class RoundScheduler:
+    """
+    Selects the winners of equb rounds when their deadlines are due.
+
+    Deadlines are kept in a heap ordered by due time so that the scheduler can
+    sleep until exactly the next one. The RoundDeadline table is polled for rows
+    changed since the last poll and for rows that are already due, which are
+    two indexed queries, and all the deadlines that are due together are
+    handled as one batch. A deadline that can't be processed is moved
+    retry_delay seconds later.
+
+    Several schedulers can share the deadlines by giving each of them a shard
+    out of shards, in which case a scheduler only handles the equbs whose id
+    falls in its shard.
+    """
+
+    def __init__(self, batch_size=100, poll_interval=5.0, retry_delay=30.0, clock=timezone.now, sleep=time.sleep,
+                 shard=0, shards=1):
+        self.batch_size = batch_size
+        self.shard = shard
+        self.shards = shards
+        self.poll_interval = poll_interval
+        self.retry_delay = datetime.timedelta(seconds=retry_delay)
+        self.clock = clock
+        self.sleep = sleep
+        self.heap = []  # (due_at, equb_id, round)
+        self.deadlines = {}  # equb_id: (due_at, round) of the latest known deadline
+        self.loaded_until = None
+
+    def queryset(self):
+        queryset = RoundDeadline.objects.all()
+        if self.shards > 1:
+            queryset = queryset.alias(shard=Mod('equb_id', self.shards)).filter(shard=self.shard)
+        return queryset
+
+    def load(self):
+        """
+        adds the deadlines created or moved since the last load to the heap,
+        along with every deadline that is already due. A row saved by a
+        transaction that committed after the last load is missed by the first
+        query, whatever its updated_at, but is read by the second once it is due.
+        """
+        now = self.clock()
+        if self.loaded_until is None:
+            querysets = [self.queryset()]
+        else:
+            querysets = [
+                self.queryset().filter(updated_at__gte=self.loaded_until - datetime.timedelta(seconds=self.poll_interval)),
+                self.queryset().filter(due_at__lte=now),
+            ]
+        for queryset in querysets:
+            for equb_id, round, due_at in queryset.values_list('equb_id', 'round', 'due_at'):
+                self.push(equb_id, round, due_at)
+        self.loaded_until = now
+
+    def push(self, equb_id, round, due_at):
+        if self.deadlines.get(equb_id) == (due_at, round):
+            return
+        self.deadlines[equb_id] = (due_at, round)
+        heapq.heappush(self.heap, (due_at, equb_id, round))
+
+    def pop_due(self, now):
+        """
+        removes and returns up to batch_size deadlines that are due, skipping heap
+        entries that were replaced by a later deadline of the same equb
+        """
+        due = []
+        while self.heap and self.heap[0][0] <= now and len(due) < self.batch_size:
+            due_at, equb_id, round = heapq.heappop(self.heap)
+            if self.deadlines.get(equb_id) != (due_at, round):
+                continue
+            del self.deadlines[equb_id]
+            due.append((equb_id, round, due_at))
+        return due
+
+    def process(self, due):
+        """
+        selects the winner of every due round that is still current
+        """
+        deadlines = RoundDeadline.objects.filter(
+            equb_id__in=[equb_id for equb_id, round, due_at in due]
+        ).select_related('equb')
+        expected = {equb_id: (round, due_at) for equb_id, round, due_at in due}
+        processed = 0
+        for deadline in deadlines:
+            if expected[deadline.equb_id] != (deadline.round, deadline.due_at):
+                continue  # moved since it was loaded and will be loaded again
+            try:
+                selected = self.select_winner(deadline)
+            except Exception:
+                logging.exception(f'could not select the winner of {deadline}')
+                selected = None
+            if selected is None:
+                self.postpone(deadline)
+            elif selected:
+                processed += 1
+        return processed
+
+    def postpone(self, deadline):
+        """
+        moves a deadline that couldn't be processed to its next attempt, so that
+        polls for due deadlines leave it out until then
+        """
+        retry_at = self.clock() + self.retry_delay
+        try:
+            moved = RoundDeadline.objects.filter(
+                pk=deadline.pk, round=deadline.round, due_at=deadline.due_at
+            ).update(due_at=retry_at, updated_at=timezone.now())
+        except Exception:
+            logging.exception(f'could not postpone {deadline}')
+            moved = True
+        if moved:
+            self.push(deadline.equb_id, deadline.round, retry_at)
+
+    def select_winner(self, deadline):
+        """
+        selects the winner of the deadline's round. Returns None without waiting
+        if the equb's balance manager is locked by another worker.
+        """
+        with transaction.atomic():
+            balance_manager = BalanceManager.objects.select_for_update(skip_locked=True).filter(
+                equb_id=deadline.equb_id
+            ).first()
+            if balance_manager is None:
+                return None
+            deleted, _ = RoundDeadline.objects.filter(
+                pk=deadline.pk, round=deadline.round, due_at=deadline.due_at
+            ).delete()
+            if not deleted:
+                return False  # already handled by another scheduler
+            equb = deadline.equb
+            balance_manager.equb = equb
+            if equb.is_in_payment_stage or balance_manager.current_round() != deadline.round:
+                return False
+            balance_manager.select_winner()
+            return True
+
+    def run_once(self):
+        """
+        loads new deadlines, processes the due ones and returns the number of
+        seconds to wait before the next run
+        """
+        self.load()
+        now = self.clock()
+        due = self.pop_due(now)
+        while due:
+            self.process(due)
+            due = self.pop_due(now)
+
+        wait = self.poll_interval
+        if self.heap:
+            wait = min(wait, (self.heap[0][0] - self.clock()).total_seconds())
+        return max(wait, 0)
+
+    def run(self):
+        while True:
+            self.sleep(self.run_once())
+
+
+def run_shard(shard, shards, **options):
+    RoundScheduler(shard=shard, shards=shards, **options).run()
+
+
+def run_workers(workers, **options):
+    """
+    runs one scheduler process per shard until they exit or are interrupted
+    """
+    connections.close_all()  # each process must open its own database connections
+    context = multiprocessing.get_context('fork')
+    processes = [
+        context.Process(target=run_shard, args=(shard, workers), kwargs=options, name=f'round-scheduler-{shard}')
+        for shard in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
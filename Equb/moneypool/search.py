@@ -0,0 +1,30 @@
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db.models import Q, Case, When, Value, FloatField
+from django.db.models.functions import Greatest
+
+from .models import User
+
+# fields matched by user search, each backed by a trigram index and a prefix index
+USER_SEARCH_FIELDS = ['username', 'first_name', 'last_name']
+
+# queries shorter than this have too few trigrams to use the trigram indexes,
+# so they are only matched against the start of each field
+MIN_TRIGRAM_QUERY_LENGTH = 3
+
+
+def search_users(name):
+    """
+    returns users whose username, first name or last name contains name, annotated
+    with a relevance rank. Users with a field starting with name are ranked first,
+    followed by the trigram similarity of their closest field.
+    """
+    lookup = 'icontains' if len(name) >= MIN_TRIGRAM_QUERY_LENGTH else 'istartswith'
+    matches = Q()
+    prefix_matches = Q()
+    for field in USER_SEARCH_FIELDS:
+        matches |= Q(**{f'{field}__{lookup}': name})
+        prefix_matches |= Q(**{f'{field}__istartswith': name})
+
+    prefix_rank = Case(When(prefix_matches, then=Value(1.0)), default=Value(0.0), output_field=FloatField())
+    similarity = Greatest(*[TrigramSimilarity(field, name) for field in USER_SEARCH_FIELDS])
+    return User.objects.filter(matches).annotate(rank=prefix_rank + similarity)
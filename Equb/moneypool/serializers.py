@@ -7,6 +7,37 @@ from django.contrib.auth.password_validation import validate_password
 from django.core.files.base import ContentFile
 
 from .models import *
+from .snapshots import EqubSnapshotBatch, EXPANDABLE_USER_FIELDS
+from .auction import live_highest_bids
+from .cache import cached_equb_representations
+
+
+class SparseFieldsMixin:
+    """
+    limits the representation of the requested resource to the fields named in the
+    comma separated ?fields= parameter and leaves out those named in ?omit=, e.g.
+    ?fields=id,name,percent_completed. Left out fields, including method fields,
+    are never computed. Serializers of embedded resources are not affected.
+    """
+
+    def is_top_level(self):
+        """
+        tells whether the serializer gives the view's own resource, the only one the parameters apply to
+        """
+        request = self.context.get('request')
+        view = self.context.get('view')
+        return request is not None and request.method == 'GET' and view is not None and type(self) is view.get_serializer_class()
+
+    def get_fields(self):
+        fields = super().get_fields()
+        if not self.is_top_level():
+            return fields
+        request = self.context.get('request')
+        selected = [field for field in request.GET.get('fields', '').split(',') if field in fields]
+        omitted = set(request.GET.get('omit', '').split(','))
+        if selected:
+            fields = {name: fields[name] for name in selected}
+        return {name: field for name, field in fields.items() if name not in omitted}
 
 
 class RegisterUserSerializer(serializers.ModelSerializer):
@@ -69,7 +100,7 @@ class FriendshipSerializer(serializers.HyperlinkedModelSerializer):
         model = Friendship
         fields = ['id', 'url', 'friend']
 
-class PaymentMethodSerializer(serializers.HyperlinkedModelSerializer):
+class PaymentMethodSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     def validate(self, attrs):
         user = self.context.get('request').user
         service = attrs.get('service')
@@ -85,15 +116,40 @@ class PaymentMethodSerializer(serializers.HyperlinkedModelSerializer):
         fields = ['id', 'url', 'user', 'service', 'detail']
         read_only_fields = ['id', 'user']
 
-class ListUserSerializer(serializers.HyperlinkedModelSerializer):
+def user_expansions(context):
+    """
+    returns the relations of users expanded in a response: those named in the comma
+    separated ?expand= parameter, e.g. ?expand=friends,selected_payment_methods,
+    and those the view expands by default
+    """
+    expansions = set(context.get('expand_users', ()))
+    request = context.get('request')
+    if request is not None:
+        expansions.update(request.GET.get('expand', '').split(','))
+    return [field for field in EXPANDABLE_USER_FIELDS if field in expansions]
+
+
+class ListUserSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
+    """
+    compact representation of a user, as embedded in other resources. Relations
+    are only serialized when expanded, and must then be prefetched by the view.
+    """
     selected_payment_methods = PaymentMethodSerializer(many=True, read_only=True)
     joined_equbs = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
     friends = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
     class Meta:
         model = User
-        fields = ['id', 'url', 'username', 'first_name', 'last_name', 'friends', 'score', 'selected_payment_methods', 'joined_equbs', 'profile_picture']  # TODO: remove friends from list
+        fields = ['id', 'url', 'username', 'first_name', 'last_name', 'friends', 'score', 'selected_payment_methods', 'joined_equbs', 'profile_picture']
         read_only_fields = ['first_name', 'last_name', 'friends', 'score', 'joined_equbs']
 
+    def get_fields(self):
+        fields = super().get_fields()
+        expansions = user_expansions(self.context)
+        for field in EXPANDABLE_USER_FIELDS:
+            if field not in expansions:
+                fields.pop(field)
+        return fields
+
 
 class EditUserSerializer(serializers.HyperlinkedModelSerializer):
     selected_payment_methods = PaymentMethodSerializer(many=True, read_only=True)
@@ -104,7 +160,27 @@ class EditUserSerializer(serializers.HyperlinkedModelSerializer):
         model = User
         fields = ['id', 'url', 'username', 'first_name', 'last_name', 'email', 'bank_account', 'profile_picture', 'score', 'selected_payment_methods', 'friends', 'joined_equbs']
         read_only_fields = ['id', 'username', 'score', 'selected_payment_methods', 'friends', 'joined_equbs']
-class EqubSerializer(serializers.ModelSerializer):
+
+
+class EqubListSerializer(serializers.ListSerializer):
+    """
+    serializes a page of equbs from a single EqubSnapshotBatch so that the
+    number of queries stays the same regardless of how many equbs are listed
+    """
+
+    def to_representation(self, data):
+        equbs = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        request = self.context.get('request')
+        if self.parent is None and request is not None and request.method == 'GET':
+            return cached_equb_representations(equbs, request, self.serialize, self.child.cache_shape())
+        return [representation for representation, next_round_time in self.serialize(equbs)]
+
+    def serialize(self, equbs):
+        self.context['equb_snapshots'] = EqubSnapshotBatch(equbs, user_expansions(self.context))
+        return self.child.serialize(equbs)
+
+
+class EqubSerializer(SparseFieldsMixin, serializers.ModelSerializer):
 
     def validate(self, attrs):
         max_members = attrs.get('max_members')
@@ -138,77 +214,116 @@ class EqubSerializer(serializers.ModelSerializer):
     payment_collection_dates = serializers.SerializerMethodField(method_name='get_payment_collection_dates')
     is_created_by_user = serializers.SerializerMethodField(method_name='get_is_created_by_user')
 
+    def to_representation(self, instance):
+        request = self.context.get('request')
+        if self.parent is None and request is not None and request.method == 'GET':
+            return cached_equb_representations([instance], request, self.serialize, self.cache_shape())[0]
+        return self.serialize([instance])[0][0]
+
+    def cache_shape(self):
+        """
+        describes what the representations depend on besides the equb and the user:
+        the fields left by SparseFieldsMixin, whether the equb is embedded in another
+        resource and the expanded user relations
+        """
+        return ':'.join([
+            ','.join(self.fields), 'top' if self.is_top_level() else 'nested', ','.join(user_expansions(self.context)),
+        ])
+
+    def serialize(self, equbs):
+        """
+        returns the representation and next round time of each equb
+        """
+        serialized = []
+        fields = set(self.fields)
+        for equb in equbs:
+            snapshot = self.get_snapshot(equb)
+            if fields & {'members', 'creator'}:
+                snapshot.batch.users  # members and creator are serialized from the prefetched users
+            next_round_time = snapshot.next_round_time() if 'time_left_till_next_round' in fields else None
+            serialized.append((super().to_representation(equb), next_round_time))
+        return serialized
+
+    def get_snapshot(self, equb):
+        """
+        returns the snapshot of equb from the batch built by EqubListSerializer
+        or, when serializing a single equb, from a batch of its own
+        """
+        batch = self.context.get('equb_snapshots')
+        if batch is None or equb not in batch:
+            if getattr(self, '_snapshot_batch', None) is None or equb not in self._snapshot_batch:
+                self._snapshot_batch = EqubSnapshotBatch([equb], user_expansions(self.context))
+            batch = self._snapshot_batch
+        return batch.snapshot(equb)
+
     def get_is_created_by_user(self, equb):
         return self.context.get('request').user == equb.creator
     
     def get_payment_collection_dates(self, equb):
-        return equb.balance_manager.payment_collection_dates()
+        return self.get_snapshot(equb).payment_collection_dates()
 
     def get_current_user_is_member(self, equb):
-        return self.context.get('request').user in equb.members.all()
+        return self.context.get('request').user in self.get_snapshot(equb).members
     
     def get_rejected_payers(self, equb):
-        return ListUserSerializer(equb.balance_manager.rejected_payers(), many=True, context=self.context).data
+        return ListUserSerializer(self.get_snapshot(equb).rejected_payers(), many=True, context=self.context).data
     
     def get_unconfirmed_payers(self, equb):
-        return ListUserSerializer(equb.balance_manager.unconfirmed_payers(), many=True, context=self.context).data
+        return ListUserSerializer(self.get_snapshot(equb).unconfirmed_payers(), many=True, context=self.context).data
            
     def get_confirmed_payers(self, equb):
-        return ListUserSerializer(equb.balance_manager.confirmed_payers(), many=True, context=self.context).data
+        return ListUserSerializer(self.get_snapshot(equb).confirmed_payers(), many=True, context=self.context).data
     
     def get_unpaid_members(self, equb):
-        return ListUserSerializer(equb.balance_manager.unpaid_members(), many=True, context=self.context).data
+        return ListUserSerializer(self.get_snapshot(equb).unpaid_members(), many=True, context=self.context).data
     
     def get_time_left_till_next_round(self, equb):
-        return equb.balance_manager.time_left_till_next_round()
+        return self.get_snapshot(equb).time_left_till_next_round()
 
     def get_current_round(self, equb):
-        return equb.balance_manager.current_round()
+        return self.get_snapshot(equb).current_round()
     
     def get_current_award(self, equb):
-        balace_manager = equb.balance_manager
-        return balace_manager.calculate_winners_award(balace_manager.current_round())
+        return self.get_snapshot(equb).current_award()
     
     def get_current_highest_bid(self, equb):
-        highest_bid = HighestBid.objects.get(equb=equb, round=equb.balance_manager.current_round()).bid
-        if highest_bid:
-            return highest_bid.amount
-        return 0
+        return self.get_snapshot(equb).current_highest_bid()
     
     def get_current_highest_bidder(self, equb):
-        highest_bid = HighestBid.objects.get(equb=equb, round=equb.balance_manager.current_round()).bid
-        if highest_bid:
-            return ListUserSerializer(highest_bid.user, context=self.context).data
+        highest_bidder = self.get_snapshot(equb).current_highest_bidder()
+        if highest_bidder:
+            return ListUserSerializer(highest_bidder, context=self.context).data
         else:
             return None
     
     def get_percent_joined(self, equb):
-        return equb.balance_manager.percent_joined()
+        return self.get_snapshot(equb).percent_joined()
     
     def get_percent_completed(self, equb):
-        return equb.balance_manager.percent_completed()
+        return self.get_snapshot(equb).percent_completed()
     
     def get_is_won_by_user(self, equb):
-        return equb.balance_manager.check_received(self.context.get('request').user)
+        return self.get_snapshot(equb).check_received(self.context.get('request').user)
     
     def get_user_payment_status(self, equb):
         user = self.context.get('request').user
-        current_winner = equb.balance_manager.latest_winner()
+        snapshot = self.get_snapshot(equb)
+        current_winner = snapshot.latest_winner()
         
         if user == current_winner:
             return 'winner'
-        elif user in equb.balance_manager.confirmed_payers():
+        elif user in snapshot.confirmed_payers():
             return 'confirmed'
-        elif user in equb.balance_manager.unconfirmed_payers():
+        elif user in snapshot.unconfirmed_payers():
             return 'unconfirmed'
-        elif user in equb.balance_manager.rejected_payers():
+        elif user in snapshot.rejected_payers():
             return 'rejected'
         else:
             return 'unpaid'
 
     
     def get_latest_winner(self, equb):
-        latest_winner = equb.balance_manager.latest_winner()
+        latest_winner = self.get_snapshot(equb).latest_winner()
         if latest_winner:
             return ListUserSerializer(latest_winner, context=self.context).data
         return None
@@ -223,9 +338,62 @@ class EqubSerializer(serializers.ModelSerializer):
             'confirmed_payers', 'unconfirmed_payers', 'unpaid_members', 'rejected_payers', 'current_user_is_member', 'payment_collection_dates', 'is_created_by_user'
         ]
         read_only_fields = ['id', 'creator', 'members', 'is_active', 'is_completed', 'creation_date', 'end_date', 'is_in_payment_stage']
+        list_serializer_class = EqubListSerializer
+
+
+class EqubCardSerializer(serializers.ModelSerializer):
+    """
+    compact card of an equb read from the annotations of dashboard.equb_cards
+    """
+    member_count = serializers.IntegerField(read_only=True)
+    current_round = serializers.SerializerMethodField(method_name='get_current_round')
+    percent_joined = serializers.SerializerMethodField(method_name='get_percent_joined')
+    percent_completed = serializers.SerializerMethodField(method_name='get_percent_completed')
+    time_left_till_next_round = serializers.SerializerMethodField(method_name='get_time_left_till_next_round')
 
+    def get_current_round(self, equb):
+        return min(equb.finished_rounds + 1, equb.max_members)
 
-class BidSerializer(serializers.HyperlinkedModelSerializer):
+    def get_percent_joined(self, equb):
+        return round((equb.member_count / equb.max_members) * 100, 2)
+
+    def get_percent_completed(self, equb):
+        return round((equb.finished_rounds / equb.max_members) * 100, 2)
+
+    def get_time_left_till_next_round(self, equb):
+        return BalanceManager.time_left_until(equb.next_round_time)
+
+    class Meta:
+        model = Equb
+        fields = [
+            'id', 'url', 'name', 'amount', 'max_members', 'cycle', 'is_private', 'is_active', 'is_completed',
+            'is_in_payment_stage', 'member_count', 'current_round', 'percent_joined', 'percent_completed',
+            'time_left_till_next_round',
+        ]
+
+
+class DashboardCategorySerializer(serializers.Serializer):
+    count = serializers.IntegerField()
+    equbs = EqubCardSerializer(many=True)
+
+
+class BidListSerializer(serializers.ListSerializer):
+    """
+    reads the auction books of the latest round of every listed equb in one round trip
+    """
+
+    def to_representation(self, data):
+        bids = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        rounds = {}
+        for bid in bids:
+            rounds[bid.equb_id] = max(bid.round, rounds.get(bid.equb_id, 0))
+        self.context['live_bids'] = {
+            (equb_id, rounds[equb_id]): live_bid for equb_id, live_bid in live_highest_bids(rounds).items()
+        }
+        return super().to_representation(bids)
+
+
+class BidSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
 
     def validate(self, attrs):
         user = self.context.get('request').user
@@ -243,17 +411,34 @@ class BidSerializer(serializers.HyperlinkedModelSerializer):
             raise serializers.ValidationError({"equb": f"you cannot place a bid in {equb.name} because it is in the payment stage."})
         return attrs
     amount = serializers.DecimalField(max_digits=10, decimal_places=3, max_value=Decimal(1.000), min_value=Decimal(0.001))
+    is_highest = serializers.SerializerMethodField(method_name='get_is_highest')
+
+    def get_is_highest(self, bid):
+        placement = getattr(bid, 'placement', None)
+        if placement:
+            return placement.is_highest
+        # while its round is open, the highest bid is the top of the auction book
+        live_bids = self.context.get('live_bids')
+        if live_bids is None:
+            live_bids = {(bid.equb_id, bid.round): live_bid for live_bid in live_highest_bids({bid.equb_id: bid.round}).values()}
+        live_bid = live_bids.get((bid.equb_id, bid.round))
+        if live_bid:
+            return live_bid.bid_id == bid.id
+        return hasattr(bid, 'highestbid')
+
     class Meta:
         model = Bid
-        fields = ['id', 'url', 'equb', 'amount']
+        list_serializer_class = BidListSerializer
+        fields = ['id', 'url', 'equb', 'amount', 'is_highest']
         read_only_fields = ['user', 'date', 'round']
 
 
-class EqubJoinRequestSerializer(serializers.HyperlinkedModelSerializer):
+class EqubJoinRequestSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
 
     def to_representation(self, instance):
         response = super().to_representation(instance)
-        response['receiver'] = ListUserSerializer(instance.receiver, context=self.context).data
+        if 'receiver' in self.fields:
+            response['receiver'] = ListUserSerializer(instance.receiver, context=self.context).data
         return response
     
     def validate(self, attrs):
@@ -285,12 +470,35 @@ class AcceptEqubJoinRequestSerializer(serializers.HyperlinkedModelSerializer):
         read_only_fields = ['sender', 'receiver', 'equb', 'creation_date']
 
 
-class EqubInviteRequestSerializer(serializers.HyperlinkedModelSerializer):
+class EqubInviteRequestListSerializer(serializers.ListSerializer):
+    """
+    serializes the equbs of a page of invitations together so that the number
+    of queries stays the same regardless of how many invitations are listed
+    """
+
+    def to_representation(self, data):
+        invitations = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        if 'equb' not in self.child.fields:
+            return super().to_representation(invitations)
+        equbs = list({invitation.equb_id: invitation.equb for invitation in invitations}.values())
+        representations = EqubSerializer(equbs, many=True, context=dict(self.context)).data
+        self.context['equb_representations'] = {equb.id: data for equb, data in zip(equbs, representations)}
+        return super().to_representation(invitations)
+
+
+class EqubInviteRequestSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
 
     def to_representation(self, instance):
         response = super().to_representation(instance)
-        response['receiver'] = ListUserSerializer(instance.receiver, context=self.context).data
-        response['equb'] = EqubSerializer(instance.equb, context=self.context).data
+        if 'receiver' in self.fields:
+            response['receiver'] = ListUserSerializer(instance.receiver, context=self.context).data
+        if 'equb' not in self.fields:
+            return response
+        equb_representations = self.context.get('equb_representations', {})
+        if instance.equb_id in equb_representations:
+            response['equb'] = equb_representations[instance.equb_id]
+        else:
+            response['equb'] = EqubSerializer(instance.equb, context=self.context).data
         return response
     
     def validate(self, attrs):
@@ -315,6 +523,7 @@ class EqubInviteRequestSerializer(serializers.HyperlinkedModelSerializer):
         model = EqubInviteRequest
         fields = ['id', 'url', 'sender', 'receiver', 'equb', 'is_expired', 'creation_date', 'is_accepted', 'is_rejected']
         read_only_fields = ['sender', 'is_expired', 'creation_date', 'is_accepted', 'is_rejected']
+        list_serializer_class = EqubInviteRequestListSerializer
 
 
 class AcceptEqubInviteRequestSerializer(serializers.HyperlinkedModelSerializer):
@@ -331,11 +540,13 @@ class AcceptEqubInviteRequestSerializer(serializers.HyperlinkedModelSerializer):
         read_only_fields = ['sender', 'receiver', 'equb', 'creation_date']
 
 
-class FriendRequestSerializer(serializers.HyperlinkedModelSerializer):
+class FriendRequestSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     def to_representation(self, instance):
         response = super().to_representation(instance)
-        response['receiver'] = ListUserSerializer(instance.receiver, context=self.context).data
-        response['sender'] = ListUserSerializer(instance.sender, context=self.context).data
+        if 'receiver' in self.fields:
+            response['receiver'] = ListUserSerializer(instance.receiver, context=self.context).data
+        if 'sender' in self.fields:
+            response['sender'] = ListUserSerializer(instance.sender, context=self.context).data
         return response
     
     def validate(self, attrs):
@@ -380,13 +591,14 @@ class AddressPaymentConfirmationRequestSerializer(serializers.HyperlinkedModelSe
             raise serializers.ValidationError({"is_accepted": "You cannot accept and reject a payment request."})
         return attrs
 
-class ListPaymentConfirmationRequestSerializer(serializers.HyperlinkedModelSerializer):
+class ListPaymentConfirmationRequestSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
 
     sender = ListUserSerializer(read_only=True)
 
     def to_representation(self, instance):
         response = super().to_representation(instance)
-        response['payment_method'] = PaymentMethodSerializer(instance.payment_method, context=self.context).data
+        if 'payment_method' in self.fields:
+            response['payment_method'] = PaymentMethodSerializer(instance.payment_method, context=self.context).data
         return response
 
     class Meta:
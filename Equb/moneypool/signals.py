@@ -1,8 +1,9 @@
-from django.db.models.signals import post_save, pre_save, m2m_changed
+from django.db.models.signals import post_save, pre_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver, Signal
 from django.conf import settings
 from django.utils import timezone
 import datetime
+import logging
 
 from django.core.mail import EmailMultiAlternatives
 from django.template.loader import render_to_string
@@ -10,34 +11,41 @@ from django.urls import reverse
 
 from django_rest_passwordreset.signals import reset_password_token_created
 
-from guardian.shortcuts import assign_perm
-
 from .models import *
-from .tasks import select_winner_task
+from .cache import invalidate_equb, invalidate_user
+from .auction import AuctionBook, AuctionBookUnavailable, AUCTION_BOOK_GRACE_SECONDS
+from .consumers import broadcast_equb_event, countdown_data
 
 @receiver(signal=post_save, sender=User)
 def new_user(sender, instance, created, **kwargs):
     user = instance
 
-    # assigning permissions to edit user
-    if created and user.username != settings.ANONYMOUS_USER_NAME:
-        # allowing user to make changes to self
-        assign_perm("moneypool.change_user", user)
-        assign_perm("change_user", user, user)
-
     # creating a default payment method for user to be cash
     if created:
         PaymentMethod.objects.create(user=user, service=ServiceChoices.CASH)
 
+@receiver(signal=m2m_changed, sender=User.friends.through)
+def friendship_changed_action(sender, instance, action, pk_set, **kwargs):
+    user = instance
+    if action == 'post_add':
+        MutualFriendship.record_friendships(user, pk_set, 1)
+    elif action == 'post_remove':
+        MutualFriendship.record_friendships(user, pk_set, -1)
+    elif action == 'pre_clear':
+        MutualFriendship.record_friendships(user, user.friends.values_list('id', flat=True), -1)
+
+@receiver(signal=pre_delete, sender=User)
+def deleted_user_friendships_action(sender, instance, **kwargs):
+    user = instance
+    # friendships of a deleted user are removed by cascade, which doesn't send m2m_changed
+    MutualFriendship.record_friendships(user, user.friends.values_list('id', flat=True), -1)
+
 @receiver(signal=post_save, sender=Equb)
 def set_creator_membership(sender, instance, created, **kwargs):
     equb = instance
     if created:
         # including creator as a member
         equb.members.add(equb.creator)
-        # allowing creator to make changes to equb
-        assign_perm("moneypool.change_equb", equb.creator)
-        assign_perm("change_equb", equb.creator, equb)
 
 
 @receiver(signal=post_save, sender=Equb)
@@ -46,7 +54,7 @@ def new_equb_action(sender, instance, created, **kwargs):
     if created:
         BalanceManager.objects.create(equb=equb)
         HighestBid.objects.create(equb=equb, round=1)
-        NewEqubNotification.notify(equb=equb)
+        RoundState.setup(equb, 1)
 
 @receiver(signal=post_save, sender=PaymentConfirmationRequest)
 def new_payment_confirmation_request_action(sender, instance, created, **kwargs):
@@ -54,77 +62,188 @@ def new_payment_confirmation_request_action(sender, instance, created, **kwargs)
     if created:       
         NewPaymentConfirmationRequestNotification.notify(payment_confirmation_request=payment_confirmation_request)
 
+@receiver(signal=post_save, sender=PaymentConfirmationRequest)
+@receiver(signal=request_addressed_signal, sender=PaymentConfirmationRequest)
+def update_round_payments(sender, instance, **kwargs):
+    payment_confirmation_request = instance
+    RoundState.setup(payment_confirmation_request.equb, payment_confirmation_request.round).refresh_payments()
+
 @receiver(signal=m2m_changed, sender=Equb.members.through)
 def new_member_action(sender, instance, **kwargs):
     equb = instance
     if kwargs['action'] == 'post_add':
         new_member = equb.members.first()  # equb members are ordered by date_joined
         NewMemberNotification.notify(equb=equb, new_member=new_member)
+        broadcast_equb_event(equb.id, 'member.joined', {'member': new_member.id})
         if equb.members.count() == equb.max_members:
             equb.activate()
             equb.balance_manager.activate()
-            equb.balance_manager.current_round_start_date = datetime.datetime.now()
+            equb.balance_manager.current_round_start_date = timezone.now()
             equb.balance_manager.save()
-            select_winner_task(
-                equb.name, schedule=datetime.datetime.now() + equb.cycle
-            )
+            RoundDeadline.schedule(equb.balance_manager)
+            broadcast_equb_event(equb.id, 'countdown.sync', countdown_data(equb.balance_manager))
+
+@receiver(signal=m2m_changed, sender=Equb.members.through)
+def membership_access_action(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        pairs = [(instance.id, equb_id) for equb_id in pk_set or []]
+        filters = {'user': instance}
+    else:
+        pairs = [(member_id, instance.id) for member_id in pk_set or []]
+        filters = {'equb': instance}
+    if action == 'post_add':
+        EqubAccess.grant('is_member', pairs)
+    elif action == 'post_remove':
+        for user_id, equb_id in pairs:
+            EqubAccess.revoke('is_member', user_id=user_id, equb_id=equb_id)
+    elif action == 'post_clear':
+        EqubAccess.revoke('is_member', **filters)
+
+@receiver(signal=post_save, sender=EqubInviteRequest)
+def new_invitation_access_action(sender, instance, created, **kwargs):
+    invitation = instance
+    if created:
+        EqubAccess.grant('is_invited', [(invitation.receiver_id, invitation.equb_id)])
+
+@receiver(signal=post_delete, sender=EqubInviteRequest)
+def deleted_invitation_access_action(sender, instance, **kwargs):
+    invitation = instance
+    if not EqubInviteRequest.objects.filter(receiver_id=invitation.receiver_id, equb_id=invitation.equb_id).exists():
+        EqubAccess.revoke('is_invited', user_id=invitation.receiver_id, equb_id=invitation.equb_id)
 
 @receiver(signal=post_save, sender=Bid)
 def new_bid_action(sender, instance, created, **kwargs):
     bid = instance
-    if bid.is_highest_bid():
-        previous_highest_bid = HighestBid.objects.get(equb=bid.equb, round=bid.round).bid
-        OutBidNotification.notify(equb=bid.equb, previous_highest_bid=previous_highest_bid, new_highest_bid=bid)
-        bid.make_highest_bid()
+    if not created:
+        return
+    # the outcome is kept on the bid for the serializer of the request that placed it
+    bid.placement = None
+    book = AuctionBook.for_round(bid.equb_id, bid.round)
+    if book is not None:
+        try:
+            bid.placement = book.place(bid, timeout=int(bid.equb.cycle.total_seconds()) + AUCTION_BOOK_GRACE_SECONDS)
+        except AuctionBookUnavailable:
+            logging.exception(f'could not place bid {bid.id} in the auction book')
+    if bid.placement is None:
+        bid.placement = bid.place()
+    if bid.placement.is_highest:
+        OutBidNotification.notify(
+            equb=bid.equb, previous_highest_bid=bid.placement.previous_highest_bid, new_highest_bid=bid
+        )
+        broadcast_equb_event(bid.equb_id, 'bid.highest', {
+            'bid': bid.id, 'amount': str(bid.amount), 'user': bid.user_id, 'round': bid.round,
+        })
+
+
+@receiver(signal=round_closing_signal, sender=BalanceManager)
+def flush_auction_book_action(sender, instance, round, **kwargs):
+    book = AuctionBook.for_round(instance.equb_id, round)
+    if book is not None:
+        book.flush()
 
 
 @receiver(signal=new_round_signal, sender=BalanceManager)
 def new_round_action(sender, instance, equb, **kwargs):
-    balance_manager = instance
-    equb = balance_manager.equb
-    NewRoundNotification.notify(equb=equb)
-    HighestBid(equb=equb, round=balance_manager.finished_rounds + 1).save()
-    balance_manager.current_round_start_date = datetime.datetime.now()
-    balance_manager.save()
-    select_winner_task(equb.name, schedule=datetime.datetime.now() + equb.cycle)
-
-@receiver(signal=post_save, sender=EqubJoinRequest)
-def assign_equb_join_request_perm(sender, instance, created, **kwargs):
-    equb_request = instance
-    if created:
-        assign_perm('moneypool.change_equbjoinrequest', equb_request.receiver)
-        assign_perm('change_equbjoinrequest', equb_request.receiver, equb_request)
+    # sent after the new round is committed by BalanceManager.setup_next_round
+    broadcast_equb_event(equb.id, 'countdown.sync', countdown_data(instance))
 
+@receiver(signal=m2m_changed, sender=BalanceManager.wins.through)
+def new_win_action(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_add' and not reverse:
+        balance_manager = instance
+        for win in Win.objects.filter(pk__in=pk_set):
+            broadcast_equb_event(balance_manager.equb_id, 'round.winner', {'winner': win.user_id, 'round': win.round})
 
-@receiver(signal=post_save, sender=EqubInviteRequest)
-def assign_equb_invite_request_perm(sender, instance, created, **kwargs):
-    equb_request = instance
-    if created:
-        assign_perm('moneypool.change_equbinviterequest', equb_request.receiver)
-        assign_perm('change_equbinviterequest', equb_request.receiver, equb_request)
+@receiver(signal=request_addressed_signal, sender=PaymentConfirmationRequest)
+def payment_confirmed_action(sender, instance, **kwargs):
+    payment_confirmation_request = instance
+    if payment_confirmation_request.is_accepted:
+        broadcast_equb_event(payment_confirmation_request.equb_id, 'payment.confirmed', {
+            'sender': payment_confirmation_request.sender_id,
+            'round': payment_confirmation_request.round,
+        })
 
-@receiver(signal=post_save, sender=PaymentMethod)
-def assign_equb_join_request_perm(sender, instance, created, **kwargs):
-    payment_method = instance
-    if created:
-        assign_perm('moneypool.change_paymentmethod', payment_method.user)
-        assign_perm('change_paymentmethod', payment_method.user, payment_method)
+@receiver(signal=post_save, sender=Bid)
+@receiver(signal=post_save, sender=PaymentConfirmationRequest)
+@receiver(signal=request_addressed_signal, sender=PaymentConfirmationRequest)
+@receiver(signal=post_save, sender=BalanceManager)
+@receiver(signal=post_save, sender=RoundState)
+def invalidate_equb_cache(sender, instance, **kwargs):
+    invalidate_equb(instance.equb_id)
 
-@receiver(signal=post_save, sender=FriendRequest)
-def assign_friend_request_perm(sender, instance, created, **kwargs):
-    friend_request = instance
-    if created:
-        assign_perm('moneypool.change_friendrequest', friend_request.receiver)
-        assign_perm('change_friendrequest', friend_request.receiver, friend_request)
+@receiver(signal=post_save, sender=Equb)
+def invalidate_saved_equb_cache(sender, instance, **kwargs):
+    invalidate_equb(instance.id)
 
+@receiver(signal=m2m_changed, sender=Equb.members.through)
+def invalidate_membership_equb_cache(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        equb_ids = (pk_set or []) if reverse else [instance.id]
+        for equb_id in equb_ids:
+            invalidate_equb(equb_id)
 
-@receiver(signal=post_save, sender=PaymentConfirmationRequest)
-def assign_payment_confirmation_request_perm(sender, instance, created, **kwargs):
-    payment_confirmation_request = instance
+@receiver(signal=m2m_changed, sender=BalanceManager.wins.through)
+@receiver(signal=m2m_changed, sender=BalanceManager.received.through)
+def invalidate_win_equb_cache(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        if reverse:
+            for equb_id in BalanceManager.objects.filter(pk__in=pk_set or []).values_list('equb_id', flat=True):
+                invalidate_equb(equb_id)
+        else:
+            invalidate_equb(instance.equb_id)
+
+def invalidate_user_representations(user):
+    """
+    moves the user and the equbs it is embedded in as a member to new versions
+    """
+    invalidate_user(user.id)
+    for equb_id in user.joined_equbs.values_list('id', flat=True):
+        invalidate_equb(equb_id)
+
+@receiver(signal=post_save, sender=User)
+def invalidate_saved_user_cache(sender, instance, created, update_fields, **kwargs):
+    # logging in only updates last_login, which no representation shows
+    if update_fields and set(update_fields) <= {'last_login'}:
+        return
     if created:
-        assign_perm('moneypool.change_paymentconfirmationrequest', payment_confirmation_request.receiver)
-        assign_perm('change_paymentconfirmationrequest', payment_confirmation_request.receiver, payment_confirmation_request)
+        invalidate_user(instance.id)
+    else:
+        invalidate_user_representations(instance)
+
+@receiver(signal=pre_delete, sender=User)
+def invalidate_deleted_user_cache(sender, instance, **kwargs):
+    # friendships of a deleted user are removed by cascade, which doesn't send m2m_changed
+    for user_id in [instance.id] + list(instance.friends.values_list('id', flat=True)):
+        invalidate_user(user_id)
 
+@receiver(signal=post_save, sender=PaymentMethod)
+@receiver(signal=post_delete, sender=PaymentMethod)
+def invalidate_payment_method_user_cache(sender, instance, **kwargs):
+    invalidate_user_representations(instance.user)
+
+@receiver(signal=m2m_changed, sender=User.friends.through)
+def invalidate_friendship_user_cache(sender, instance, action, pk_set, **kwargs):
+    if action == 'pre_clear':
+        user_ids = list(instance.friends.values_list('id', flat=True))
+    elif action in ('post_add', 'post_remove'):
+        user_ids = list(pk_set or [])
+    else:
+        return
+    for user_id in [instance.id] + user_ids:
+        invalidate_user(user_id)
+
+@receiver(signal=m2m_changed, sender=Equb.members.through)
+def invalidate_membership_user_cache(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        user_ids = [instance.id] if action in ('post_add', 'post_remove', 'post_clear') else []
+    elif action == 'pre_clear':
+        user_ids = list(instance.members.values_list('id', flat=True))
+    elif action in ('post_add', 'post_remove'):
+        user_ids = list(pk_set or [])
+    else:
+        return
+    for user_id in user_ids:
+        invalidate_user(user_id)
 
 
 @receiver(reset_password_token_created)
@@ -138,7 +257,7 @@ def password_reset_token_created(sender, instance, reset_password_token, *args,
         'reset_password_url': f"https://equbfinance.com/#/password_reset/{reset_password_token.key}",
     }
 
-    print(context)
+    logging.debug(f'sending a password reset email to user {reset_password_token.user.id}')
 
     # render email text
     email_html_message = render_to_string('email/user_reset_password.html', context)
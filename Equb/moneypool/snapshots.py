@@ -0,0 +1,239 @@
+from collections import defaultdict
+
+from django.db.models import Prefetch, prefetch_related_objects
+from django.utils.functional import cached_property
+
+import decimal
+import pytz
+
+from .models import *
+from .auction import live_highest_bids
+
+# relations of a user that ListUserSerializer only serializes when they are expanded
+EXPANDABLE_USER_FIELDS = ['friends', 'joined_equbs', 'selected_payment_methods']
+
+
+class EqubSnapshotBatch:
+    """
+    Loads the state of a page of equbs with one batched query per relation.
+    Each relation is only loaded the first time a snapshot needs it, so the
+    number of queries does not depend on the number of equbs.
+    """
+
+    def __init__(self, equbs, user_prefetch=()):
+        self.equbs = {equb.id: equb for equb in equbs}
+        self.user_prefetch = user_prefetch
+        self._snapshots = {}
+
+    def __contains__(self, equb):
+        return equb.id in self.equbs
+
+    def snapshot(self, equb):
+        if equb.id not in self._snapshots:
+            self._snapshots[equb.id] = EqubSnapshot(self, self.equbs[equb.id])
+        return self._snapshots[equb.id]
+
+    @cached_property
+    def users(self):
+        """
+        prefetches the members and creator of every equb along with the expanded
+        relations serialized for each user
+        """
+        user_queryset = User.objects.prefetch_related(*self.user_prefetch)
+        prefetch_related_objects(
+            list(self.equbs.values()),
+            Prefetch('members', queryset=user_queryset),
+            Prefetch('creator', queryset=user_queryset),
+        )
+        return {
+            equb_id: {member.id: member for member in equb.members.all()}
+            for equb_id, equb in self.equbs.items()
+        }
+
+    @cached_property
+    def balance_managers(self):
+        balance_managers = {}
+        for balance_manager in BalanceManager.objects.filter(equb__in=self.equbs.keys()):
+            balance_manager.equb = self.equbs[balance_manager.equb_id]
+            balance_managers[balance_manager.equb_id] = balance_manager
+        return balance_managers
+
+    @cached_property
+    def received(self):
+        received = defaultdict(set)
+        equb_ids = {bm.id: bm.equb_id for bm in self.balance_managers.values()}
+        rows = BalanceManager.received.through.objects.filter(
+            balancemanager__in=equb_ids.keys()
+        ).values_list('balancemanager_id', 'user_id')
+        for balance_manager_id, user_id in rows:
+            received[equb_ids[balance_manager_id]].add(user_id)
+        return received
+
+    @cached_property
+    def wins(self):
+        """
+        wins of every equb ordered from the latest round
+        """
+        wins = defaultdict(list)
+        equb_ids = {bm.id: bm.equb_id for bm in self.balance_managers.values()}
+        rows = BalanceManager.wins.through.objects.filter(
+            balancemanager__in=equb_ids.keys()
+        ).select_related('win__user')
+        for row in rows:
+            wins[equb_ids[row.balancemanager_id]].append(row.win)
+        for equb_wins in wins.values():
+            equb_wins.sort(key=lambda win: win.round, reverse=True)
+        return wins
+
+    @cached_property
+    def live_bids(self):
+        """
+        highest bids in the auction books of the equbs whose rounds are open for bids
+        """
+        return live_highest_bids({
+            equb_id: balance_manager.current_round()
+            for equb_id, balance_manager in self.balance_managers.items()
+            if self.equbs[equb_id].is_active and not self.equbs[equb_id].is_in_payment_stage
+        })
+
+    @cached_property
+    def live_bidders(self):
+        """
+        users of the live bids, from the prefetched members or else loaded in one query
+        """
+        bidders = {}
+        for equb_id, live_bid in self.live_bids.items():
+            member = self.users[equb_id].get(live_bid.user_id)
+            if member is not None:
+                bidders[member.id] = member
+        missing = {live_bid.user_id for live_bid in self.live_bids.values()} - bidders.keys()
+        if missing:
+            bidders.update(User.objects.prefetch_related(*self.user_prefetch).in_bulk(missing))
+        return bidders
+
+    @cached_property
+    def round_states(self):
+        round_states = defaultdict(dict)
+        queryset = RoundState.objects.filter(equb__in=self.equbs.keys()).select_related('winner', 'highest_bidder')
+        for round_state in queryset:
+            round_states[round_state.equb_id][round_state.round] = round_state
+        return round_states
+
+
+class EqubSnapshot:
+    """
+    In-memory view of one equb's current round, mirroring the read methods of
+    BalanceManager without issuing queries of its own.
+    """
+
+    def __init__(self, batch, equb):
+        self.batch = batch
+        self.equb = equb
+
+    @property
+    def balance_manager(self):
+        return self.batch.balance_managers[self.equb.id]
+
+    @property
+    def members(self):
+        return list(self.batch.users[self.equb.id].values())
+
+    def _user(self, user):
+        """
+        returns the prefetched member instance for user, if there is one
+        """
+        if user is None:
+            return None
+        return self.batch.users[self.equb.id].get(user.id, user)
+
+    def current_round(self):
+        return self.balance_manager.current_round()
+
+    def percent_joined(self):
+        return round((len(self.members) / self.equb.max_members) * 100, 2)
+
+    def percent_completed(self):
+        return self.balance_manager.percent_completed()
+
+    def time_left_till_next_round(self):
+        return self.balance_manager.time_left_till_next_round()
+
+    def next_round_time(self):
+        return self.balance_manager.next_round_time()
+
+    def check_received(self, user):
+        return user.id in self.batch.received[self.equb.id]
+
+    def round_state(self):
+        return self.batch.round_states[self.equb.id].get(self.current_round())
+
+    def live_bid(self):
+        """
+        returns the highest bid of the current round's auction book if it is
+        higher than the one recorded in the round state
+        """
+        live_bid = self.batch.live_bids.get(self.equb.id)
+        round_state = self.round_state()
+        if live_bid and (round_state is None or live_bid.amount > round_state.highest_bid_amount):
+            return live_bid
+        return None
+
+    def current_highest_bid(self):
+        live_bid = self.live_bid()
+        if live_bid:
+            return live_bid.amount
+        round_state = self.round_state()
+        return (round_state.highest_bid_amount or 0) if round_state else 0
+
+    def current_highest_bidder(self):
+        live_bid = self.live_bid()
+        if live_bid:
+            return self.batch.live_bidders.get(live_bid.user_id)
+        round_state = self.round_state()
+        return self._user(round_state.highest_bidder) if round_state else None
+
+    def current_award(self):
+        live_bid = self.live_bid()
+        if live_bid:
+            return self.balance_manager.calculate_award_for_bid(live_bid.amount).quantize(decimal.Decimal('0.01'))
+        round_state = self.round_state()
+        if round_state:
+            return round_state.award
+        return self.balance_manager.calculate_award_for_bid(0)
+
+    def latest_winner(self):
+        for round, round_state in sorted(self.batch.round_states[self.equb.id].items(), reverse=True):
+            if round_state.winner:
+                return self._user(round_state.winner)
+        return None
+
+    def _payers(self, *statuses):
+        round_state = self.round_state()
+        if round_state is None:
+            return []
+        payer_ids = [payer_id for status in statuses for payer_id in getattr(round_state, f'{status}_payer_ids')]
+        users = self.batch.users[self.equb.id]
+        return [users[payer_id] for payer_id in payer_ids if payer_id in users]
+
+    def rejected_payers(self):
+        return self._payers('rejected')
+
+    def unconfirmed_payers(self):
+        return self._payers('unconfirmed')
+
+    def confirmed_payers(self):
+        return self._payers('confirmed')
+
+    def unpaid_members(self):
+        latest_winner = self.latest_winner()
+        requested = {payer.id for payer in self._payers('confirmed', 'unconfirmed')}
+        if latest_winner:
+            requested.add(latest_winner.id)
+        return [member for member in self.members if member.id not in requested]
+
+    def payment_collection_dates(self):
+        balance_manager = self.balance_manager
+        win_dates = [win.date for win in self.batch.wins[self.equb.id]]
+        if balance_manager.current_round_start_date and balance_manager.finished_rounds < self.equb.max_members:
+            win_dates.append(balance_manager.current_round_start_date.replace(tzinfo=pytz.UTC) + self.equb.cycle)
+        return win_dates
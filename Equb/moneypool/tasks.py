@@ -1,10 +0,0 @@
-from background_task import background
-from .models import Equb
-
-
-@background()
-def select_winner_task(equb_name):
-    equb = Equb.objects.get(name=equb_name)
-    equb.balance_manager.select_winner()
-    
-    
\ No newline at end of file
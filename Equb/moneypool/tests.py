@@ -2,16 +2,44 @@ import json
 
 from django.urls import reverse
 from django.test.client import RequestFactory
+from django.test import override_settings, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, DatabaseError
+from django.db.models import QuerySet
+from django.conf import settings
+from django.core import mail
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APITestCase
+from guardian.models import UserObjectPermission
 
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
+from unittest import mock
+import datetime
+import random
+import threading
+import unittest
+
+import redis
 
 from .serializers import *
 from .models import *
-from .tasks import select_winner_task
+from .cache import equb_cache
+from .scheduler import RoundScheduler
+from .expiry import expire_stale_requests
+from .consumers import equb_group_name
+from . import auction
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+# the test runner is the only process, so a local memory cache stands in for redis
+SHARED_CACHES = {**settings.CACHES, 'equbs': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+UNSHARED_CACHES = {**settings.CACHES, 'equbs': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+
 
+@override_settings(CACHES=SHARED_CACHES)
 class ActivateEqubTestCase(APITestCase):
     equb_list_url = reverse('equb-list')
     equb_join_request_list_url = reverse('equbinviterequest-list')
@@ -28,6 +56,7 @@ class ActivateEqubTestCase(APITestCase):
             self.users[idx] = user
             self.user_urls[idx] = Util.get_test_object_url('User', user)
 
+        equb_cache().clear()
         self.client.login(username='test_user_0', password='test_password_0')
 
     def tearDown(self):
@@ -40,6 +69,7 @@ class ActivateEqubTestCase(APITestCase):
         OutBidNotification.objects.all().delete()
         EqubInviteRequest.objects.all().delete()
         Win.objects.all().delete()
+        RoundState.objects.all().delete()
 
     def test_create_equb_authenticated(self):
         """
@@ -75,6 +105,13 @@ class ActivateEqubTestCase(APITestCase):
         # checking if balance manager is initialized because equb is active
         self.assertEqual(equb.balance_manager.finished_rounds, 0) 
 
+    def close_round(self, equb):
+        """
+        runs the round scheduler at the deadline of the equb's current round
+        """
+        due_at = RoundDeadline.objects.get(equb=equb).due_at
+        RoundScheduler(clock=lambda: due_at).run_once()
+
     def test_equb_bid(self):
         # calling test_create_equb_invite_authenticated to create equb and invite test_user_1
         self.test_create_equb_invite_authenticated()
@@ -101,9 +138,8 @@ class ActivateEqubTestCase(APITestCase):
         self.assertEqual(HighestBid.objects.get(equb=equb).bid.amount, Decimal('0.20'))
         self.assertEqual(OutBidNotification.objects.all().count(), 2 * equb.members.all().count())
 
-        # force background task to update winner account and make sure test_user_1 is the winner
-        # because test_user_1 outbid test_user_0
-        select_winner_task.now(equb.name)
+        # closing the round and making sure test_user_1 is the winner because test_user_1 outbid test_user_0
+        self.close_round(equb)
         equb = Equb.objects.get(name='test_equb')
         self.assertEqual(equb.balance_manager.received.all()[0].username, 'test_user_1')
         
@@ -118,7 +154,7 @@ class ActivateEqubTestCase(APITestCase):
         self.client.login(username='test_user_0', password='test_password_0')
         data = {'equb': Util.get_test_object_url('Equb', equb), 'amount': 0.9, 'round': 1}
         response = self.client.post(reverse('bid-list'), data)
-        select_winner_task.now(equb.name) # this will make user 0 the winner
+        self.close_round(equb)  # this will make user 0 the winner
 
         # sending a payment confirmation request from user_1 to user_0
         self.client.login(username='test_user_1', password='test_password_1')
@@ -135,7 +171,7 @@ class ActivateEqubTestCase(APITestCase):
         self.client.login(username='test_user_0', password='test_password_0')
         self.client.put(response.data['url'], {'is_accepted': True})
         
-        select_winner_task.now(equb.name) # this will make user_1 the winner
+        self.close_round(equb)  # this will make user_1 the winner
         
         # sending a payment confirmation request from user_0 to user_1
         selected_payment_method = PaymentMethod.objects.filter(user=self.users[0], service=ServiceChoices.CASH).first()
@@ -154,6 +190,773 @@ class ActivateEqubTestCase(APITestCase):
         self.assertEqual(equb.balance_manager.finished_rounds, 2)
         self.assertEqual(equb.is_completed, True)
 
+    def test_bid_placement(self):
+        """
+        Ensure a bid only replaces a lower highest bid and its outcome is returned.
+        """
+        self.test_create_equb_invite_authenticated()
+        equb = Equb.objects.get(name='test_equb')
+        equb_url = Util.get_test_object_url('Equb', equb)
+        response = self.client.post(reverse('bid-list'), {'equb': equb_url, 'amount': 0.3, 'round': 1})
+        self.assertTrue(response.data['is_highest'])
+        higher_bid = Bid.objects.get(pk=response.data['id'])
+
+        self.client.login(username='test_user_0', password='test_password_0')
+        response = self.client.post(reverse('bid-list'), {'equb': equb_url, 'amount': 0.2, 'round': 1})
+        self.assertFalse(response.data['is_highest'])
+
+        # a lower bid placed after a higher one is not placed
+        lower_bid = Bid.objects.bulk_create([Bid(equb=equb, user=self.users[0], round=1, amount=Decimal('0.25'))])[0]
+        self.assertEqual(lower_bid.place(), BidPlacement(is_highest=False, previous_highest_bid=higher_bid))
+        self.assertEqual(HighestBid.objects.get(equb=equb, round=1).bid, higher_bid)
+        RoundState.record_highest_bid(lower_bid)
+        self.assertEqual(RoundState.for_round(equb, 1).highest_bid_amount, Decimal('0.3'))
+
+        # nor is a bid that read the highest bid just before a higher bid replaced it
+        racing_bid, highest_bid = Bid.objects.bulk_create([
+            Bid(equb=equb, user=self.users[0], round=1, amount=Decimal('0.35')),
+            Bid(equb=equb, user=self.users[1], round=1, amount=Decimal('0.4')),
+        ])
+        get = QuerySet.get
+        outbidding = [highest_bid]
+
+        def get_then_outbid(queryset, *args, **kwargs):
+            instance = get(queryset, *args, **kwargs)
+            if queryset.model is HighestBid and outbidding:
+                outbidding.pop().place()
+            return instance
+
+        with mock.patch.object(QuerySet, 'get', autospec=True, side_effect=get_then_outbid):
+            self.assertEqual(racing_bid.place(), BidPlacement(is_highest=False, previous_highest_bid=highest_bid))
+        self.assertEqual(HighestBid.objects.get(equb=equb, round=1).bid, highest_bid)
+        self.assertEqual(RoundState.for_round(equb, 1).highest_bid_amount, Decimal('0.4'))
+        self.assertEqual(
+            [(bid['amount'], bid['is_highest']) for bid in self.client.get(reverse('bid-list')).data['results']],
+            [('0.400', True), ('0.350', False), ('0.250', False), ('0.200', False), ('0.300', False)]
+        )
+
+    def test_bid_rank(self):
+        """
+        Ensure the rank of a bidder is read from the database when there is no auction book.
+        """
+        self.test_create_equb_invite_authenticated()
+        equb = Equb.objects.get(name='test_equb')
+        equb_url = Util.get_test_object_url('Equb', equb)
+        self.client.post(reverse('bid-list'), {'equb': equb_url, 'amount': 0.3, 'round': 1})
+        self.client.login(username='test_user_0', password='test_password_0')
+        self.assertEqual(self.client.get(reverse('bid-rank'), {'equb': equb.id}).data, {'round': 1, 'rank': None, 'bidders': 1})
+
+        self.client.post(reverse('bid-list'), {'equb': equb_url, 'amount': 0.2, 'round': 1})
+        self.assertEqual(self.client.get(reverse('bid-rank'), {'equb': equb.id}).data, {'round': 1, 'rank': 2, 'bidders': 2})
+
+    def test_unavailable_auction_books_back_off(self):
+        """
+        Ensure bids fall back to the database without calling redis again for a while once it fails.
+        """
+        self.test_create_equb_invite_authenticated()
+        equb_url = Util.get_test_object_url('Equb', Equb.objects.get(name='test_equb'))
+        calls = []
+
+        class FailingClient:
+            def __getattr__(self, name):
+                def fail(*args, **kwargs):
+                    calls.append(name)
+                    raise redis.ConnectionError()
+                return fail
+
+        with mock.patch.object(auction, '_client', FailingClient()), mock.patch.object(auction, '_unavailable_until', 0.0):
+            for amount in (0.2, 0.3):
+                response = self.client.post(reverse('bid-list'), {'equb': equb_url, 'amount': amount, 'round': 1})
+                self.assertTrue(response.data['is_highest'])
+        self.assertEqual(calls, ['incr'])
+
+    def test_lost_auction_book_is_settled_from_saved_bids(self):
+        """
+        Ensure bids that only reached the auction book still win once the book is lost, and are shown highest while it is live.
+        """
+        self.test_create_equb_invite_authenticated()
+        equb = Equb.objects.get(name='test_equb')
+        equb_url = Util.get_test_object_url('Equb', equb)
+        live_placement = lambda bid, timeout: BidPlacement(is_highest=True, previous_highest_bid=None)
+        with mock.patch.object(auction, '_client', object()), \
+                mock.patch.object(auction.AuctionBook, 'place', side_effect=live_placement):
+            self.client.post(reverse('bid-list'), {'equb': equb_url, 'amount': 0.2, 'round': 1})
+            self.client.login(username='test_user_0', password='test_password_0')
+            self.client.post(reverse('bid-list'), {'equb': equb_url, 'amount': 0.3, 'round': 1})
+        self.assertIsNone(HighestBid.objects.get(equb=equb, round=1).bid)
+        highest_bid = Bid.objects.get(equb=equb, amount=Decimal('0.3'))
+
+        live_bid = auction.LiveBid(highest_bid.id, highest_bid.user_id, highest_bid.amount)
+        with mock.patch('moneypool.serializers.live_highest_bids', return_value={equb.id: live_bid}):
+            bids = self.client.get(reverse('bid-list')).data['results']
+            self.assertEqual([(bid['amount'], bid['is_highest']) for bid in bids], [('0.300', True), ('0.200', False)])
+            self.assertTrue(self.client.get(Util.get_test_object_url('Bid', highest_bid)).data['is_highest'])
+
+        # the book comes back empty, as it does after a redis restart or eviction
+        with mock.patch.object(auction, '_client', object()), \
+                mock.patch.object(auction.AuctionBook, 'highest', return_value=None), \
+                mock.patch.object(auction.AuctionBook, 'clear'):
+            self.close_round(equb)
+        self.assertEqual(HighestBid.objects.get(equb=equb, round=1).bid, highest_bid)
+        self.assertEqual(RoundState.objects.get(equb=equb, round=1).winner, self.users[0])
+
+    def test_round_state(self):
+        """
+        Ensure the round state follows bids, wins and payment confirmations.
+        """
+        self.test_equb_payment_request()
+        equb = Equb.objects.get(name='test_equb')
+        first_round, second_round = RoundState.objects.filter(equb=equb).order_by('round')
+        self.assertEqual(first_round.highest_bid_amount, Decimal('0.9'))
+        self.assertEqual(first_round.highest_bidder, self.users[0])
+        self.assertEqual(first_round.award, equb.balance_manager.calculate_award_for_bid(Decimal('0.9')).quantize(Decimal('0.01')))
+        self.assertEqual(first_round.winner, self.users[0])
+        self.assertEqual(first_round.confirmed_payer_ids, [self.users[1].id])
+        self.assertEqual(second_round.winner, self.users[1])
+        self.assertEqual(second_round.confirmed_count, 1)
+
+    def test_round_state_is_written_with_the_highest_bid(self):
+        """
+        Ensure reading a round's state writes nothing and the highest bid isn't swapped when its round state can't be written.
+        """
+        self.test_create_equb_invite_authenticated()
+        equb = Equb.objects.get(name='test_equb')
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(equb.balance_manager.rejected_payers(), [])
+            self.assertEqual(equb.balance_manager.calculate_winners_award(2), equb.balance_manager.calculate_winners_award(1))
+        self.assertTrue(all(query['sql'].startswith('SELECT') for query in context.captured_queries))
+        self.assertFalse(RoundState.objects.filter(equb=equb, round=2).exists())
+
+        bid = Bid.objects.bulk_create([Bid(equb=equb, user=self.users[0], round=1, amount=Decimal('0.4'))])[0]
+        with mock.patch.object(RoundState, 'record_highest_bid', side_effect=DatabaseError), self.assertRaises(DatabaseError):
+            bid.place()
+        self.assertIsNone(HighestBid.objects.get(equb=equb, round=1).bid)
+        self.assertEqual(RoundState.objects.get(equb=equb, round=1).highest_bid_amount, 0)
+
+        # the first highest bid of a round whose state is missing sets it up
+        RoundState.objects.filter(equb=equb, round=1).delete()
+        self.assertTrue(bid.place().is_highest)
+        self.assertEqual(RoundState.objects.get(equb=equb, round=1).highest_bid_amount, Decimal('0.4'))
+
+    def test_settle_round(self):
+        """
+        Ensure settling a round updates every balance and records it in the ledger.
+        """
+        self.test_create_equb_invite_authenticated()
+        equb = Equb.objects.get(name='test_equb')
+        self.client.login(username='test_user_0', password='test_password_0')
+        data = {'equb': Util.get_test_object_url('Equb', equb), 'amount': 0.5, 'round': 1}
+        self.client.post(reverse('bid-list'), data)
+
+        balance_manager = equb.balance_manager
+        balance_manager.update_winner_account()
+        balance_manager.update_winner_account()  # the round is already closed, so the winner isn't credited again
+        balance_manager.collect_money()
+
+        self.assertEqual(User.objects.get(pk=self.users[0].pk).bank_account, Decimal('125.00'))
+        self.assertEqual(User.objects.get(pk=self.users[1].pk).bank_account, Decimal('75.00'))
+        self.assertEqual(LedgerEntry.objects.filter(equb=equb, kind=LedgerEntry.CREDIT).count(), 1)
+        self.assertEqual(LedgerEntry.objects.filter(equb=equb, kind=LedgerEntry.DEBIT).count(), 2)
+
+        # recorded entries can be neither changed nor deleted, one at a time or in bulk
+        entry = LedgerEntry.objects.filter(equb=equb).first()
+        entry.amount = 0
+        entries = LedgerEntry.objects.filter(equb=equb)
+        for change in (
+            entry.save, entry.delete, entries.delete, lambda: entries.update(amount=0),
+            lambda: LedgerEntry.objects.bulk_update([entry], ['amount']),
+        ):
+            with self.assertRaises(LedgerEntryImmutable):
+                change()
+        self.assertEqual(LedgerEntry.objects.filter(equb=equb).exclude(amount=0).count(), 3)
+
+    def test_round_transition(self):
+        """
+        Ensure closing and advancing a round happen once each, in one transaction.
+        """
+        self.test_create_equb_invite_authenticated()
+        equb = Equb.objects.get(name='test_equb')
+        balance_manager = equb.balance_manager
+        channel_layer = get_channel_layer()
+        async_to_sync(channel_layer.group_add)(equb_group_name(equb.id), 'test-channel')
+
+        winner = balance_manager.select_winner()
+        self.assertIsNotNone(winner)
+        self.assertIsNone(balance_manager.select_winner())
+        self.assertEqual(balance_manager.wins.count(), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            balance_manager.setup_next_round()
+            balance_manager.setup_next_round()
+        balance_manager = BalanceManager.objects.get(pk=balance_manager.pk)
+        self.assertEqual(balance_manager.finished_rounds, 1)
+        self.assertFalse(balance_manager.equb.is_in_payment_stage)
+        self.assertTrue(HighestBid.objects.filter(equb=equb, round=2).exists())
+        self.assertTrue(RoundState.objects.filter(equb=equb, round=2).exists())
+        self.assertEqual(RoundDeadline.objects.get(equb=equb).round, 2)
+        self.assertEqual(NewRoundNotification.objects.filter(equb=equb, round=2).count(), equb.members.count())
+
+        message = async_to_sync(channel_layer.receive)('test-channel')
+        while message['event'] != 'countdown.sync':
+            message = async_to_sync(channel_layer.receive)('test-channel')
+        self.assertEqual(message['data']['round'], 2)
+        async_to_sync(channel_layer.flush)()
+
+    def test_request_transitions(self):
+        """
+        Ensure a request is addressed once with a single conditional update.
+        """
+        friend_request = FriendRequest.objects.create(sender=self.users[0], receiver=self.users[1])
+        concurrent_request = FriendRequest.objects.get(pk=friend_request.pk)
+
+        with CaptureQueriesContext(connection) as context:
+            self.assertTrue(friend_request.accept())
+        self.assertFalse(any(query['sql'].startswith('SELECT') and 'moneypool_friendrequest' in query['sql'] for query in context.captured_queries))
+        self.assertFalse(concurrent_request.reject())
+        self.assertFalse(friend_request.expire())
+
+        friend_request = FriendRequest.objects.get(pk=friend_request.pk)
+        self.assertTrue(friend_request.is_accepted)
+        self.assertFalse(friend_request.is_rejected)
+        self.assertEqual(list(self.users[1].friends.all()), [self.users[0]])
+        self.assertFalse(FriendRequest.pending().filter(pk=friend_request.pk).exists())
+
+    def test_request_expiry(self):
+        """
+        Ensure pending requests are expired on activation and by the periodic sweep.
+        """
+        self.test_create_equb_authenticated()
+        equb = Equb.objects.get(name='test_equb')
+        for user in (self.users[1], self.users[2]):
+            EqubInviteRequest.objects.create(sender=self.users[0], receiver=user, equb=equb)
+        EqubJoinRequest.objects.create(sender=self.users[1], receiver=self.users[0], equb=equb)
+        equb.activate()
+        self.assertFalse(EqubInviteRequest.pending().filter(equb=equb).exists())
+        self.assertFalse(EqubJoinRequest.pending().filter(equb=equb).exists())
+
+        late_invitation = EqubInviteRequest.objects.create(sender=self.users[0], receiver=self.users[2], equb=equb)
+        old_friend_request = FriendRequest.objects.create(
+            sender=self.users[1], receiver=self.users[2],
+            creation_date=timezone.now() - settings.FRIEND_REQUEST_TTL - datetime.timedelta(minutes=1)
+        )
+        new_friend_request = FriendRequest.objects.create(sender=self.users[2], receiver=self.users[0])
+        expired = expire_stale_requests(batch_size=1)
+        self.assertEqual(expired, {EqubJoinRequest: 0, EqubInviteRequest: 1, FriendRequest: 1})
+        self.assertTrue(EqubInviteRequest.objects.get(pk=late_invitation.pk).is_expired)
+        self.assertTrue(FriendRequest.objects.get(pk=old_friend_request.pk).is_expired)
+        self.assertFalse(FriendRequest.objects.get(pk=new_friend_request.pk).is_expired)
+
+    def test_notification_fan_out(self):
+        """
+        Ensure notifications are created in bulk and their receivers can change them.
+        """
+        self.test_create_equb_invite_authenticated()
+        equb = Equb.objects.get(name='test_equb')
+        bid = Bid.objects.create(equb=equb, user=self.users[0], round=1, amount=Decimal('0.1'))
+        OutBidNotification.objects.all().delete()
+
+        with CaptureQueriesContext(connection) as context:
+            OutBidNotification.notify(equb=equb, previous_highest_bid=None, new_highest_bid=bid)
+        self.assertLessEqual(len(context.captured_queries), 6)
+        self.assertEqual(OutBidNotification.objects.filter(equb=equb).count(), equb.members.count())
+        for notification in OutBidNotification.objects.filter(equb=equb):
+            receiver = User.objects.get(pk=notification.receiver_id)
+            self.assertTrue(receiver.has_perm('moneypool.change_outbidnotification', notification))
+
+    def test_ownership_permissions(self):
+        """
+        Ensure change permissions follow ownership without storing permission rows.
+        """
+        self.test_create_equb_invite_authenticated()
+        equb = Equb.objects.get(name='test_equb')
+        invitation = EqubInviteRequest.objects.get(equb=equb)
+        self.assertTrue(self.users[0].has_perm('moneypool.change_equb', equb))
+        self.assertFalse(self.users[1].has_perm('moneypool.change_equb', equb))
+        self.assertTrue(self.users[1].has_perm('moneypool.change_equbinviterequest', invitation))
+        self.assertFalse(self.users[0].has_perm('moneypool.change_equbinviterequest', invitation))
+        self.assertTrue(self.users[1].has_perm('moneypool.change_user', self.users[1]))
+        self.assertFalse(self.users[1].has_perm('moneypool.change_user', self.users[0]))
+        self.assertEqual(UserObjectPermission.objects.count(), 0)
+
+        # owners get no permission on the whole model, so staff can't change others' objects in the admin
+        staff = User.objects.create_user(username='test_staff', password='test_password_staff', is_staff=True)
+        self.assertFalse(staff.has_perm('moneypool.change_equb'))
+        self.assertFalse(self.users[0].has_perm('moneypool.change_equb'))
+        self.client.login(username='test_staff', password='test_password_staff')
+        response = self.client.get(reverse('admin:moneypool_equb_change', args=[equb.pk]))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        # the sender can see the invitation but cannot address it
+        self.client.login(username='test_user_0', password='test_password_0')
+        response = self.client.patch(Util.get_test_object_url('EqubInviteRequest', invitation), {'is_rejected': True})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_password_reset_token_is_not_logged(self):
+        """
+        Ensure the reset token only reaches the user's email.
+        """
+        self.client.logout()
+        with mock.patch('builtins.print') as printed, self.assertLogs(level='DEBUG') as logs:
+            response = self.client.post(reverse('password_reset:reset-password-request'), {'email': self.users[1].email})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        key = self.users[1].password_reset_tokens.get().key
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn(key, mail.outbox[0].body)
+        printed.assert_not_called()
+        self.assertFalse(any(key in line for line in logs.output))
+
+    def test_cached_equb_is_invalidated_by_bid(self):
+        """
+        Ensure a cached equb is served fresh after a new bid.
+        """
+        self.test_create_equb_invite_authenticated()
+        equb = Equb.objects.get(name='test_equb')
+        equb_url = Util.get_test_object_url('Equb', equb)
+        self.assertEqual(self.client.get(equb_url).data['current_highest_bid'], 0)
+
+        self.client.post(reverse('bid-list'), {'equb': equb_url, 'amount': 0.3, 'round': 1})
+        self.assertEqual(self.client.get(equb_url).data['current_highest_bid'], Decimal('0.3'))
+
+    def test_highest_bid_is_broadcast(self):
+        """
+        Ensure members subscribed to an equb receive its new highest bid.
+        """
+        self.test_create_equb_invite_authenticated()
+        equb = Equb.objects.get(name='test_equb')
+        equb_url = Util.get_test_object_url('Equb', equb)
+        channel_layer = get_channel_layer()
+        async_to_sync(channel_layer.group_add)(equb_group_name(equb.id), 'test-channel')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('bid-list'), {'equb': equb_url, 'amount': 0.3, 'round': 1})
+
+        message = async_to_sync(channel_layer.receive)('test-channel')
+        self.assertEqual(message['event'], 'bid.highest')
+        self.assertEqual(message['data']['amount'], '0.300')
+        self.assertEqual(message['data']['round'], 1)
+        async_to_sync(channel_layer.flush)()
+
+    def test_round_scheduler(self):
+        """
+        Ensure the winner of a round is selected once its deadline is due.
+        """
+        self.test_create_equb_invite_authenticated()
+        equb = Equb.objects.get(name='test_equb')
+        deadline = RoundDeadline.objects.get(equb=equb)
+        self.assertEqual(deadline.round, 1)
+        self.assertEqual(deadline.due_at, equb.balance_manager.current_round_start_date + equb.cycle)
+
+        scheduler = RoundScheduler(clock=lambda: deadline.due_at - datetime.timedelta(seconds=1))
+        self.assertEqual(scheduler.run_once(), 1)
+        self.assertFalse(equb.balance_manager.received.exists())
+
+        scheduler.clock = lambda: deadline.due_at
+        self.assertEqual(scheduler.run_once(), scheduler.poll_interval)
+        self.assertEqual(equb.balance_manager.received.count(), 1)
+        self.assertFalse(RoundDeadline.objects.filter(equb=equb).exists())
+        self.assertTrue(Equb.objects.get(pk=equb.pk).is_in_payment_stage)
+
+    def test_round_scheduler_loads_late_commits(self):
+        """
+        Ensure a deadline committed after the poll that should have read it is still handled once due.
+        """
+        self.test_create_equb_invite_authenticated()
+        equb = Equb.objects.get(name='test_equb')
+        deadline = RoundDeadline.objects.get(equb=equb)
+        scheduler = RoundScheduler(clock=lambda: deadline.due_at - datetime.timedelta(hours=1))
+        RoundDeadline.objects.filter(pk=deadline.pk).delete()
+        scheduler.load()
+
+        # saved long before the next poll, as if by a transaction that committed after it
+        RoundDeadline.objects.create(equb=equb, round=deadline.round, due_at=deadline.due_at)
+        RoundDeadline.objects.filter(equb=equb).update(updated_at=deadline.due_at - datetime.timedelta(days=1))
+        scheduler.run_once()
+        self.assertFalse(equb.balance_manager.received.exists())
+
+        scheduler.clock = lambda: deadline.due_at
+        scheduler.run_once()
+        self.assertEqual(equb.balance_manager.received.count(), 1)
+
+    def test_round_scheduler_retries_after_delay(self):
+        """
+        Ensure a round whose winner can't be selected is retried after the retry delay, not at every poll.
+        """
+        self.test_create_equb_invite_authenticated()
+        equb = Equb.objects.get(name='test_equb')
+        due_at = RoundDeadline.objects.get(equb=equb).due_at
+        scheduler = RoundScheduler(clock=lambda: due_at)
+        with mock.patch.object(BalanceManager, 'select_winner', side_effect=DatabaseError) as select_winner:
+            scheduler.run_once()
+            self.assertEqual(RoundDeadline.objects.get(equb=equb).due_at, due_at + scheduler.retry_delay)
+            for seconds in (5, 10, 25):
+                scheduler.clock = lambda: due_at + datetime.timedelta(seconds=seconds)
+                scheduler.run_once()
+            self.assertEqual(select_winner.call_count, 1)
+
+        scheduler.clock = lambda: due_at + scheduler.retry_delay
+        scheduler.run_once()
+        self.assertEqual(equb.balance_manager.received.count(), 1)
+        self.assertFalse(RoundDeadline.objects.filter(equb=equb).exists())
+
+    def test_round_scheduler_shards(self):
+        """
+        Ensure every deadline is handled by exactly one shard.
+        """
+        self.test_create_equb_invite_authenticated()
+        equb = Equb.objects.get(name='test_equb')
+        schedulers = [RoundScheduler(shard=shard, shards=3) for shard in range(3)]
+        for scheduler in schedulers:
+            scheduler.load()
+        self.assertEqual([equb.id in scheduler.deadlines for scheduler in schedulers], [
+            shard == equb.id % 3 for shard in range(3)
+        ])
+
+    def test_equbs_by_user(self):
+        """
+        Ensure a user's equbs are listed when they are public or the current user shares or is invited to them.
+        """
+        owner = self.users[1]
+
+        def create_equb(name, is_private, creator=owner, members=()):
+            equb = Equb.objects.create(name=name, amount=100, max_members=5, creator=creator, is_private=is_private)
+            equb.members.add(*members)
+            return equb
+
+        create_equb('public_equb', False)
+        create_equb('shared_equb', True, members=[self.users[0]])
+        invited_equb = create_equb('invited_equb', True)
+        EqubInviteRequest.objects.create(sender=owner, receiver=self.users[0], equb=invited_equb)
+        create_equb('hidden_equb', True, members=[self.users[2]])
+        create_equb('other_equb', False, creator=self.users[2])
+
+        response = self.client.get(reverse('equb-by-user'), {'user': owner.id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            {equb['name'] for equb in response.data['results']}, {'public_equb', 'shared_equb', 'invited_equb'}
+        )
+
+    def test_user_search(self):
+        """
+        Ensure user search ranks prefix matches first and pages by cursor without a count.
+        """
+        User.objects.create_user(username='other_test_user', first_name='other', last_name='other', password='test_password')
+        response = self.client.get(reverse('user-search'), {'name': 'test_user'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('count', response.data)
+        usernames = [user['username'] for user in response.data['results']]
+        self.assertEqual(set(usernames[:2]), {'test_user_1', 'test_user_2'})
+        self.assertEqual(usernames[2], 'other_test_user')
+
+        # queries too short for trigrams only match the start of a name
+        response = self.client.get(reverse('user-search'), {'name': 'ot'})
+        self.assertEqual([user['username'] for user in response.data['results']], ['other_test_user'])
+
+    def test_recommended_equbs(self):
+        """
+        Ensure public equbs of friends and friends of friends are recommended, friends first.
+        """
+        self.users[0].friends.add(self.users[1])
+        self.users[1].friends.add(self.users[2])
+        self.assertEqual(MutualFriendship.objects.get(user=self.users[0], other=self.users[2]).mutual_friends, 1)
+
+        friend_of_friend_equb = Equb.objects.create(name='test_equb_2', amount=100, max_members=3, creator=self.users[2])
+        friend_equb = Equb.objects.create(name='test_equb_1', amount=100, max_members=3, creator=self.users[1])
+        Equb.objects.create(name='test_private_equb', amount=100, max_members=3, creator=self.users[1], is_private=True)
+        self.assertFalse(NewEqubNotification.objects.exists())
+
+        response = self.client.get(reverse('equb-recommended-equbs'))
+        self.assertEqual([equb['id'] for equb in response.data], [friend_equb.id, friend_of_friend_equb.id])
+        self.assertEqual(self.client.get(Util.get_test_object_url('Equb', friend_of_friend_equb)).status_code, status.HTTP_200_OK)
+
+        self.users[1].remove_friend(self.users[2])
+        self.assertFalse(MutualFriendship.objects.exists())
+        response = self.client.get(reverse('equb-recommended-equbs'))
+        self.assertEqual([equb['id'] for equb in response.data], [friend_equb.id])
+
+    def test_equb_access(self):
+        """
+        Ensure equbs are visible to their members and invited users through equb accesses.
+        """
+        data = {'name': 'test_equb', 'max_members': 3, 'amount': 100, 'cycle': "00:10:00", 'is_private': True}
+        self.client.post(self.equb_list_url, data)
+        equb = Equb.objects.get(name='test_equb')
+        self.assertTrue(EqubAccess.objects.get(user=self.users[0], equb=equb).is_member)
+
+        invitation = EqubInviteRequest.objects.create(sender=self.users[0], receiver=self.users[1], equb=equb)
+        self.assertTrue(EqubAccess.objects.get(user=self.users[1], equb=equb).is_invited)
+        self.client.login(username='test_user_1', password='test_password_1')
+        self.assertEqual([equb['id'] for equb in self.client.get(self.equb_list_url).data['results']], [equb.id])
+
+        invitation.delete()
+        self.assertFalse(EqubAccess.objects.filter(user=self.users[1]).exists())
+        self.assertEqual(self.client.get(self.equb_list_url).data['results'], [])
+        self.assertEqual(self.client.get(Util.get_test_object_url('Equb', equb)).status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(CACHES=SHARED_CACHES)
+class EqubListQueryCountTestCase(APITestCase):
+    equb_list_url = reverse('equb-list')
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='test_user_0', email='test_0@gamil.com',
+            first_name='test_first_name_0', last_name='test_last_name_0',
+            password='test_password_0'
+        )
+        equb_cache().clear()
+        self.client.login(username='test_user_0', password='test_password_0')
+
+    def create_equbs(self, count):
+        for idx in range(count):
+            Equb.objects.create(
+                name=f'test_equb_{Equb.objects.count()}', amount=100, max_members=3, creator=self.user
+            )
+
+    def count_list_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.equb_list_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(context.captured_queries)
+
+    def test_list_query_count_is_constant(self):
+        """
+        Ensure listing equbs costs the same number of queries for any number of equbs.
+        """
+        self.create_equbs(2)
+        queries_for_two = self.count_list_queries()
+        self.create_equbs(6)
+        queries_for_eight = self.count_list_queries()
+        self.assertEqual(queries_for_two, queries_for_eight)
+
+    def test_list_is_paginated_by_cursor(self):
+        """
+        Ensure equbs are listed a page at a time from the most recent and a later page costs no more queries.
+        """
+        self.create_equbs(12)
+        with CaptureQueriesContext(connection) as context:
+            first_page = self.client.get(self.equb_list_url).data
+        equb_cache().clear()
+        with CaptureQueriesContext(connection) as next_context:
+            second_page = self.client.get(first_page['next']).data
+        self.assertEqual(len(next_context.captured_queries), len(context.captured_queries))
+        names = [equb['name'] for equb in first_page['results'] + second_page['results']]
+        self.assertEqual(names, [f'test_equb_{idx}' for idx in reversed(range(12))])
+        self.assertIsNone(second_page['next'])
+
+    def test_conditional_requests(self):
+        """
+        Ensure unchanged equbs and users are answered with 304 Not Modified until they change.
+        """
+        self.create_equbs(1)
+        equb = Equb.objects.get()
+        urls = {
+            'equb': Util.get_test_object_url('Equb', equb),
+            'current_user': reverse('user-current-user'),
+            'user_profile': reverse('user-user-profile') + f'?id={self.user.id}',
+        }
+        etags = {name: self.client.get(url)['ETag'] for name, url in urls.items()}
+        self.assertTrue(self.client.get(urls['equb']).has_header('Last-Modified'))
+        for name, url in urls.items():
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[name])
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(response['ETag'], etags[name])
+            self.assertLessEqual(len(context.captured_queries), 3)  # the session, its user and the equb or the counts
+
+        other = User.objects.create_user(username='test_user_1', first_name='test', last_name='test')
+        equb.members.add(other)
+        self.user.first_name = 'renamed'
+        self.user.save()
+        for name, url in urls.items():
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[name])
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotEqual(response['ETag'], etags[name])
+
+        # deleting an equb doesn't move the versions of its members, but changes their counts
+        etag = self.client.get(urls['user_profile'])['ETag']
+        Equb.objects.all().delete()
+        response = self.client.get(urls['user_profile'], HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response.data['equbsCount']), (status.HTTP_200_OK, 0))
+
+        missing_url = reverse('user-user-profile') + f'?id={other.id + 1}'
+        self.assertEqual(self.client.get(missing_url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_404_NOT_FOUND)
+        with override_settings(CACHES=UNSHARED_CACHES):
+            response = self.client.get(urls['current_user'], HTTP_IF_NONE_MATCH=etags['current_user'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(response.has_header('ETag'))
+
+    def test_embedded_users_are_compact(self):
+        """
+        Ensure embedded users only carry their relations when expanded.
+        """
+        self.create_equbs(1)
+        creator = self.client.get(self.equb_list_url).data['results'][0]['creator']
+        self.assertEqual(
+            set(creator), {'id', 'url', 'username', 'first_name', 'last_name', 'score', 'profile_picture'}
+        )
+        creator = self.client.get(self.equb_list_url, {'expand': 'friends,selected_payment_methods'}).data['results'][0]['creator']
+        self.assertEqual(creator['friends'], [])
+        self.assertEqual(len(creator['selected_payment_methods']), 1)
+        self.assertNotIn('joined_equbs', creator)
+        self.assertIn('friends', self.client.get(reverse('user-current-user')).data)
+
+    def test_sparse_fieldsets(self):
+        """
+        Ensure only the requested fields of an equb are computed.
+        """
+        self.create_equbs(3)
+        card_fields = 'id,name,amount,percent_completed,current_round,time_left_till_next_round'
+        full_queries = self.count_list_queries()
+        equb_cache().clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.equb_list_url, {'fields': card_fields})
+        self.assertEqual(set(response.data['results'][0]), set(card_fields.split(',')))
+        self.assertLess(len(context.captured_queries), full_queries)
+
+        response = self.client.get(self.equb_list_url, {'omit': 'members,creator'})
+        self.assertNotIn('members', response.data['results'][0])
+        self.assertIn('current_award', response.data['results'][0])
+
+    def invite(self, count):
+        inviter = User.objects.get_or_create(username='test_inviter', first_name='test_inviter', last_name='test_inviter')[0]
+        for idx in range(count):
+            equb = Equb.objects.create(
+                name=f'test_equb_{Equb.objects.count()}', amount=100, max_members=3, creator=inviter
+            )
+            EqubInviteRequest.objects.create(sender=inviter, receiver=self.user, equb=equb)
+
+    def count_queries(self, url):
+        equb_cache().clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(context.captured_queries), len(response.data['results'])
+
+    def test_invitations_query_count_is_constant(self):
+        """
+        Ensure listing invitations costs the same number of queries for any number of invitations.
+        """
+        self.invite(2)
+        equbs_for_two = self.count_queries(reverse('equb-invited-equbs'))
+        invitations_for_two = self.count_queries(reverse('equbinviterequest-received'))
+        self.invite(6)
+        equbs_for_eight = self.count_queries(reverse('equb-invited-equbs'))
+        invitations_for_eight = self.count_queries(reverse('equbinviterequest-received'))
+        self.assertEqual((equbs_for_two[0], equbs_for_eight[1]), (equbs_for_eight[0], 8))
+        self.assertEqual((invitations_for_two[0], invitations_for_eight[1]), (invitations_for_eight[0], 8))
+
+    def test_list_is_cached(self):
+        """
+        Ensure a repeated list is served from the cache.
+        """
+        self.create_equbs(3)
+        uncached_queries = self.count_list_queries()
+        cached_queries = self.count_list_queries()
+        self.assertLess(cached_queries, uncached_queries)
+
+    def test_cached_equbs_keep_their_fields(self):
+        """
+        Ensure an equb trimmed by ?fields= and the same equb embedded in full in another resource are cached apart.
+        """
+        self.invite(1)
+        equb_url = reverse('equb-detail', args=[Equb.objects.get().id])
+        params = {'fields': 'id,equb'}
+        for _ in range(2):
+            self.assertEqual(set(self.client.get(equb_url, params).data), {'id'})
+            invitation = self.client.get(reverse('equbinviterequest-received'), params).data['results'][0]
+            self.assertEqual(set(invitation), {'id', 'equb'})
+            self.assertIn('members', invitation['equb'])
+
+    @override_settings(CACHES=UNSHARED_CACHES)
+    def test_list_is_not_cached_without_shared_cache(self):
+        """
+        Ensure equbs aren't cached when the cache isn't shared by all processes.
+        """
+        self.create_equbs(3)
+        self.assertEqual(self.count_list_queries(), self.count_list_queries())
+
+    def test_dashboard(self):
+        """
+        Ensure the dashboard counts and cards cost the same number of queries for any number of equbs.
+        """
+        url = reverse('equb-dashboard')
+        self.create_equbs(2)
+        self.invite(1)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        queries_for_three = len(context.captured_queries)
+        self.assertEqual(response.data['pending']['count'], 2)
+        self.assertEqual(response.data['invited']['count'], 1)
+        card = response.data['pending']['equbs'][0]
+        self.assertEqual((card['member_count'], card['percent_joined'], card['current_round']), (1, 33.33, 1))
+
+        self.create_equbs(6)
+        self.invite(6)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(len(context.captured_queries), queries_for_three)
+        self.assertEqual((response.data['pending']['count'], len(response.data['invited']['equbs'])), (8, 7))
+
+
+class IndexUsageTestCase(APITestCase):
+    """
+    Ensure the hot lookups are planned with their composite and partial indexes.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='test_user_0', password='test_password_0')
+        self.equb = Equb.objects.create(name='test_equb', amount=100, max_members=3, creator=self.user)
+
+    def assertUsesIndex(self, queryset, index_name):
+        if connection.vendor == 'postgresql':
+            # tables of a test database are too small for the planner to prefer an index
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        self.assertIn(index_name, queryset.explain())
+
+    def test_hot_lookups_use_indexes(self):
+        lookups = {
+            'paymentrequest_equb_round': PaymentConfirmationRequest.objects.filter(equb=self.equb, round=1, is_rejected=False),
+            'unique_equb_round_highest_bid': HighestBid.objects.filter(equb=self.equb, round=1),
+            'bid_equb_round_amount': Bid.objects.filter(equb=self.equb, round=1).order_by('-amount', 'date'),
+            'inviterequest_receiver_pending': EqubInviteRequest.pending().filter(receiver=self.user),
+            'friendrequest_receiver_pending': FriendRequest.pending().filter(receiver=self.user),
+            'friendrequest_sender_pending': FriendRequest.pending().filter(sender=self.user),
+        }
+        for index_name, queryset in lookups.items():
+            with self.subTest(index_name):
+                self.assertUsesIndex(queryset, index_name)
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'concurrent transactions need PostgreSQL')
+class BidRaceTestCase(TransactionTestCase):
+    """
+    Ensure bids placed at the same time from several connections keep the highest one.
+    """
+
+    def test_concurrent_bids(self):
+        user = User.objects.create_user(username='test_user_0', password='test_password_0')
+        equb = Equb.objects.create(name='test_equb', amount=100, max_members=3, creator=user)
+        bids = Bid.objects.bulk_create([
+            Bid(equb=equb, user=user, round=1, amount=Decimal(amount) / 100) for amount in range(10, 90, 5)
+        ])
+        random.shuffle(bids)
+        barrier = threading.Barrier(len(bids))
+
+        def place(bid):
+            try:
+                barrier.wait()
+                return bid.place()
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=len(bids)) as executor:
+            placements = dict(zip(bids, executor.map(place, bids)))
+        highest_bid = max(bids, key=lambda bid: bid.amount)
+        self.assertEqual(HighestBid.objects.get(equb=equb, round=1).bid, highest_bid)
+        self.assertEqual(RoundState.objects.get(equb=equb, round=1).highest_bid_amount, highest_bid.amount)
+        self.assertTrue(placements[highest_bid].is_highest)
+
 
 class Util:
     @staticmethod
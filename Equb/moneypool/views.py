@@ -3,31 +3,106 @@ from rest_framework import permissions
 from rest_framework.response import Response
 from rest_framework.decorators import action, permission_classes
 from rest_framework.permissions import IsAuthenticated
-from rest_framework.pagination import PageNumberPagination
 from rest_framework.throttling import AnonRateThrottle, UserRateThrottle
+from django.utils.cache import get_conditional_response
 from django.utils.decorators import method_decorator
+from django.utils.http import http_date
 from django.views.decorators.cache import cache_page
-from django.db.models import Q
+from django.db.models import Q, Count, Exists, OuterRef
 from django.conf import settings
 import stripe
 
 from .serializers import *
 from .models import *
 from .permissions import *
+from .pagination import (
+    UserSearchPagination, UserCursorPagination, EqubCursorPagination, BidCursorPagination, RequestCursorPagination
+)
+from .snapshots import EXPANDABLE_USER_FIELDS
+from .search import search_users
+from .recommendations import discoverable_equbs, recommended_equbs
+from .dashboard import dashboard
+from .auction import bid_rank
+from .cache import is_cache_shared, get_versions, version_timestamp, representation_etag
 
 stripe.api_key = settings.STRIPE_SECRET_KEY
 
+
+def with_users(queryset, context, *relations):
+    """
+    selects the users at relations of queryset along with the relations
+    expanded in their representation
+    """
+    expansions = user_expansions(context)
+    return queryset.select_related(*relations).prefetch_related(
+        *[f'{relation}__{field}' for relation in relations for field in expansions]
+    )
+
+
+def paginated_response(view, queryset):
+    """
+    returns the response of the page of queryset requested from view
+    """
+    page = view.paginate_queryset(queryset)
+    serializer = view.get_serializer(page, many=True)
+    return view.get_paginated_response(serializer.data)
+
+
+def equbs_with_ids(*id_querysets):
+    """
+    returns the equbs whose id is in any of id_querysets. The ids are unioned
+    rather than ORed, so that each set is read with its own indexes.
+    """
+    first, *rest = id_querysets
+    return Equb.objects.filter(id__in=first.union(*rest))
+
+
+def conditional_response(request, kind, id, respond, *validators):
+    """
+    returns 304 Not Modified if the client's copy of the resource is current,
+    otherwise the response of respond() along with its validators. The copy is
+    current if the version of the equb or user id and any further validators,
+    like counts that the version doesn't track, are unchanged. Versions are only
+    reliable when the cache is shared, so without it every request is answered.
+    """
+    if not is_cache_shared():
+        return respond()
+    version = get_versions(kind, [id])[id]
+    etag = representation_etag(kind, version, request, *validators)
+    last_modified = version_timestamp(version)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = respond()
+    if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
 class UserViewSet(viewsets.ModelViewSet):
     """
     users to be viewed or edited.
     """
     queryset = User.objects.all().order_by('-date_joined')
+    pagination_class = UserCursorPagination
 
     def get_permissions(self):
         if self.request.method in ['GET', 'POST']:
             return [permissions.AllowAny()]
         else:
-            return [permissions.DjangoObjectPermissions()]
+            return [OwnershipPermissions()]
+
+    def get_queryset(self):
+        # only the relations expanded in the response are prefetched
+        return super().get_queryset().prefetch_related(*user_expansions(self.get_serializer_context()))
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.action in ['retrieve', 'current_user', 'user_profile']:
+            # a single user resource is expanded unless it is embedded
+            context['expand_users'] = EXPANDABLE_USER_FIELDS
+        return context
 
     def get_serializer_class(self):
         if self.request.method in ['DELETE', 'POST']:
@@ -72,8 +147,10 @@ class UserViewSet(viewsets.ModelViewSet):
         get details for the current user
         """
         user = self.request.user
-        serializer = self.get_serializer(user)
-        return Response(serializer.data)
+        respond = lambda: Response(self.get_serializer(user).data)
+        if request.method != 'GET':
+            return respond()
+        return conditional_response(request, 'user', user.id, respond, 'current-user')
     
     @action(detail=False, methods=['get'], url_path='userprofile')
     @permission_classes([IsAuthenticated])
@@ -87,15 +164,25 @@ class UserViewSet(viewsets.ModelViewSet):
                 {"detail": "Id is a required parameter."},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        user = self.get_queryset().get(id=name)
-        friendsCount = user.friends.count()
-        equbsCount = user.joined_equbs.count()
-        serializer = self.get_serializer(user)
-        return Response({
-            "user": serializer.data,
-            "friendsCount": friendsCount,
-            "equbsCount": equbsCount
-        })
+        # the counts are read along with the user's existence, since they also change
+        # when friends or equbs are deleted, which doesn't move the user's version
+        counts = User.objects.filter(id=name).annotate(
+            friends_count=Count('friends', distinct=True), equbs_count=Count('joined_equbs', distinct=True)
+        ).values('friends_count', 'equbs_count').first()
+        if counts is None:
+            return Response({"detail": "User not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        def respond():
+            user = self.get_queryset().get(id=name)
+            serializer = self.get_serializer(user)
+            return Response({
+                "user": serializer.data,
+                "friendsCount": counts['friends_count'],
+                "equbsCount": counts['equbs_count']
+            })
+        return conditional_response(
+            request, 'user', int(name), respond, 'user-profile', counts['friends_count'], counts['equbs_count']
+        )
 
     @action(detail=False, methods=['get'], url_path='friends')
     @permission_classes([IsAuthenticated])
@@ -110,18 +197,16 @@ class UserViewSet(viewsets.ModelViewSet):
         else:
             user = self.get_queryset().get(id=id)
 
-        friends = user.friends.all()
-        serializer = self.get_serializer(friends, many=True)
-        return Response(serializer.data)
+        friends = user.friends.prefetch_related(*user_expansions(self.get_serializer_context()))
+        return paginated_response(self, friends)
     
     @method_decorator(cache_page(120))
     @action(detail=False, methods=['get'], url_path='search')
     def search(self, request):
         """
-        search for users by name paginated by 10
+        search for users by name ranked by relevance and paginated by cursor
         """
-        paginator = PageNumberPagination()
-        paginator.page_size = 5
+        paginator = UserSearchPagination()
         name = request.query_params.get('name')
         if not name:
             return Response(
@@ -129,16 +214,12 @@ class UserViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        queryset = User.objects.filter(
-            Q(first_name__icontains=name) | 
-            Q(last_name__icontains=name) | 
-            Q(username__icontains=name)
-        ).exclude(
+        queryset = search_users(name).exclude(
             Q(id=request.user.id) | 
             Q(username__in=['deleted', 'AnonymousUser']) | 
             Q(is_staff=True)
-        )
-        result_page = paginator.paginate_queryset(queryset, request)
+        ).prefetch_related(*user_expansions(self.get_serializer_context()))
+        result_page = paginator.paginate_queryset(queryset, request, view=self)
         serializer = self.get_serializer(result_page, many=True)
         return paginator.get_paginated_response(serializer.data)
 
@@ -149,15 +230,23 @@ class EqubViewSet(AuthenticatedAndObjectPermissionMixin, viewsets.ModelViewSet):
     """
 
     serializer_class = EqubSerializer
+    pagination_class = EqubCursorPagination
 
     def get_queryset(self):
         user = self.request.user
-        joined_equbs = user.joined_equbs.all()
-        invited_equbs = Equb.objects.filter(id__in=user.received_equbinviterequests.values_list('equb__id', flat=True))
-        recommended_equbs = Equb.objects.filter(id__in=NewEqubNotification.objects.filter(receiver=user, equb__is_active=False).values_list('equb__id', flat=True))
-        combined_equbs = joined_equbs | invited_equbs | recommended_equbs
-        return combined_equbs.distinct()
+        # joined and invited equbs are read from the user's equb accesses
+        accessible_ids = EqubAccess.objects.filter(user=user).values('equb_id')
+        discoverable_ids = discoverable_equbs(user).order_by().values('id')
+        return equbs_with_ids(accessible_ids, discoverable_ids)
         
+    def retrieve(self, request, *args, **kwargs):
+        """
+        get an equb, or 304 Not Modified once it is loaded if the client's copy is current
+        """
+        equb = self.get_object()
+        respond = lambda: Response(self.get_serializer(equb).data)
+        return conditional_response(request, 'equb', equb.id, respond)
+
     def perform_create(self, serializer):
         serializer.save(creator=self.request.user)
         
@@ -168,8 +257,7 @@ class EqubViewSet(AuthenticatedAndObjectPermissionMixin, viewsets.ModelViewSet):
         """
         user = self.request.user
         equbs = user.joined_equbs.filter(is_active=True, is_completed=False)
-        serializer = self.get_serializer(equbs, many=True)
-        return Response(serializer.data)
+        return paginated_response(self, equbs)
     
     @action(detail=False, methods=['get'], url_path='pendingequbs')
     def pending_equbs(self, request):
@@ -178,8 +266,7 @@ class EqubViewSet(AuthenticatedAndObjectPermissionMixin, viewsets.ModelViewSet):
         """
         user = self.request.user
         equbs = user.joined_equbs.filter(is_active=False, is_completed=False)
-        serializer = self.get_serializer(equbs, many=True)
-        return Response(serializer.data)
+        return paginated_response(self, equbs)
 
     @action(detail=False, methods=['get'], url_path='invitedequbs')
     def invited_equbs(self, request):
@@ -187,13 +274,11 @@ class EqubViewSet(AuthenticatedAndObjectPermissionMixin, viewsets.ModelViewSet):
         get equbs that user has been invited to
         """
         user = self.request.user
-        invitations = user.received_equbinviterequests.all()
-        equbs = [invitation.equb for invitation in invitations]
         # making sure that the equbs are not active and user has not joined them
-        equbs = [equb for equb in equbs if not equb.is_active and not user.joined_equbs.filter(id=equb.id).exists()]
-        equbs = list(set(equbs))
-        serializer = self.get_serializer(equbs, many=True)
-        return Response(serializer.data)
+        equbs = Equb.objects.filter(
+            accesses__user=user, accesses__is_invited=True, accesses__is_member=False, is_active=False
+        )
+        return paginated_response(self, equbs)
     
     @action(detail=False, methods=['get'], url_path='pastequbs')
     def past_equbs(self, request):
@@ -202,19 +287,30 @@ class EqubViewSet(AuthenticatedAndObjectPermissionMixin, viewsets.ModelViewSet):
         """
         user = self.request.user
         equbs = user.joined_equbs.filter(is_completed=True)
-        serializer = self.get_serializer(equbs, many=True)
-        return Response(serializer.data)
+        return paginated_response(self, equbs)
     
     @action(detail=False, methods=['get'], url_path='recommendedequbs')
     def recommended_equbs(self, request):
         """
-        get new public equbs that have been created by users friends
+        get new public equbs that have been created by users friends or their friends
         """
-        user = self.request.user
-        new_equb_notifications = NewEqubNotification.objects.filter(receiver=user, equb__is_active=False)
-        equbs = [notification.equb for notification in new_equb_notifications]
+        # recommendations are ranked rather than paged and bounded by RECOMMENDATION_LIMIT
+        equbs = recommended_equbs(self.request.user)
         serializer = self.get_serializer(equbs, many=True)
         return Response(serializer.data)
+
+    @action(detail=False, methods=['get'], url_path='dashboard')
+    def dashboard(self, request):
+        """
+        get the number of active, pending, invited, past and recommended equbs
+        of user along with compact cards of the first ones of each
+        """
+        categories = dashboard(self.request.user)
+        context = self.get_serializer_context()
+        return Response({
+            category: DashboardCategorySerializer(data, context=context).data
+            for category, data in categories.items()
+        })
    
     @action(detail=False, methods=['get'], url_path='by-user')
     def by_user(self, request):
@@ -229,14 +325,11 @@ class EqubViewSet(AuthenticatedAndObjectPermissionMixin, viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         user = User.objects.get(id=user_id)
-        current_user = self.request.user
-        public_equbs = user.joined_equbs.filter(is_private=False)
-        shared_private_equbs = user.joined_equbs.filter(is_private=True, members__in=[current_user])
-        current_user_invited_equbs = Equb.objects.filter(id__in=user.received_equbinviterequests.values_list('equb__id', flat=True))
-        invited_private_equbs = current_user_invited_equbs.filter(is_private=True, members__in=[user])
-        equbs = public_equbs | shared_private_equbs | invited_private_equbs
-        serializer = self.get_serializer(equbs, many=True)
-        return Response(serializer.data)
+        # the current user's accesses cover the equbs they share with user or are invited to
+        joined_ids = EqubAccess.objects.filter(user=user, is_member=True).values('equb_id')
+        public_ids = Equb.objects.filter(id__in=joined_ids, is_private=False).order_by().values('id')
+        accessible_ids = EqubAccess.objects.filter(user=self.request.user, equb_id__in=joined_ids).values('equb_id')
+        return paginated_response(self, equbs_with_ids(public_ids, accessible_ids))
 
 class BidViewSet(AuthenticatedAndObjectPermissionMixin, viewsets.ModelViewSet):
     """
@@ -244,12 +337,13 @@ class BidViewSet(AuthenticatedAndObjectPermissionMixin, viewsets.ModelViewSet):
     """
 
     serializer_class = BidSerializer
+    pagination_class = BidCursorPagination
 
     def get_queryset(self):
         equbs = self.request.user.joined_equbs.all()
         if equbs is None:
             return None
-        return Bid.objects.filter(equb__in=equbs) # all bids that belong to equbs joined by current user
+        return Bid.objects.filter(equb__in=equbs).select_related('highestbid') # all bids that belong to equbs joined by current user
 
     def perform_create(self, serializer):
         serializer.save(
@@ -257,12 +351,30 @@ class BidViewSet(AuthenticatedAndObjectPermissionMixin, viewsets.ModelViewSet):
             round=serializer.validated_data['equb'].balance_manager.finished_rounds + 1
         )
 
+    @action(detail=False, methods=['get'], url_path='rank')
+    def rank(self, request):
+        """
+        get the rank of the current user's best bid in the current round of an equb
+        """
+        equb_id = request.query_params.get('equb')
+        if not equb_id:
+            return Response(
+                {"detail": "Equb is a required parameter."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        equb = self.request.user.joined_equbs.get(id=equb_id)
+        round = equb.balance_manager.current_round()
+        rank, bidders = bid_rank(equb, round, self.request.user)
+        return Response({"round": round, "rank": rank, "bidders": bidders})
+
 
 class EqubJoinRequestViewSet(AuthenticatedAndObjectPermissionMixin, viewsets.ModelViewSet):
+    pagination_class = RequestCursorPagination
 
     def get_queryset(self):
         user = self.request.user
-        return user.received_equbjoinrequests.all() | user.sent_equbjoinrequests.all()
+        requests = user.received_equbjoinrequests.all() | user.sent_equbjoinrequests.all()
+        return with_users(requests, self.get_serializer_context(), 'receiver')
 
     def get_serializer_class(self, *args, **kwargs):
         if self.request.method in ['PUT', 'PATCH']:
@@ -275,13 +387,15 @@ class EqubJoinRequestViewSet(AuthenticatedAndObjectPermissionMixin, viewsets.Mod
 
 
 class EqubInviteRequestViewSet(AuthenticatedAndObjectPermissionMixin, viewsets.ModelViewSet):
+    pagination_class = RequestCursorPagination
 
     def get_queryset(self):
         user = self.request.user
         equbs = user.joined_equbs.all()
         invites_to_joined_equbs = EqubInviteRequest.objects.filter(equb__in=equbs)
         received = user.received_equbinviterequests.all()
-        return received | invites_to_joined_equbs
+        invitations = (received | invites_to_joined_equbs).select_related('equb')
+        return with_users(invitations, self.get_serializer_context(), 'receiver')
 
     def get_serializer_class(self, *args, **kwargs):
         if self.request.method in ['PUT', 'PATCH']:
@@ -298,11 +412,13 @@ class EqubInviteRequestViewSet(AuthenticatedAndObjectPermissionMixin, viewsets.M
         get equb invitations received by user
         """
         user = self.request.user
-        invitations = user.received_equbinviterequests.filter(is_accepted=False, is_rejected=False, is_expired=False)
-        # making sure that the equbs are not active and user has not joined them
-        invitations = [invitation for invitation in invitations if not user.joined_equbs.filter(id=invitation.equb.id).exists()]
-        serializer = self.get_serializer(invitations, many=True)
-        return Response(serializer.data)
+        # making sure that user has not joined the equbs
+        joined = EqubMembership.objects.filter(member=user, equb=OuterRef('equb'))
+        invitations = EqubInviteRequest.objects.filter(
+            ~Exists(joined), receiver=user, is_accepted=False, is_rejected=False, is_expired=False
+        ).select_related('equb')
+        invitations = with_users(invitations, self.get_serializer_context(), 'receiver')
+        return paginated_response(self, invitations)
 
     @action(detail=False, methods=['get'], url_path='by-equb')
     def by_equb(self, request):
@@ -315,18 +431,18 @@ class EqubInviteRequestViewSet(AuthenticatedAndObjectPermissionMixin, viewsets.M
                 {"detail": "Equb is a required parameter."},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        invitations = EqubInviteRequest.objects.filter(equb=equb_id)
-        serializer = self.get_serializer(invitations, many=True)
-        return Response(serializer.data)
+        invitations = with_users(EqubInviteRequest.objects.filter(equb=equb_id), self.get_serializer_context(), 'receiver')
+        return paginated_response(self, invitations)
 
 class FriendRequestViewSet(AuthenticatedAndObjectPermissionMixin, viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = RequestCursorPagination
 
     def get_queryset(self):
         user = self.request.user
         received = user.received_friendrequests.all()
         sent = user.sent_friendrequests.all()
-        return received | sent
+        return with_users(received | sent, self.get_serializer_context(), 'sender', 'receiver')
 
     def get_serializer_class(self, *args, **kwargs):
         if self.request.method in ['PUT', 'PATCH']:
@@ -344,8 +460,8 @@ class FriendRequestViewSet(AuthenticatedAndObjectPermissionMixin, viewsets.Model
         """
         user = self.request.user
         requests = user.received_friendrequests.filter(is_accepted=False, is_rejected=False, is_expired=False)
-        serializer = self.get_serializer(requests, many=True)
-        return Response(serializer.data)
+        requests = with_users(requests, self.get_serializer_context(), 'sender', 'receiver')
+        return paginated_response(self, requests)
     
     @action(detail=False, methods=['get'], url_path='sent')
     def sent(self, request):
@@ -354,17 +470,18 @@ class FriendRequestViewSet(AuthenticatedAndObjectPermissionMixin, viewsets.Model
         """
         user = self.request.user
         requests = user.sent_friendrequests.filter(is_accepted=False, is_rejected=False, is_expired=False)
-        serializer = self.get_serializer(requests, many=True)
-        return Response(serializer.data)
+        requests = with_users(requests, self.get_serializer_context(), 'sender', 'receiver')
+        return paginated_response(self, requests)
 
 class PaymentConfirmationRequestViewSet(AuthenticatedAndObjectPermissionMixin, viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = RequestCursorPagination
 
     def get_queryset(self):
         user = self.request.user
         received = user.received_paymentconfirmationrequests.all()
         sent = user.sent_paymentconfirmationrequests.all()
-        return received | sent
+        return with_users(received | sent, self.get_serializer_context(), 'sender').select_related('payment_method')
 
     def get_serializer_class(self, *args, **kwargs):
         if self.request.method in ['PUT', 'PATCH']:
@@ -403,8 +520,8 @@ class PaymentConfirmationRequestViewSet(AuthenticatedAndObjectPermissionMixin, v
                 status=status.HTTP_400_BAD_REQUEST
             )
         queryset = PaymentConfirmationRequest.objects.filter(equb=equb_id, round=round, is_rejected=False)
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        queryset = with_users(queryset, self.get_serializer_context(), 'sender').select_related('payment_method')
+        return paginated_response(self, queryset)
 
 class PaymentMethodViewSet(AuthenticatedAndObjectPermissionMixin, viewsets.ModelViewSet):
     serializer_class = PaymentMethodSerializer